@@ -0,0 +1,6 @@
+import os
+
+if os.environ.get("ISIM_STARTUP_PROFILE"):
+    # Before anything else is imported, also in the worker processes, see startup
+    from isim_control import startup
+    startup.install()
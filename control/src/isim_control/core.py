@@ -33,4 +33,25 @@ class ISIMCore(CMMCorePlus):
             self.waitForDevice(device)
             pos = self.getXYPosition(device)
             self.events.XYStagePositionChanged.emit(device, *pos)
-        del receiver
\ No newline at end of file
+        del receiver
+
+def add_live_frame_signal(mmcore: CMMCorePlus) -> None:
+    """Add the liveFrameReady(img, event, meta) signal that the LiveEngine emits to mmcore.events.
+
+    Works with the Qt and the psygnal backend of pymmcore-plus, so live can also run headless.
+    """
+    events_class = mmcore.events.__class__
+    if hasattr(events_class, 'liveFrameReady'):
+        return
+    try:
+        from qtpy.QtCore import QObject, Signal
+        if not isinstance(mmcore.events, QObject):
+            raise ImportError
+    except ImportError:
+        from psygnal import Signal
+    #This is hacky, might just want to make our own preview
+    new_cls = type(
+        events_class.__name__, events_class.__bases__,
+        {**events_class.__dict__, 'liveFrameReady': Signal(object, object, dict)},
+    )
+    mmcore.events.__class__ = new_cls
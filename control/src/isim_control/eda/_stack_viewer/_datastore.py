@@ -3,7 +3,7 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 from psygnal import Signal
-from isim_control.eda._util.zarr_saver import POS_PREFIX, OMEZarrWriter
+from isim_control.eda._util.zarr_saver import POS_PREFIX, ChunkedOMEZarrWriter, OMEZarrWriter
 from useq import MDAEvent
 import yaml
 from pathlib import Path
@@ -19,9 +19,9 @@ if TYPE_CHECKING:
 class QOMEZarrDatastore(OMEZarrWriter):
     frame_ready = Signal(MDAEvent)
 
-    def __init__(self, store = None, overwrite=False) -> None:
+    def __init__(self, store = None, overwrite=False, pyramid=(), **kwargs) -> None:
         self.store = store
-        super().__init__(store=store, overwrite=overwrite)
+        super().__init__(store=store, overwrite=overwrite, pyramid=pyramid, **kwargs)
 
     def sequenceStarted(self, sequence: useq.MDASequence) -> None:
         self._used_axes = tuple(x for x in sequence.used_axes if x not in ['p'])
@@ -43,10 +43,15 @@ class QOMEZarrDatastore(OMEZarrWriter):
         super().frameReady(frame, event, meta or {})
         self.frame_ready.emit(event)
 
-    def get_frame(self, event: MDAEvent) -> np.ndarray:
+    def get_frame(self, event: MDAEvent, level: int = 0) -> np.ndarray:
+        """level > 0 reads from the pyramid levels, if the datastore has them."""
         key = f'{POS_PREFIX}{event.index.get("p", 0)}'
-        ary = self.position_arrays[key]
+        ary = self.level(key, level)
 
         index = tuple(event.index.get(k) for k in self._used_axes)
-        data: np.ndarray = ary[index]
+        data: np.ndarray = self.read_frame(ary, index)
         return data
+
+
+class ChunkedQOMEZarrDatastore(QOMEZarrDatastore, ChunkedOMEZarrWriter):
+    """QOMEZarrDatastore that writes compressed blocks of chunks, see ChunkedOMEZarrWriter."""
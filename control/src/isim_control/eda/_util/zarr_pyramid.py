@@ -0,0 +1,179 @@
+"""Downsampled levels of OME-Zarr position arrays, for overviews that don't read the full data.
+
+PyramidBuilder is used by OMEZarrWriter while the frames come in: every plane is downsampled in a
+thread pool and written to the level arrays next to the position array, e.g. p0_2x, p0_4x and
+p0_8x for factors (2, 4, 8). The levels are added to the datasets of the position in the ome-ngff
+multiscales metadata, with their scale. Each level is made from the one before, so the levels
+cost little more than the first.
+
+build_pyramid does the same for a store that was written without levels:
+
+    python -m isim_control.eda._util.zarr_pyramid data.zarr --factors 2 4 8
+"""
+from __future__ import annotations
+
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Literal, Sequence
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import zarr
+
+logger = logging.getLogger(__name__)
+
+Method = Literal["mean", "stride"]
+
+
+def level_path(path: str, factor: int) -> str:
+    return f"{path}_{factor}x"
+
+
+def downsample(plane: np.ndarray, factor: int, method: Method = "mean") -> np.ndarray:
+    """Downsample the last two axes by factor, edges that don't fill a block are cut off."""
+    if factor == 1:
+        return plane
+    h, w = (plane.shape[-2] // factor) * factor, (plane.shape[-1] // factor) * factor
+    if method == "stride":
+        return plane[..., :h:factor, :w:factor]
+    blocks = plane[..., :h, :w].reshape(*plane.shape[:-2], h // factor, factor,
+                                        w // factor, factor)
+    mean = blocks.mean(axis=(-3, -1), dtype=np.float32)
+    if np.issubdtype(plane.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(plane.dtype)
+
+
+class PyramidBuilder:
+    """Writes the levels of the position arrays of group, plane by plane in n_threads threads.
+
+    factors have to be multiples of each other, like (2, 4, 8). Levels that would be smaller than
+    one pixel are left out. The frames given to add_plane are read later in the threads, so they
+    must not be changed after. If more than max_pending planes wait, add_plane waits for the oldest.
+    """
+    def __init__(self, group: zarr.Group, factors: Sequence[int] = (2, 4, 8),
+                 method: Method = "mean", n_threads: int = 2, max_pending: int = 64):
+        factors = sorted(factors)
+        for previous, factor in zip([1, *factors], factors):
+            if factor <= previous or factor % previous:
+                raise ValueError(f"Pyramid factors have to be multiples of each other, "
+                                 f"got {factors}")
+        if method not in ("mean", "stride"):
+            raise ValueError(f"Unknown downsampling method {method!r}")
+        self.group = group
+        self.factors = factors
+        self.method = method
+        self.max_pending = max_pending
+        # array path -> [(factor, level array)]
+        self.levels: dict[str, list[tuple[int, zarr.Array]]] = {}
+        self._pool = ThreadPoolExecutor(n_threads, thread_name_prefix="zarr_pyramid")
+        self._futures: deque[Future] = deque()
+
+    def add_array(self, ary: zarr.Array) -> list[tuple[int, zarr.Array]]:
+        """Make the level arrays for ary and add them to the multiscales metadata."""
+        levels = []
+        for factor in self.factors:
+            shape = (*ary.shape[:-2], ary.shape[-2] // factor, ary.shape[-1] // factor)
+            if 0 in shape[-2:]:
+                break
+            # Single plane chunks, so the threads never write to the same chunk
+            level = self.group.create(
+                level_path(ary.path, factor),
+                shape=shape,
+                chunks=(1,) * len(shape[:-2]) + shape[-2:],
+                dtype=ary.dtype,
+                compressor=ary.compressor,
+                fill_value=ary.fill_value,
+                dimension_separator=getattr(ary, "_dimension_separator", "/"),
+                overwrite=True,
+            )
+            if "_ARRAY_DIMENSIONS" in ary.attrs:
+                level.attrs["_ARRAY_DIMENSIONS"] = ary.attrs["_ARRAY_DIMENSIONS"]
+            levels.append((factor, level))
+        self.levels[ary.path] = levels
+
+        scales = self.group.attrs.get("multiscales", [])
+        for item in scales:
+            datasets = item["datasets"]
+            if datasets and datasets[0]["path"] == ary.path:
+                n_dims = len(ary.shape)
+                item["datasets"] = datasets[:1] + [
+                    {"coordinateTransformations": [
+                        {"scale": [1] * (n_dims - 2) + [factor, factor], "type": "scale"}],
+                     "path": level.path}
+                    for factor, level in levels]
+        self.group.attrs["multiscales"] = scales
+        return levels
+
+    def add_plane(self, ary: zarr.Array, index: tuple[int, ...], frame: np.ndarray) -> None:
+        """Downsample frame, the plane of ary at index, into the levels in the background."""
+        levels = self.levels.get(ary.path)
+        if not levels:
+            return
+        while len(self._futures) >= self.max_pending:
+            self._wait_oldest()
+        self._futures.append(self._pool.submit(self._write, levels, index, frame))
+
+    def _write(self, levels: list[tuple[int, zarr.Array]], index: tuple[int, ...],
+               frame: np.ndarray) -> None:
+        plane, previous = frame, 1
+        for factor, level in levels:
+            plane = downsample(plane, factor // previous, self.method)
+            previous = factor
+            level[index] = plane
+
+    def wait(self) -> None:
+        """Wait until all planes are written to the levels."""
+        while self._futures:
+            self._wait_oldest()
+
+    def close(self) -> None:
+        self.wait()
+        self._pool.shutdown()
+
+    def _wait_oldest(self) -> None:
+        future = self._futures.popleft()
+        try:
+            future.result()
+        except Exception:
+            logger.exception("Could not write pyramid level")
+
+
+def build_pyramid(store, factors: Sequence[int] = (2, 4, 8), method: Method = "mean",
+                  n_threads: int = 4) -> dict[str, list[str]]:
+    """Add the levels to all position arrays of an existing OME-Zarr store.
+
+    Levels that are already there are made again. Returns the level paths per position array.
+    """
+    import zarr
+
+    group = zarr.open_group(store, mode="r+")
+    builder = PyramidBuilder(group, factors, method, n_threads)
+    paths = [item["datasets"][0]["path"] for item in group.attrs.get("multiscales", [])
+             if item.get("datasets")]
+    try:
+        for path in paths:
+            ary = group[path]
+            builder.add_array(ary)
+            for index in np.ndindex(ary.shape[:-2]):
+                builder.add_plane(ary, index, ary[index])
+            logger.info(f"Pyramid of {path} done")
+    finally:
+        builder.close()
+    return {path: [level.path for _, level in builder.levels[path]] for path in paths}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Add pyramid levels to an OME-Zarr store")
+    parser.add_argument("store")
+    parser.add_argument("--factors", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--method", choices=["mean", "stride"], default="mean")
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for path, levels in build_pyramid(args.store, args.factors, args.method,
+                                      args.threads).items():
+        print(path, "->", ", ".join(levels))
@@ -2,9 +2,13 @@ from __future__ import annotations
 
 import atexit
 import json
+import logging
 import os.path
 import shutil
 import tempfile
+from collections import deque
+from concurrent.futures import Future
+from threading import Lock
 from typing import TYPE_CHECKING, Any, Literal, MutableMapping, Protocol
 
 from ._5d_writer_base import _5DWriterBase
@@ -14,10 +18,13 @@ if TYPE_CHECKING:
     from typing import ContextManager, Sequence, TypedDict
 
     import numpy as np
+    import useq
     import zarr
     from fsspec import FSMap
     from numcodecs.abc import Codec
 
+    from .zarr_pyramid import PyramidBuilder
+
     class ZarrSynchronizer(Protocol):
         def __getitem__(self, key: str) -> ContextManager: ...
 
@@ -37,6 +44,8 @@ if TYPE_CHECKING:
 
 POS_PREFIX = "p"
 
+logger = logging.getLogger(__name__)
+
 
 class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
     """MDA handler that writes to a zarr file following the ome-ngff spec.
@@ -47,9 +56,9 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
     It also aims to be compatible with the xarray Zarr spec:
     https://docs.xarray.dev/en/latest/internals/zarr-encoding-spec.html
 
-    Note: this does *not* currently calculate any additional pyramid levels.
-    But it would be easy to do so after acquisition.
-    Chunk size is currently 1 XY plane.
+    With `pyramid`, e.g. `(2, 4, 8)`, every plane is also downsampled into pyramid
+    levels, see zarr_pyramid. Stores without them can get them with build_pyramid.
+    Chunk size is 1 XY plane, see ChunkedOMEZarrWriter for larger, compressed chunks.
 
     Zarr directory structure will be:
 
@@ -96,6 +105,11 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
         If True, zattrs metadata will be read from disk, minified, and written
         back to disk at the end of a successful acquisition (to save space). Default is
         False.
+    pyramid : Sequence[int], optional
+        Downsampling factors of the pyramid levels written during the acquisition, e.g.
+        `(2, 4, 8)`. Default is no levels.
+    pyramid_method : "mean" | "stride", optional
+        How the levels are downsampled. Default is "mean".
     """
 
     def __init__(
@@ -107,6 +121,8 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
         zarr_version: Literal[2, 3, None] = None,
         array_kwargs: ArrayCreationKwargs | None = None,
         minify_attrs_metadata: bool = False,
+        pyramid: Sequence[int] = (),
+        pyramid_method: Literal["mean", "stride"] = "mean",
     ) -> None:
         try:
             import zarr
@@ -139,6 +155,12 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
         self._array_kwargs.setdefault("dimension_separator", "/")
         self._minify_metadata = minify_attrs_metadata
 
+        self._pyramid: PyramidBuilder | None = None
+        if pyramid:
+            from .zarr_pyramid import PyramidBuilder
+
+            self._pyramid = PyramidBuilder(self._group, pyramid, pyramid_method)
+
     @classmethod
     def in_tmpdir(
         cls,
@@ -191,6 +213,8 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
             if key in self.position_arrays:
                 self.position_arrays[key].attrs["frame_meta"] = metas
 
+        if self._pyramid is not None:
+            self._pyramid.wait()
         if self._minify_metadata:
             self._minify_zattrs_metadata()
 
@@ -200,7 +224,7 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
         ary: zarr.Array = self._group.create(
             key,
             shape=shape,
-            chunks=(1,) * len(shape[:-2]) + shape[-2:],  # single XY plane chunks
+            chunks=self.chunk_shape(dims, shape),
             dtype=dtype,
             **self._array_kwargs,
         )
@@ -210,15 +234,38 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
         scales.append(self._multiscales_item(ary.path, ary.path, dims))
         self._group.attrs["multiscales"] = scales
         ary.attrs["_ARRAY_DIMENSIONS"] = dims
+        if self._pyramid is not None:
+            self._pyramid.add_array(ary)
         if seq := self.current_sequence:
             ary.attrs["useq_MDASequence"] = json.loads(seq.json(exclude_unset=True))
         return ary
 
-    # # the superclass implementation is all we need
-    # def write_frame(
-    #     self, ary: zarr.Array, frame: np.ndarray, event: useq.MDAEvent
-    # ) -> None:
-    #     super().write_frame(ary, frame, event)
+    def chunk_shape(self, dims: Sequence[str], shape: Sequence[int]) -> tuple[int, ...]:
+        """Chunks of the array for a position, single XY planes."""
+        return (1,) * len(shape[:-2]) + tuple(shape[-2:])
+
+    def write_frame(
+        self, ary: zarr.Array, index: tuple[int, ...], frame: np.ndarray
+    ) -> None:
+        super().write_frame(ary, index, frame)
+        if self._pyramid is not None:
+            self._pyramid.add_plane(ary, index, frame)
+
+    def read_frame(self, ary: zarr.Array, index: tuple[int, ...]) -> np.ndarray:
+        """The frame at `index` of `ary`, for viewers that show every frame as it comes."""
+        return ary[index]
+
+    def close(self) -> None:
+        """Wait for the pyramid levels and stop their threads."""
+        if self._pyramid is not None:
+            self._pyramid.close()
+
+    def level(self, key: str, level: int) -> zarr.Array:
+        """Array of pyramid level `level` of position `key`, 0 is the full resolution."""
+        if level == 0 or self._pyramid is None:
+            return self.position_arrays[key]
+        levels = self._pyramid.levels[self.position_arrays[key].path]
+        return levels[min(level, len(levels)) - 1][1]
 
     def _multiscales_item(self, path: str, name: str, axes: Sequence[str]) -> dict:
         """ome-zarr multiscales image metadata.
@@ -251,6 +298,156 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
                 store[key] = json.dumps(data, separators=(",", ":")).encode("ascii")
 
 
+def default_compressor() -> Codec:
+    """zstd in blosc, with bit shuffle, which works best on the low bits of uint16 camera data."""
+    from numcodecs import Blosc
+
+    return Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
+
+
+class ChunkedOMEZarrWriter(OMEZarrWriter):
+    """OMEZarrWriter for fast acquisitions, with larger chunks compressed in a thread pool.
+
+    `chunks` maps dimensions to chunk sizes, e.g. `{"z": 8, "y": 512, "x": 512}`. Other
+    dimensions are chunked by 1, y and x by the full frame. Frames are collected in memory
+    until all planes of a block of chunks are there. Then the chunks of the block are
+    compressed and written by `n_threads` threads, so chunks are only ever written whole
+    and never read back to be updated. If more than `max_pending` chunk writes are
+    waiting, frameReady waits for the oldest.
+
+    A frame can only be read from the store once its chunk is written, `read_frame` gets
+    it from the buffer of its block until then. sequenceFinished and close write the
+    blocks that are not full and wait for all writes. Blocks are only written once, so
+    nothing is written before that, a block that is written early would be overwritten
+    by the rest of its planes.
+    """
+
+    DEFAULT_CHUNKS = {"z": 8, "y": 512, "x": 512}
+
+    def __init__(
+        self,
+        store: MutableMapping | str | os.PathLike | FSMap | None = None,
+        *,
+        chunks: dict[str, int] | None = None,
+        compressor: Codec | None = None,
+        n_threads: int = 4,
+        max_pending: int = 256,
+        **kwargs: Any,
+    ) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        array_kwargs = kwargs.pop("array_kwargs", None) or {}
+        array_kwargs.setdefault("compressor", compressor or default_compressor())
+        # Chunks are written whole, empty ones don't have to be skipped
+        array_kwargs.setdefault("write_empty_chunks", True)
+        super().__init__(store, array_kwargs=array_kwargs, **kwargs)
+        self.chunks = self.DEFAULT_CHUNKS if chunks is None else chunks
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(n_threads, thread_name_prefix="zarr_chunks")
+        self._futures: deque[Future] = deque()
+        # (array path, block index) -> [array, buffer, start of the block, planes in it]
+        self._blocks: dict[tuple[str, tuple[int, ...]], list] = {}
+        # Blocks that are being written, the last item counts the chunks left to write
+        self._writing: dict[tuple[str, tuple[int, ...]], list] = {}
+        self._lock = Lock()
+
+    def chunk_shape(self, dims: Sequence[str], shape: Sequence[int]) -> tuple[int, ...]:
+        default = {"y": shape[-2], "x": shape[-1]}
+        return tuple(
+            max(1, min(self.chunks.get(dim, default.get(dim, 1)), size))
+            for dim, size in zip(dims, shape)
+        )
+
+    def write_frame(
+        self, ary: zarr.Array, index: tuple[int, ...], frame: np.ndarray
+    ) -> None:
+        import numpy as np
+
+        if self._pyramid is not None:
+            self._pyramid.add_plane(ary, index, frame)
+        chunks = ary.chunks[:-2]
+        block = tuple(i // c for i, c in zip(index, chunks))
+        key = (ary.path, block)
+        if key not in self._blocks:
+            start = tuple(b * c for b, c in zip(block, chunks))
+            size = tuple(
+                min(c, n - s) for s, c, n in zip(start, chunks, ary.shape[:-2])
+            )
+            buffer = np.full(
+                (*size, *ary.shape[-2:]), ary.fill_value or 0, dtype=ary.dtype
+            )
+            self._blocks[key] = [ary, buffer, start, 0]
+        pending = self._blocks[key]
+        buffer, start = pending[1], pending[2]
+        buffer[tuple(i - s for i, s in zip(index, start))] = frame
+        pending[3] += 1
+        if pending[3] >= np.prod(buffer.shape[:-2]):
+            self._submit(key)
+
+    def read_frame(self, ary: zarr.Array, index: tuple[int, ...]) -> np.ndarray:
+        """The frame at `index`, from the buffer of its block if that is not written yet."""
+        block = tuple(i // c for i, c in zip(index, ary.chunks[:-2]))
+        with self._lock:
+            pending = self._blocks.get((ary.path, block)) or self._writing.get(
+                (ary.path, block)
+            )
+            if pending is not None:
+                buffer, start = pending[1], pending[2]
+                return buffer[tuple(i - s for i, s in zip(index, start))].copy()
+        return ary[index]
+
+    def sequenceFinished(self, seq: useq.MDASequence) -> None:
+        self._write_all()
+        super().sequenceFinished(seq)
+
+    def close(self) -> None:
+        self._write_all()
+        self._pool.shutdown()
+        super().close()
+
+    def _write_all(self) -> None:
+        """Write all blocks, also the ones that are not full, and wait for the writes."""
+        for key in list(self._blocks):
+            self._submit(key)
+        while self._futures:
+            self._wait_oldest()
+
+    def _submit(self, key: tuple[str, tuple[int, ...]]) -> None:
+        ary, buffer, start, _ = self._blocks[key]
+        block = tuple(slice(s, s + n) for s, n in zip(start, buffer.shape[:-2]))
+        tile_y, tile_x = ary.chunks[-2:]
+        tiles = [
+            (slice(y, y + tile_y), slice(x, x + tile_x))
+            for y in range(0, buffer.shape[-2], tile_y)
+            for x in range(0, buffer.shape[-1], tile_x)
+        ]
+        with self._lock:
+            self._writing[key] = [ary, buffer, start, len(tiles)]
+            del self._blocks[key]
+        for tile in tiles:
+            while len(self._futures) >= self.max_pending:
+                self._wait_oldest()
+            future = self._pool.submit(
+                ary.__setitem__, (*block, *tile), buffer[(..., *tile)]
+            )
+            future.add_done_callback(lambda _, key=key: self._written(key))
+            self._futures.append(future)
+
+    def _written(self, key: tuple[str, tuple[int, ...]]) -> None:
+        with self._lock:
+            writing = self._writing[key]
+            writing[3] -= 1
+            if not writing[3]:
+                del self._writing[key]
+
+    def _wait_oldest(self) -> None:
+        future = self._futures.popleft()
+        try:
+            future.result()
+        except Exception:
+            logger.exception("Could not write zarr chunk")
+
+
 # https://ngff.openmicroscopy.org/0.4/index.html#axes-md
 AXTYPE = {
     "x": "space",
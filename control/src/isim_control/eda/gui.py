@@ -75,10 +75,18 @@ def main():
     CHANNELS = ("488", "LED")
     # Viewer
     from pymmcore_eda._eda_sequence import EDASequence
-    from isim_control.eda._stack_viewer._datastore import QOMEZarrDatastore
+    from isim_control.eda._stack_viewer._datastore import (QOMEZarrDatastore,
+                                                           ChunkedQOMEZarrDatastore)
     from isim_control.eda._stack_viewer import StackViewer
     eda_sequence = EDASequence(channels=CHANNELS)
-    datastore = QOMEZarrDatastore(None, overwrite=True)
+    # Pyramid levels for the overview are opt-in, e.g. "eda_pyramid": [2, 4] in the settings
+    # Larger compressed chunks, e.g. "zarr_chunks": {"z": 8}, see ChunkedOMEZarrWriter
+    if chunks := settings.get('zarr_chunks'):
+        datastore = ChunkedQOMEZarrDatastore(None, overwrite=True, chunks=chunks,
+                                             pyramid=settings.get('eda_pyramid', ()))
+    else:
+        datastore = QOMEZarrDatastore(None, overwrite=True,
+                                      pyramid=settings.get('eda_pyramid', ()))
     datastore._mm_config = mmc.getSystemState().dict()
     mmc.mda.events.frameReady.connect(datastore.frameReady)
     viewer = StackViewer(datastore=datastore, mmcore=mmc,
@@ -112,6 +120,7 @@ def main():
     app.exec_()
     base_actuator.thread.join()
     b_actuator.thread.join()
+    datastore.close()
     # broker.stop()
     # viewer.shutdown()
 
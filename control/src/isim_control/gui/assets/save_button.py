@@ -5,9 +5,9 @@ from qtpy.QtWidgets import  QWidget, QFileDialog
 from qtpy.QtGui import QCloseEvent
 from pymmcore_plus import CMMCorePlus
 from useq import  MDASequence
-import zarr
 
 from isim_control.io.ome_tiff_writer import OMETiffWriter
+from isim_control.startup import lazy_import
 from isim_control.io.datastore import QOMEZarrDatastore
 
 
@@ -17,7 +17,7 @@ from qtpy.QtWidgets import QFileDialog, QPushButton, QWidget
 from superqt import fonticon
 from fonticon_mdi6 import MDI6
 
-
+zarr = lazy_import("zarr")
 
 
 class CoreSaveButton(QPushButton):
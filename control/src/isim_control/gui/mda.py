@@ -116,6 +116,8 @@ class RunButtons(QWidget):
         self.run_btn = QPushButton("Run")
         self.run_btn.clicked.connect(self._on_run_clicked)
         self.run_btn.setIcon(fonticon.icon(MDI6.play_circle_outline, color="lime"))
+        # Until the output processes are ready
+        self.run_btn.setDisabled(True)
         self.pause_btn = QPushButton("Pause")
         self.pause_btn.clicked.connect(self._on_pause_clicked)
         self.pause_btn.setIcon(fonticon.icon(MDI6.pause_circle_outline, color="green"))
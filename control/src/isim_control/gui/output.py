@@ -4,10 +4,11 @@ from pymmcore_plus import CMMCorePlus
 from isim_control.settings import iSIMSettings
 from isim_control.settings_translate import useq_from_settings, load_settings
 from isim_control.pubsub import Subscriber, Broker, Publisher
-from isim_control.mp_pubsub import Relay, tiff_writer_process, viewer_process
+from isim_control.mp_pubsub import WorkerPool, tiff_writer_process, viewer_process
 
 # from isim_control.gui.save_button import SaveButton
 from isim_control.io.buffered_datastore import BufferedDataStore
+from isim_control.settings_store import SettingsStore, SystemStateCache
 from qtpy.QtWidgets import QWidget
 import time
 
@@ -43,66 +44,106 @@ class OutputGUI(QWidget):
         self.broker.attach(self)
         self.pub = publisher
 
-        self.writer_relay = Relay(self.mmc)
-        self.viewer_relay = Relay(self.mmc)
         self.buffered_datastore = BufferedDataStore(mmcore=self.mmc, create=True,
-                                                    publishers=[self.writer_relay.pub,
-                                                                self.viewer_relay.pub],
                                                     live_frames=True)
 
         self.settings = settings
 
         self.last_live_stop = time.perf_counter()
+        self.acquiring = False
+        self.last_dropped = {}
         self.mm_config = None
         self.viewer = None
-        self.system_state = self.mmc.getSystemState().dict()
-        self.start_processes()
+        self.writer = None
+        # The other processes read settings and system state from the store, they only get its
+        # version. The system state follows the property changes of the core.
+        self.system_state = SystemStateCache(self.mmc)
+        self.store = SettingsStore(create=True)
+        self.store.update(settings=self.settings, system_state=self.system_state.snapshot())
+        self.system_state.pop_changed()
+        # The processes are started before they are needed, so an acquisition does not wait for
+        # them. The writer gets all frames in batches and is reused, the viewer only the newest
+        # frame. Every acquisition keeps its viewer window, so there is a new one from a spare.
+        self.writer_pool = WorkerPool(tiff_writer_process,
+                                      (self.buffered_datastore.name, self.store.name),
+                                      self.mmc, size=2, name="writer", batch="all", window=0.1)
+        self.viewer_pool = WorkerPool(viewer_process,
+                                      (self.buffered_datastore.name, self.store.name),
+                                      self.mmc, reuse=False, name="viewer", batch="latest")
+        self.pub.publish("gui", "output_ready", [])
 
     def _on_settings_change(self, keys, value):
         self.settings.set_by_path(keys, value)
-        self.viewer_relay.pub.publish("gui", "settings_change", [self.settings])
-        # This can take ~1s, so do it here instead of when the sequence starts
-        if not 'live' in keys:
-            print("Update system state in output")
-            self.system_state = self.mmc.getSystemState().dict()
+        version = self.store.update(settings=self.settings)
+        viewers = self.viewer_pool.workers + ([self.viewer] if self.viewer else [])
+        for worker in viewers:
+            worker["relay"].pub.publish("gui", "settings_version", [version, [keys]])
+
+    def update_store(self) -> int:
+        """Version of the store with the system state as it is now."""
+        if not self.system_state.pop_changed():
+            return self.store.version
+        return self.store.update(system_state=self.system_state.snapshot())
 
     def _on_acquisition_end(self):
-        self.close_remote_brokers()
-        self.start_processes()
-
-    def start_processes(self):
-        self.writer_process = multiprocessing.Process(target=tiff_writer_process,
-                                                 args=([self.writer_relay.pub_queue,
-                                                        self.settings,
-                                                        self.system_state,
-                                                        self.writer_relay.in_conn,
-                                                        self.buffered_datastore._shm.name]),
-                                                 name="writer")
-        self.writer_process.start()
-
-        self.viewer_process = multiprocessing.Process(target=viewer_process,
-                                                 args=([self.viewer_relay.pub_queue,
-                                                        self.viewer_relay.in_conn,
-                                                        self.viewer_relay.out_conn,
-                                                        self.buffered_datastore._shm.name]),
-                                                 name="viewer")
-        self.viewer_process.start()
-        self.viewer_id = self.viewer_relay.in_conn.recv()
+        self.acquiring = False
+        self.system_state.hold(False)
+        if self.viewer:
+            self.buffered_datastore.remove_publisher(self.viewer["relay"].pub, forget=True)
+            self.viewer_pool.release(self.viewer)
+            self.viewer = None
+        if self.writer:
+            # The writer keeps its column, it might still hold frames it has to write
+            self.buffered_datastore.remove_publisher(self.writer["relay"].pub)
+            self.writer_pool.release(self.writer)
+            self.writer = None
+        # The next viewer and writer are already waiting
         self.pub.publish("gui", "output_ready", [])
 
     def make_viewer(self, settings:dict = None):
+        # Before the runner gets to the devices, the sweep would compete with it for the core
+        self.system_state.hold()
         self.size = (self.mmc.getImageHeight(), self.mmc.getImageWidth())
-        self.viewer_relay.pub.publish("gui", "acquisition_start", [useq_from_settings(self.settings),
-                                                                   self.system_state,
-                                                                   self.settings])
-        self.activate_remotes()
+        self.viewer = self.viewer_pool.acquire()
+        self.viewer_id = self.viewer["info"]
+        self.buffered_datastore.add_publisher(self.viewer["relay"].pub)
+        version = self.update_store()
+        self.viewer["relay"].pub.publish("gui", "acquisition_start",
+                                         [useq_from_settings(self.settings), version])
         if self.settings['save']:
-            self.writer_relay.pub.publish("datastore", "reset", [self.settings, self.system_state])
-        else:
-            self.writer_relay.pub.publish("stop", "stop", [])
+            self.writer = self.writer_pool.acquire()
+            writer_pub = self.writer["relay"].pub
+            # The writer gets its frames pinned, so they are not overwritten before they are
+            # saved. Drop what it might not have released in the last acquisition first.
+            self.buffered_datastore.release_all(self.buffered_datastore.column(writer_pub))
+            self.buffered_datastore.add_publisher(writer_pub,
+                                                  self.settings.get('writer_policy', 'block'))
+            writer_pub.publish("datastore", "reset", [version])
+        self.acquiring = True
+        self.last_dropped = {}
+        Timer(1, self.check_backpressure).start()
         # The viewer process does not have the right to set a window to the foreground
         Timer(0.5, lambda: ctypes.windll.user32.SetForegroundWindow(self.viewer_id)).start()
 
+    def check_backpressure(self):
+        """Publish the datastore counters and warn before a consumer loses frames."""
+        if not self.acquiring:
+            return
+        stats = self.buffered_datastore.stats()
+        n_slots = stats["_pool"]["slots"]
+        for name, consumer in stats.items():
+            if name == "_pool":
+                continue
+            if consumer["policy"] != "drop" and consumer["held_slots"] > 0.75*n_slots:
+                logging.warning(f"{name} holds {consumer['held_slots']}/{n_slots} frame slots, "
+                                f"{consumer['policy']} is close")
+            if consumer["lost"] > self.last_dropped.get(name, 0):
+                logging.warning(f"{name} lost {consumer['lost']} frames, "
+                                f"{consumer['lag_frames']} frames behind")
+            self.last_dropped[name] = consumer["lost"]
+        self.pub.publish("gui", "output_stats", [stats])
+        Timer(1, self.check_backpressure).start()
+
     def get_shape(self, settings:dict):
         sequence = useq_from_settings(settings)
         sizes = sequence.sizes
@@ -111,25 +152,13 @@ class OutputGUI(QWidget):
         return shape
 
     def _on_live_toggle(self, toggled):
+        if not self.acquiring:
+            self.system_state.hold(toggled)
         if not toggled:
             self.last_live_stop = time.perf_counter()
 
-    def close_remote_brokers(self):
-        self.writer_relay.pub.publish("stop", "stop", [])
-        self.viewer_relay.pub.publish("stop", "stop", [])
-
-    def activate_remotes(self):
-        self.writer_relay.out_conn.send(True)
-        self.viewer_relay.out_conn.send(True)
-
     def shutdown(self):
-        self.writer_relay.pub.publish("stop", "stop", [])
-        self.viewer_relay.pub.publish("gui", "shutdown", [])
-        self.viewer_relay.pub.publish("stop", "stop", [])
-
-        self.writer_relay.out_conn.send(False)
-        self.viewer_relay.out_conn.send(False)
-        self.writer_process.join()
-        logging.debug("Writer process closed")
-        self.viewer_process.join()
-        logging.debug("Viewer process closed")
\ No newline at end of file
+        self.writer_pool.shutdown()
+        self.viewer_pool.shutdown()
+        self.system_state.stop()
+        self.store.close()
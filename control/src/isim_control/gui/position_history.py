@@ -8,12 +8,14 @@ from threading import Timer
 
 from isim_control.pubsub import Broker, Subscriber
 from isim_control.io.remote_datastore import RemoteDatastore
+from isim_control.io.frame_pool import FrameOverwritten
 from isim_control.io.keyboard import KeyboardListener
 from qtpy.QtWidgets import QApplication
 
 import multiprocessing as mp
 from isim_control.mp_pubsub import Relay
 from isim_control.io.buffered_datastore import BufferedDataStore
+from isim_control.startup import mark, report
 
 def position_history_process(event_queue, control_queue, pipe, name: str):
     app = QApplication([])
@@ -22,13 +24,15 @@ def position_history_process(event_queue, control_queue, pipe, name: str):
     history = PositionHistory(datastore=remote_datastore)
     history.sub = Subscriber(["datastore", "sequence", "gui"],
                              {"new_frame": [history.frame_ready_datastore],
-                              "new_live_frame": [history.frame_ready_datastore],
+                              "new_live_frame": [history.live_frame_ready_datastore],
                               "xy_stage_position_changed": [history.stage_moved_process],
                               "shutdown": [history.shutdown]})
     broker.attach(history)
     broker.start()
     key_listener=KeyboardListener(device="MicroDrive XY Stage", pub_queue=control_queue)
     app.installEventFilter(key_listener)
+    mark("ready")
+    report()
     pipe.send(True)
     history.show()
     app.exec_()
@@ -135,9 +139,15 @@ class PositionHistory(QtWidgets.QGraphicsView):
     def frame_ready(self, frame, event, metadata):
         self.increase_values_signal.emit(frame, event, metadata)
 
-    def frame_ready_datastore(self, event, shape, idx, meta):
-        frame = self.datastore.get_frame(idx, shape[0], shape[1])
-        self.increase_values_signal.emit(frame, MDAEvent(**event), meta)
+    def frame_ready_datastore(self, idx, shape, delta, kind="new_frame"):
+        try:
+            frame, event, meta = self.datastore.read(idx, shape, delta, kind, depth=self.sub.depth)
+        except FrameOverwritten:
+            return
+        self.increase_values_signal.emit(frame, event, meta)
+
+    def live_frame_ready_datastore(self, idx, shape, delta):
+        self.frame_ready_datastore(idx, shape, delta, "new_live_frame")
 
     def stage_moved_process(self, name, new_pos0, new_pos1):
         self.xy_stage_position.emit(name, new_pos0, new_pos1)
@@ -299,7 +309,7 @@ class PositionHistory(QtWidgets.QGraphicsView):
 
 def main_mp(mmcore:CMMCorePlus, datastore:RemoteDatastore):
     broker = Broker()
-    relay = Relay(mmcore=mmcore, subscriber=True)
+    relay = Relay(mmcore=mmcore, subscriber=True, batch="latest", name="history")
     process = mp.Process(target=position_history_process,
                         args=([relay.pub_queue,
                                broker.pub_queue,
@@ -1,4 +1,5 @@
-from isim_control.io.kpal import SharedBuffer as BufferedArray
+from isim_control.io.frame_pool import SharedFramePool, MAX_CONSUMERS
+from isim_control.io.frame_descriptor import DESCRIPTOR, pack, meta_delta
 # import copy
 # from typing import TYPE_CHECKING
 
@@ -8,63 +9,193 @@ from pymmcore_plus import CMMCorePlus
 
 from useq import MDAEvent
 # import copy
+import logging
 import time
 
+logger = logging.getLogger(__name__)
+
 CAPACITY = int(5E9)
+SLOT_SIZE = 2048*2048
+POLICIES = ("block", "drop", "spill")
 
-class BufferedDataStore(BufferedArray):
-    def __new__(self, *args, **kwargs):
-        print(kwargs)
-        self.mmc = kwargs.get("mmcore", None)
-        self.pubs = kwargs.get('publishers', None)
-        self.live_frames = kwargs.get("live_frames", None)
-        if self.live_frames:
-            del kwargs['live_frames']
-        if self.mmc:
-            del kwargs['mmcore']
-        if self.pubs:
-            del kwargs['publishers']
-        return super().__new__(BufferedDataStore, *args, capacity=CAPACITY, dtype=np.uint16,
-                                **kwargs)
-
-    def __init__(self, *args, **kwargs):
-        super().__init__()
+class BufferedDataStore(SharedFramePool):
+    """Frame pool that the core puts the frames into, the publishers tell the other processes.
+
+    Frames are published as [handle, shape, meta delta]. handle is (slot, seq, column) into the
+    pool, the event is packed into the DESCRIPTOR next to the frame. The metadata is a delta to the
+    last frame of the same kind (new_frame or new_live_frame), the first acquisition frame of every
+    sequence has the full metadata.
+
+    Every publisher gets a column in the consumer table of the pool, what happens if its process
+    falls behind is set with set_policy:
+    block  The frames are pinned, the acquisition waits for a free slot. The default for writers.
+    drop   The frames are not pinned, the consumer counts the ones that were overwritten as lost.
+    spill  The frames are pinned, but if all slots are held the oldest is saved to disk instead of
+           waiting, the consumer loads it from there.
+    stats has the live counters, how far every consumer is behind and what it lost.
+    """
+    def __init__(self, name: str|None = None, create: bool = False,
+                 mmcore: CMMCorePlus|None = None, publishers: list|None = None,
+                 live_frames: bool = False, capacity: int = CAPACITY, slot_size: int|None = None):
+        self.mmc = mmcore
+        self.pubs = publishers or []
+        self.live_frames = live_frames
+        if slot_size is None:
+            slot_size = SLOT_SIZE
+            if self.mmc:
+                slot_size = max(slot_size, self.mmc.getImageWidth()*self.mmc.getImageHeight())
+        super().__init__(name=name, create=create, capacity=capacity, slot_size=slot_size,
+                         dtype=np.uint16)
+        # Consumer column and policy of the publishers, and the counters at sequence start
+        self.columns = {}
+        self.policies = {}
+        self.sent = {}
+        self.baseline = {}
+        self.frame_bytes = 0
+        self.last_put_time = 0.
+        self.descriptor = np.zeros((), DESCRIPTOR)
+        # Metadata the deltas are relative to, per kind of frame. None sends the full metadata.
+        self.last_meta = {"new_frame": None, "new_live_frame": None}
         if self.mmc:
+            self.mmc.mda.events.sequenceStarted.connect(self.sequence_started)
             self.mmc.mda.events.frameReady.connect(self.new_frame)
             if self.live_frames:
                 self.mmc.events.liveFrameReady.connect(self.new_live_frame)
 
+    def column(self, pub) -> int:
+        if pub not in self.columns:
+            free = set(range(MAX_CONSUMERS)) - set(self.columns.values())
+            if not free:
+                raise ValueError(f"No more than {MAX_CONSUMERS} consumers per datastore")
+            column = min(free)
+            self.columns[pub] = column
+            self.sent[column] = 0
+            self.baseline[column] = self._counters(pub, column)
+        return self.columns[pub]
+
+    def set_policy(self, pub, policy: str = "drop"):
+        """What happens to the acquisition frames if the consumer behind pub falls behind."""
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, use one of {POLICIES}")
+        column = self.column(pub)
+        old_policy = self.policies.get(pub, "drop")
+        if old_policy != "drop" and policy == "drop":
+            # Also drops what a consumer of an earlier sequence did not release
+            self.release_all(column)
+        self.policies[pub] = policy
+        if policy == "spill":
+            self.spill_columns.add(column)
+        else:
+            self.spill_columns.discard(column)
+
+    def add_publisher(self, pub, policy: str = "drop"):
+        if pub not in self.pubs:
+            self.pubs.append(pub)
+        self.set_policy(pub, policy)
+
+    def remove_publisher(self, pub, forget: bool = False):
+        """Stop sending frames to pub. With forget, its column is freed for a new publisher.
+
+        A writer that is reused keeps its column, so it can still release what it holds.
+        """
+        if pub in self.pubs:
+            self.pubs.remove(pub)
+        if forget and pub in self.columns:
+            column = self.columns.pop(pub)
+            self.release_all(column)
+            self.spill_columns.discard(column)
+            self.policies.pop(pub, None)
+            del self.sent[column], self.baseline[column]
+
+    def _pinned_columns(self) -> tuple[int]:
+        return tuple(self.columns[pub] for pub in self.pubs
+                     if self.policies.get(pub, "drop") != "drop")
+
+    def _counters(self, pub, column: int) -> dict:
+        row = self.consumers[column]
+        return {"read": int(row["read"]), "lost": int(row["lost"]),
+                "unspilled": int(row["unspilled"]),
+                "coalesced": getattr(pub, "coalesced", {}).get("new_frame", 0)}
+
+    def stats(self) -> dict:
+        """Live counters per consumer for this sequence, keyed by the name of the publisher.
+
+        lag_frames and lag_bytes are how far the consumer is behind the producer, held_slots the
+        frames it pins. dropped is lost plus coalesced, the frames it will never get.
+        """
+        stats = {}
+        for pub, column in self.columns.items():
+            counters = self._counters(pub, column)
+            counters = {key: value - self.baseline[column][key] for key, value in counters.items()}
+            handled = counters["read"] + counters["lost"] + counters["coalesced"]
+            lag = max(self.sent[column] - handled, 0)
+            held, held_bytes = self.held_by(column)
+            try:
+                queue_depth = pub.pub_queue.qsize()
+            except (AttributeError, NotImplementedError):
+                queue_depth = None
+            stats[getattr(pub, "name", None) or f"consumer_{column}"] = {
+                "policy": self.policies.get(pub, "drop"), "sent": self.sent[column],
+                **counters, "dropped": counters["lost"] + counters["coalesced"],
+                "lag_frames": lag, "lag_bytes": lag*self.frame_bytes,
+                "held_slots": held, "held_bytes": held_bytes,
+                "queue_depth": queue_depth,
+                "consumer_queue_depth": int(self.consumers[column]["depth"])}
+        stats["_pool"] = {"slots": self.n_slots, "frames": self.frames, "spilled": self.spilled,
+                          "last_put_time": self.last_put_time}
+        return stats
+
+    def sequence_started(self, *_):
+        """A writer or viewer may not have seen the last sequence, start from the full metadata.
+
+        The counters of stats restart as well.
+        """
+        self.last_meta["new_frame"] = None
+        for pub, column in self.columns.items():
+            self.sent[column] = 0
+            self.baseline[column] = self._counters(pub, column)
+
     def new_live_frame(self, img: np.ndarray, event: MDAEvent, meta:dict):
-        idx, meta = self.put_and_prepare(img, meta)
+        (slot, seq), delta = self.put_and_prepare(img, event, meta, "new_live_frame")
         for pub in self.pubs:
-            pub.publish("datastore", "new_live_frame", [event.model_dump(), img.shape, idx, meta])
+            pub.publish("datastore", "new_live_frame", [(slot, seq, -1), img.shape, delta])
 
     def new_frame(self, img: np.ndarray, event: MDAEvent, meta:dict):
-        idx, meta = self.put_and_prepare(img, meta)
+        (slot, seq), delta = self.put_and_prepare(img, event, meta, "new_frame",
+                                                  pin=self._pinned_columns())
+        self.frame_bytes = img.nbytes
         for pub in self.pubs:
-            pub.publish("datastore", "new_frame", [event.model_dump(), img.shape, idx, meta])
+            column = self.column(pub)
+            self.sent[column] += 1
+            pub.publish("datastore", "new_frame", [(slot, seq, column), img.shape, delta])
 
-    def put_and_prepare(self, img: np.ndarray, meta:dict):
-        idx = self._write_idx
+    def put_and_prepare(self, img: np.ndarray, event: MDAEvent, meta:dict, kind: str,
+                        pin: tuple[int] = ()):
+        meta = dict(meta)
+        meta.pop('Event', None)
+        pack(event, meta, self.descriptor)
+        self.descriptor["put_time"] = time.time()
         t0 = time.perf_counter()
-        self.put(img)
-        if this_time:= time.perf_counter() - t0 > 0.1:
-            print("SLOW WRITE TO DATASTORE", this_time)
-        try:
-            del meta['Event']
-        except:
-            pass
-        return idx, meta
+        idx = self.put(img, pin, descriptor=self.descriptor)
+        self.last_put_time = time.perf_counter() - t0
+        if self.last_put_time > 0.1:
+            logger.warning(f"Slow write to datastore: {self.last_put_time:.3f} s")
+        delta = meta_delta(self.last_meta[kind], meta)
+        self.last_meta[kind] = meta
+        return idx, delta
 
 
 if __name__ == "__main__":
     from useq import MDASequence
+    from isim_control.io.remote_datastore import RemoteDatastore
     import time
     mmcore = CMMCorePlus()
     mmcore.loadSystemConfiguration()
     mmcore.setProperty("Camera", "OnCameraCCDXSize", 1024)
     mmcore.setProperty("Camera", "OnCameraCCDYSize", 1024)
-    database = BufferedDataStore(create=True)
+    database = BufferedDataStore(mmcore=mmcore, create=True)
     mmcore.run_mda(MDASequence(time_plan={"interval": 1, "loops": 3}))
     time.sleep(3)
-    print(database.get_frame([0, 0, 1]).shape)
\ No newline at end of file
+    remote = RemoteDatastore(database.name)
+    frame, event, meta = remote.read((0, 2, -1), (1024, 1024), {})
+    print(frame.shape, event)
@@ -0,0 +1,109 @@
+"""Fixed layout description of a frame, stored in the frame pool next to the frame.
+
+Instead of event.model_dump() and the full metadata dict with every frame, the producer packs the
+parts of the event that the consumers use into a numpy record in the slot header. The metadata is
+sent as a delta to the metadata of the last frame of the same kind, which is empty as long as
+nothing changes, apart from the per frame values that are in the record as well.
+"""
+from __future__ import annotations
+
+import numpy as np
+from useq import MDAEvent
+
+AXES = ("t", "p", "g", "c", "z")
+# Metadata that changes with every frame, these don't go into the deltas
+PER_FRAME = {"ElapsedTime-ms": "elapsed", "ImageNumber": "image_number", "Time": "time"}
+# In a delta that replaces the whole metadata instead of updating it
+RESET = "_reset"
+
+DESCRIPTOR = np.dtype([
+    ("index", "i4", (len(AXES),)),    # -1 for axes that are not in the event
+    ("position", "f8", (3,)),         # x, y, z, NaN if not set
+    ("exposure", "f8"),
+    ("channel", "S32"),
+    ("group", "S32"),
+    ("put_time", "f8"),               # time.time() when the frame was put into the pool
+    ("elapsed", "f8"),
+    ("image_number", "S16"),
+    ("time", "S32"),
+])
+
+
+def _nan(value) -> float:
+    return np.nan if value is None else value
+
+
+def pack(event: MDAEvent, meta: dict, out: np.ndarray):
+    """Fill the DESCRIPTOR record out from event and meta."""
+    out["index"] = [event.index.get(axis, -1) for axis in AXES]
+    out["position"] = (_nan(event.x_pos), _nan(event.y_pos), _nan(event.z_pos))
+    out["exposure"] = _nan(event.exposure)
+    if event.channel is not None:
+        out["channel"] = event.channel.config.encode()
+        out["group"] = event.channel.group.encode()
+    else:
+        out["channel"] = out["group"] = b""
+    out["elapsed"] = float(meta.get("ElapsedTime-ms", np.nan))
+    out["image_number"] = str(meta.get("ImageNumber", "")).encode()
+    out["time"] = str(meta.get("Time", "")).encode()
+
+
+def unpack(record: np.ndarray) -> MDAEvent:
+    """The MDAEvent of a DESCRIPTOR record, with only the fields that were packed."""
+    kwargs = {"index": {axis: int(value) for axis, value in zip(AXES, record["index"])
+                        if value >= 0}}
+    for key, value in zip(("x_pos", "y_pos", "z_pos"), record["position"]):
+        if not np.isnan(value):
+            kwargs[key] = float(value)
+    if not np.isnan(record["exposure"]):
+        kwargs["exposure"] = float(record["exposure"])
+    if record["channel"]:
+        kwargs["channel"] = {"config": record["channel"].decode(),
+                             "group": record["group"].decode()}
+    return MDAEvent(**kwargs)
+
+
+def per_frame_meta(record: np.ndarray) -> dict:
+    meta = {}
+    if not np.isnan(record["elapsed"]):
+        meta["ElapsedTime-ms"] = float(record["elapsed"])
+    for key in ("ImageNumber", "Time"):
+        value = record[PER_FRAME[key]].decode()
+        if value:
+            meta[key] = value
+    return meta
+
+
+def meta_delta(old: dict|None, new: dict) -> dict:
+    """Entries of new that are not the same in old. Keys that are gone are set to None.
+
+    If old is None, the delta has all of new and replaces what the consumer had.
+    """
+    if old is None:
+        delta = {key: value for key, value in new.items() if key not in PER_FRAME}
+        delta[RESET] = True
+        return delta
+    delta = {key: value for key, value in new.items()
+             if key not in PER_FRAME and (key not in old or old[key] != value)}
+    for key in old.keys() - new.keys() - PER_FRAME.keys():
+        delta[key] = None
+    return delta
+
+
+def apply_delta(meta: dict, delta: dict):
+    if delta.get(RESET):
+        meta.clear()
+    for key, value in delta.items():
+        if key == RESET:
+            continue
+        if value is None:
+            meta.pop(key, None)
+        else:
+            meta[key] = value
+
+
+def merge_frame_values(old: list, new: list) -> list:
+    """Coalesce two frame messages [handle, shape, delta] to the newer one, keeping both deltas."""
+    delta = {} if new[2].get(RESET) else dict(old[2])
+    delta.update(new[2])
+    return [new[0], new[1], delta]
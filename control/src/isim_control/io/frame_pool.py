@@ -0,0 +1,300 @@
+"""Shared memory pool of fixed size frame slots, to hand frames to other processes.
+
+The shared memory starts with a small info block (n_slots, slot_size, dtype) and a table with a
+row of counters for every consumer, then a header with one record per slot and then the slots
+themselves. The record of a slot has:
+
+seq       Sequence number of the frame in the slot. Frame k gets 2*(k + 1), while it is being
+          written the seq is odd. A reader compares the seq before and after copying to the seq
+          in its handle to detect a torn or overwritten read.
+shape     Shape of the frame in the slot.
+frame     DESCRIPTOR of the frame, see frame_descriptor.
+pinned    One column per consumer, the seq of the frame the producer pinned for that consumer.
+released  The seq the consumer released.
+dropped   The seq the producer let go of for the consumer, because it spilled the frame or the
+          consumer stopped. The consumer holds the slot while pinned is neither released nor dropped.
+
+Every field has only one process writing to it, so no lock is needed across processes: the
+consumers write their column of released and their row of the consumer table, the producer all
+the rest. The producer never reuses a slot that a consumer still holds, so a lossless consumer
+like the writer can fall behind without getting wrong frames. Lossy consumers like the viewer do
+not pin and just skip frames that were overwritten before they got to them, they count them as
+lost in their row of the consumer table. If all slots are held, the producer waits, unless the slots are held by
+consumers in spill_columns. Then it saves the oldest of these frames to spill_dir and drops the
+slot for them, the consumer loads the frame from there with unspill.
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import shutil
+import tempfile
+import time
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from isim_control.io.frame_descriptor import DESCRIPTOR
+
+logger = logging.getLogger(__name__)
+
+MAX_CONSUMERS = 8
+_INFO = np.dtype([("n_slots", "i8"), ("slot_size", "i8"), ("itemsize", "i8"), ("kind", "i8")])
+# Written by the consumers: seq of the last frame read, frames read, lost, and loaded from disk
+# and the length of their message queue
+_CONSUMER = np.dtype([("seen", "i8"), ("read", "i8"), ("lost", "i8"), ("unspilled", "i8"),
+                      ("depth", "i8")])
+_HEAD = _INFO.itemsize + MAX_CONSUMERS*_CONSUMER.itemsize
+_RECORD = np.dtype([("seq", "i8"), ("shape", "i8", (2,)), ("frame", DESCRIPTOR),
+                    ("pinned", "i8", (MAX_CONSUMERS,)), ("released", "i8", (MAX_CONSUMERS,)),
+                    ("dropped", "i8", (MAX_CONSUMERS,))])
+
+
+class FrameOverwritten(ValueError):
+    """The frame of a handle is not in its slot anymore, or was changed while it was read."""
+
+
+class SharedFramePool:
+    """Ring of frame slots in shared memory, see the module docstring for the layout.
+
+    The producer creates the pool with create=True and a capacity in bytes, consumers attach with
+    the name only. put returns the slot and seq of the frame, together with the consumer column
+    this is the handle (slot, seq, column) that is sent to the consumers. A column of -1 means the
+    frame is not pinned for that consumer.
+    """
+    def __init__(self, name: Optional[str] = None, create: bool = False, capacity: int = int(5E9),
+                 slot_size: int = 2048*2048, dtype: npt.DTypeLike = np.uint16):
+        self._writeable = create
+        if create:
+            dtype = np.dtype(dtype)
+            slot_bytes = slot_size*dtype.itemsize
+            n_slots = (int(capacity) - _HEAD)//(_RECORD.itemsize + slot_bytes)
+            if n_slots < 2:
+                raise ValueError(f"Capacity {capacity} is too small for two slots of "
+                                 f"{slot_bytes} bytes")
+            size = _HEAD + n_slots*(_RECORD.itemsize + slot_bytes)
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            info = np.ndarray((), _INFO, buffer=self._shm.buf)
+            info[()] = (n_slots, slot_size, dtype.itemsize, ord(dtype.char))
+        else:
+            self._shm = shared_memory.SharedMemory(name=name, create=False)
+            info = np.ndarray((), _INFO, buffer=self._shm.buf)
+            n_slots, slot_size = int(info["n_slots"]), int(info["slot_size"])
+            dtype = np.dtype(chr(int(info["kind"])))
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.dtype = dtype
+        self.consumers = np.ndarray((MAX_CONSUMERS,), _CONSUMER, buffer=self._shm.buf,
+                                    offset=_INFO.itemsize)
+        self.header = np.ndarray((n_slots,), _RECORD, buffer=self._shm.buf, offset=_HEAD)
+        self.slots = np.ndarray((n_slots, slot_size), dtype, buffer=self._shm.buf,
+                                offset=_HEAD + n_slots*_RECORD.itemsize)
+        if create:
+            self.consumers[...] = 0
+            self.header[...] = 0
+        else:
+            # Consumers only write their released column, see release
+            self.slots.flags.writeable = False
+        self._next_slot = 0
+        self.frames = 0
+        self.spill_columns = set()
+        self.spilled = 0
+        atexit.register(self.close)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def spill_dir(self) -> Path:
+        return Path(tempfile.gettempdir())/f"{self.name.strip('/')}_spill"
+
+    def close(self) -> None:
+        if self._writeable:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        # Drop the views before the shared memory, it can't be closed while they exist
+        self.consumers = None
+        self.header = None
+        self.slots = None
+        try:
+            self._shm.close()
+        except BufferError:
+            logger.debug("Frame pool %s still has views, not closed", self._shm.name)
+            return
+        if self._writeable:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                logger.debug("Frame pool %s was already unlinked", self._shm.name)
+
+    # -------------------- producer --------------------
+    def _holding(self, header: np.ndarray) -> np.ndarray:
+        pinned = header["pinned"]
+        return (pinned != header["released"]) & (pinned != header["dropped"])
+
+    def held(self, slot: int) -> bool:
+        return bool(np.any(self._holding(self.header[slot])))
+
+    def refcount(self, slot: int) -> int:
+        return int(np.count_nonzero(self._holding(self.header[slot])))
+
+    def held_by(self, column: int) -> tuple[int, int]:
+        """Number of slots and bytes that the consumer in column holds."""
+        held = self._holding(self.header)[:, column]
+        n_items = np.prod(self.header["shape"][held], axis=1).sum()
+        return int(np.count_nonzero(held)), int(n_items)*self.dtype.itemsize
+
+    def _spill_oldest(self) -> bool:
+        """Save the oldest frame that is only held by spill consumers to disk and free its slot."""
+        pinned, dropped = self.header["pinned"], self.header["dropped"]
+        holding = self._holding(self.header)
+        others = [column for column in range(MAX_CONSUMERS) if column not in self.spill_columns]
+        candidates = np.flatnonzero(holding.any(axis=1) & ~holding[:, others].any(axis=1))
+        if not candidates.size:
+            return False
+        slot = candidates[np.argmin(self.header["seq"][candidates])]
+        record = self.header[slot]
+        n_items = int(np.prod(record["shape"]))
+        self.spill_dir.mkdir(exist_ok=True)
+        np.savez(self.spill_dir/f"{record['seq']}.npz", frame=self.slots[slot, :n_items],
+                 descriptor=record["frame"], shape=record["shape"])
+        for column in self.spill_columns:
+            dropped[slot, column] = pinned[slot, column]
+        self.spilled += 1
+        return True
+
+    def _claim_slot(self, timeout: float|None = None) -> int:
+        """Next slot that no consumer holds, spills or waits if all of them are held."""
+        t0 = time.perf_counter()
+        warned = t0
+        while True:
+            for offset in range(self.n_slots):
+                slot = (self._next_slot + offset) % self.n_slots
+                if not self.held(slot):
+                    self._next_slot = (slot + 1) % self.n_slots
+                    return slot
+            if self.spill_columns and self._spill_oldest():
+                continue
+            now = time.perf_counter()
+            if timeout is not None and now - t0 > timeout:
+                raise TimeoutError(f"All {self.n_slots} frame slots are held by consumers")
+            if now - warned > 1:
+                logger.warning("All frame slots held by consumers, waiting since %.1f s",
+                               now - t0)
+                warned = now
+            time.sleep(0.001)
+
+    def put(self, data: npt.NDArray, pin: tuple[int] = (), timeout: float|None = None,
+            descriptor: np.ndarray|None = None) -> tuple[int, int]:
+        """Copy data and its descriptor into the next free slot, pin it for the columns in pin.
+
+        Returns slot and seq of the frame.
+        """
+        if data.size > self.slot_size:
+            raise ValueError(f"Frame of {data.size} items does not fit into slots of "
+                             f"{self.slot_size}")
+        if data.dtype != self.dtype:
+            raise ValueError("dtypes of frame and frame pool do not match")
+        slot = self._claim_slot(timeout)
+        self.frames += 1
+        seq = 2*self.frames
+        record = self.header[slot:slot + 1]
+        record["seq"] = seq - 1
+        self.slots[slot, :data.size] = np.ravel(data)
+        record["shape"] = data.shape[-2:] if data.ndim > 1 else (1, data.size)
+        if descriptor is not None:
+            record["frame"] = descriptor
+        for column in pin:
+            record["pinned"][0, column] = seq
+        record["seq"] = seq
+        return slot, seq
+
+    def release_all(self, column: int):
+        """Drop all pins of a consumer, for when it stopped without releasing its frames."""
+        self.header["dropped"][:, column] = self.header["pinned"][:, column]
+
+    # -------------------- consumer --------------------
+    def get(self, handle: tuple[int, int, int], shape: tuple[int, int]|None = None,
+            release: bool = True, copy: bool = True) -> np.ndarray:
+        """The frame of handle, raises FrameOverwritten if it's not there anymore.
+
+        With copy=False this is a read-only view into the slot, nothing is released then. It stays
+        valid only as long as the handle is pinned, release it when done with the view.
+        """
+        if not copy:
+            return self.view(handle, shape)
+        if not self.valid(handle):
+            self._overwritten(handle, release)
+        data = self.view(handle, shape).copy()
+        if not self.valid(handle):
+            self._overwritten(handle, release)
+        if release:
+            self.release(handle)
+        return data
+
+    def view(self, handle: tuple[int, int, int], shape: tuple[int, int]|None = None
+             ) -> np.ndarray:
+        slot, seq = handle[0], handle[1]
+        if shape is None:
+            shape = tuple(self.header["shape"][slot])
+        if not self.valid(handle):
+            self._overwritten(handle, False)
+        view = self.slots[slot, :int(np.prod(shape))].reshape(shape)
+        view.flags.writeable = False
+        return view
+
+    def descriptor(self, handle: tuple[int, int, int], release: bool = False) -> np.ndarray:
+        """Copy of the DESCRIPTOR record of the frame of handle."""
+        slot = handle[0]
+        record = self.header["frame"][slot].copy()
+        if not self.valid(handle):
+            self._overwritten(handle, release)
+        return record
+
+    def valid(self, handle: tuple[int, int, int]) -> bool:
+        """The frame of handle is still complete in its slot."""
+        return self.header["seq"][handle[0]] == handle[1]
+
+    def _overwritten(self, handle: tuple[int, int, int], release: bool):
+        if release:
+            self.release(handle)
+        raise FrameOverwritten(f"Frame {handle[1]//2} in slot {handle[0]} was overwritten")
+
+    def pinned(self, handle: tuple[int, int, int]) -> bool:
+        """The producer holds the frame of handle for its consumer, until it is released."""
+        slot, seq, column = handle
+        return (column >= 0 and self.header["pinned"][slot, column] == seq
+                and self.header["dropped"][slot, column] != seq)
+
+    def release(self, handle: tuple[int, int, int]):
+        slot, seq, column = handle
+        # Frames that were not pinned for the consumer have an older seq in pinned
+        if column >= 0 and self.header["pinned"][slot, column] == seq:
+            self.header["released"][slot, column] = seq
+
+    def unspill(self, handle: tuple[int, int, int]) -> tuple[np.ndarray, np.ndarray]|None:
+        """Frame and descriptor of a frame that the producer saved to disk, None if it didn't."""
+        path = self.spill_dir/f"{handle[1]}.npz"
+        if not path.exists():
+            return None
+        with np.load(path) as spilled:
+            frame = spilled["frame"].reshape(spilled["shape"])
+            descriptor = spilled["descriptor"][()]
+        path.unlink()
+        if handle[2] >= 0:
+            self.consumers["unspilled"][handle[2]] += 1
+        return frame, descriptor
+
+    def account(self, handle: tuple[int, int, int], lost: bool = False, depth: int|None = None):
+        """Count a frame as read or lost in the row of the consumer, see BufferedDataStore.stats."""
+        column = handle[2]
+        if column < 0:
+            return
+        row = self.consumers[column:column + 1]
+        row["seen"] = handle[1]
+        row["lost" if lost else "read"] += 1
+        if depth is not None:
+            row["depth"] = depth
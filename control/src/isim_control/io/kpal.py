@@ -117,10 +117,11 @@ class SharedBuffer(np.ndarray):
             next_write_idx = self._write_idx + data.size
 
         if current_write_idx < 0:
-            # Integer ranges won't work when wrapping around the end of the array, so use an array of
-            # indexes instead
-            indexes = list(range(current_write_idx, next_write_idx))
-            self[indexes] = np.ravel(data)
+            # Wrapping around the end of the array, copy the two parts as slices. A list of indexes
+            # for fancy indexing is a lot slower for a full frame.
+            flat = np.ravel(data)
+            self[current_write_idx:] = flat[:-current_write_idx]
+            self[:next_write_idx] = flat[-current_write_idx:]
         else:
             self[current_write_idx:next_write_idx] = np.ravel(data)
 
@@ -1,15 +1,84 @@
 """ File to first try to make out own metadata """
-import ome_types
+from __future__ import annotations
 from useq import MDAEvent, MDASequence, Channel
 import numpy as np
 from datetime import datetime
 import json
-from typing import List
+import re
+from typing import Iterator, List
 
-from ome_types.model import simple_types
+from isim_control.startup import lazy_import
 
+# ome_types takes seconds to import, only load it when the first metadata is made
+ome_types = lazy_import("ome_types")
 
-ome_model = ome_types.model
+
+# One row per plane, NaN for positions and exposures that the event didn't have
+PLANE = np.dtype([
+    ("the_c", "i4"), ("the_z", "i4"), ("the_t", "i4"), ("ifd", "i8"),
+    ("delta_t", "f8"), ("exposure", "f8"),
+    ("position_x", "f8"), ("position_y", "f8"), ("position_z", "f8"),
+])
+# Closing tag of Pixels, or the end of it if it has no channels, with the namespace prefix if any
+_PIXELS_END = re.compile(r"</((?:\w+:)?)Pixels>|<((?:\w+:)?)Pixels\b[^>]*?(/>)")
+
+
+class PlaneTable:
+    """Columns of the Plane and TiffData metadata, appending a plane is O(1) on average."""
+    def __init__(self, capacity: int = 1024):
+        self.data = np.zeros(capacity, PLANE)
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, **values):
+        if self.length == len(self.data):
+            self.data = np.resize(self.data, 2 * len(self.data))
+        row = self.data[self.length:self.length + 1]
+        for name in PLANE.names:
+            value = values.get(name)
+            row[name] = np.nan if value is None else value
+        self.length += 1
+
+    @classmethod
+    def from_columns(cls, **columns) -> PlaneTable:
+        """All planes at once from arrays of the PLANE fields, the missing ones are NaN or 0."""
+        length = len(next(iter(columns.values())))
+        table = cls(max(length, 1))
+        for name in PLANE.names:
+            table.data[name][:length] = columns.get(name, np.nan if PLANE[name].kind == "f" else 0)
+        table.length = length
+        return table
+
+    @property
+    def planes(self) -> np.ndarray:
+        return self.data[:self.length]
+
+    def iter_xml(self, prefix: str = "", batch: int = 4096) -> Iterator[str]:
+        """TiffData and then Plane elements, in strings of up to batch elements."""
+        planes = self.planes
+        for start in range(0, len(planes), batch):
+            rows = planes[start:start + batch]
+            yield "".join(
+                f'<{prefix}TiffData FirstC="{c}" FirstT="{t}" FirstZ="{z}" IFD="{ifd}" '
+                f'PlaneCount="1"/>'
+                for c, z, t, ifd in zip(*(rows[name].tolist()
+                                          for name in ("the_c", "the_z", "the_t", "ifd"))))
+        for start in range(0, len(planes), batch):
+            rows = planes[start:start + batch]
+            columns = [rows[name].tolist() for name in PLANE.names if name != "ifd"]
+            yield "".join(self._plane_xml(prefix, *row) for row in zip(*columns))
+
+    @staticmethod
+    def _plane_xml(prefix, c, z, t, delta_t, exposure, x, y, z_pos) -> str:
+        xml = f'<{prefix}Plane TheC="{c}" TheT="{t}" TheZ="{z}"'
+        for name, value, unit in (("DeltaT", delta_t, "ms"), ("ExposureTime", exposure, "ms"),
+                                  ("PositionX", x, "µm"), ("PositionY", y, "µm"),
+                                  ("PositionZ", z_pos, "µm")):
+            if value == value:  # not NaN
+                xml += f' {name}="{value}" {name}Unit="{unit}"'
+        return xml + "/>"
 
 
 class OME:
@@ -17,73 +86,87 @@ class OME:
 
     This class can be used to generate OME metadata during an acquisition using the EDA plugin. The
     writer implemented uses this and the methods to generate the metadata as the images come in.
+    Only the header (image, pixels, channels) is an ome_types model. The planes are kept as columns
+    in a PlaneTable and to_xml writes their elements into the XML of the header, there can be
+    100k of them in a long timelapse.
     """
-    def __init__(self, ome=ome_model.OME, seq: MDASequence|None = None):
+    def __init__(self, ome=None, seq: MDASequence|None = None):
         # TODO: Make this version to be taken over from the setup.py file
+        ome = ome or ome_types.model.OME
         self.ome = ome(creator="LEB, iSIM, V0.0.1")
-        self.instrument_ref = ome_model.InstrumentRef(id="Instrument:0")
+        self.instrument_ref = ome_types.model.InstrumentRef(id="Instrument:0")
         # TODO: This we should get also in the settings
-        self.stage_label = ome_model.StageLabel(
+        self.stage_label = ome_types.model.StageLabel(
             name="Default", x=0.0, x_unit="µm", y=0.0, y_unit="µm"
         )
 
         self.seq = seq
         self.acquisition_date = str(datetime.now())
         self.max_indices = [1, 1, 1]
-        self.planes = []
-        self.tiff_data = []
+        self.planes = PlaneTable()
 
     def add_plane_from_image(self, _, event: MDAEvent, meta:dict):
-        """The units are hardcoded for now."""
-        plane = ome_model.Plane(
-            exposure_time=event.exposure,
-            exposure_time_unit="ms",
-            the_c=event.index.get("c", 0),
-            the_z=event.index.get("z", 0),
-            the_t=event.index.get("t", 0),
-            delta_t=meta.get('ElapsedTime-ms',0.0),
-            delta_t_unit="ms",
+        """The units are hardcoded for now, ms for times and µm for positions."""
+        index = event.index
+        self.planes.append(
+            the_c=index.get("c", 0),
+            the_z=index.get("z", 0),
+            the_t=index.get("t", 0),
+            ifd=len(self.planes),
+            delta_t=meta.get('ElapsedTime-ms', 0.0),
+            exposure=event.exposure,
             position_x=event.x_pos,
-            position_x_unit="µm",
             position_y=event.y_pos,
-            position_y_unit="µm",
             position_z=event.z_pos,
-            position_z_unit="µm",
-        )
-        tiff = ome_model.TiffData(
-            first_c=event.index.get("c", 0),
-            first_t=event.index.get("t", 0),
-            first_z=event.index.get("z", 0),
-            ifd=len(self.planes),
-            plane_count=1,
         )
         self.image_size = [meta['Width'], meta['Height']]
         self.max_indices = [
-            max(self.max_indices[0], event.index.get("c", 0) + 1),
-            max(self.max_indices[1], event.index.get("t", 0) + 1),
-            max(self.max_indices[2], event.index.get("z", 0) + 1),
+            max(self.max_indices[0], index.get("c", 0) + 1),
+            max(self.max_indices[1], index.get("t", 0) + 1),
+            max(self.max_indices[2], index.get("z", 0) + 1),
         ]
-        self.planes.append(plane)
-        self.tiff_data.append(tiff)
 
     def finalize_metadata(self):
         """No more images to be expected, set the values for all images received so far."""
         pixels = self.pixels_after_acqusition()
         images = [
-            ome_model.Image(id="Image:0", pixels=pixels, acquisition_date=self.acquisition_date)
+            ome_types.model.Image(id="Image:0", pixels=pixels,
+                                  acquisition_date=self.acquisition_date)
         ]
         self.ome.images = images
         print("OME Metadata generated")
 
-    def pixels_after_acqusition(self) -> ome_model.Pixels:
+    def iter_xml(self) -> Iterator[str]:
+        """The XML of the header with the plane elements inserted, piece by piece."""
+        header = self.ome.to_xml()
+        match = _PIXELS_END.search(header)
+        if match is None or not len(self.planes):
+            yield header
+            return
+        if match.group(3):
+            # <Pixels .../> without channels, open it up for the planes
+            prefix = match.group(2)
+            yield header[:match.end() - 2] + ">"
+            yield from self.planes.iter_xml(prefix)
+            yield f"</{prefix}Pixels>" + header[match.end():]
+        else:
+            yield header[:match.start()]
+            yield from self.planes.iter_xml(match.group(1))
+            yield header[match.start():]
+
+    def to_xml(self) -> str:
+        return "".join(self.iter_xml())
+
+    def pixels_after_acqusition(self) -> ome_types.model.Pixels:
         """Generate the Pixels instance after all images where acquired and received."""
+        from ome_types.model import simple_types
         dim_order = [a for a in self.seq.axis_order if a.upper() in "ZCT"] + ["Y","X"]
         dim_order = "".join(dim_order).upper()
         dim_order = dim_order[::-1]
         for a in ["Z", "C", "T"]:
             if a not in dim_order:
                 dim_order += a
-        pixels = ome_model.Pixels(
+        pixels = ome_types.model.Pixels(
             id="Pixels:0",
             dimension_order=dim_order,
             size_c=self.max_indices[0],
@@ -100,8 +183,6 @@ class OME:
             physical_size_z=0.5,
             physical_size_z_unit=simple_types.UnitsLength("µm"),
             channels=self.channels,
-            planes=self.planes,
-            tiff_data_blocks=self.tiff_data,
         )
         return pixels
 
@@ -113,7 +194,7 @@ class OME:
 
     def instrument_from_settings(self, microscope):
         """Generate the instrument from the information received from Micro-Manager."""
-        instrument = ome_model.Instrument(
+        instrument = ome_types.model.Instrument(
             id="Instrument:0",
             detectors=[self.detector_from_settings(microscope.detector)],
             microscope=self.microscope_from_settings(microscope),
@@ -124,7 +205,7 @@ class OME:
         """Generate the channels from the channel information received from Micro-Manager."""
         ome_channels = []
         for idx, channel in enumerate(channels):
-            ome_channel = ome_model.Channel(
+            ome_channel = ome_types.model.Channel(
                 id="Channel:0:" + str(idx),
                 name=channel.config,
                 #color=simple_types.Color(),  # TODO implement to take colors over
@@ -136,7 +217,7 @@ class OME:
 
     def detector_from_settings(self, detector):
         """Generate the detector from the information received from Micro-Manager."""
-        return ome_model.Detector(
+        return ome_types.model.Detector(
             id=detector.id,
             manufacturer=detector.manufacturer,
             model=detector.model,
@@ -146,7 +227,8 @@ class OME:
 
     def microscope_from_settings(self, microscope):
         """ Generate the microscope from the information received from Micro-Manager."""
-        return ome_model.Microscope(manufacturer=microscope.manufacturer, model=microscope.model)
+        return ome_types.model.Microscope(manufacturer=microscope.manufacturer,
+                                          model=microscope.model)
 
 
 if __name__ == "__main__":
@@ -184,7 +266,7 @@ if __name__ == "__main__":
 
     mmc.mda.run(seq)
 
-    print(json.dumps(ome.ome.to_xml(), indent=4))
-    tifffile.tiffcomment("C:/Users/stepp/Desktop/Desktop.ome.tiff", ome.ome.to_xml().encode())
+    print(json.dumps(ome.to_xml(), indent=4))
+    tifffile.tiffcomment("C:/Users/stepp/Desktop/Desktop.ome.tiff", ome.to_xml().encode())
 
     # print(json.dumps(metadata_dict, indent=4))
@@ -7,30 +7,54 @@ from __future__ import annotations
 
 
 from datetime import timedelta
-from threading import Timer
-from typing import TYPE_CHECKING, Any, cast
+import logging
+import queue
+import re
+import time
+from threading import Event, Thread
+from typing import TYPE_CHECKING, Any, Callable, cast
 from pathlib import Path
 import yaml
 
 from useq import MDAEvent
 from isim_control.io.remote_datastore import RemoteDatastore
 from isim_control.io.datastore import QOMEZarrDatastore
-from isim_control.io.ome_metadata import OME
+from isim_control.io.frame_descriptor import AXES
+from isim_control.io.ome_metadata import OME, PlaneTable
+from isim_control.io.tiff_stream import PlaneIndex, StreamingTiff
 from isim_control.settings_translate import load_settings
 import numpy as np
 
 if TYPE_CHECKING:
     import useq
 
-
+logger = logging.getLogger(__name__)
 
 
 class OMETiffWriter:
+    """Writes the frames of a sequence into OME-TIFF memmaps, one file per grid position.
+
+    With write_behind, frameReady only puts the frame into a queue of up to max_queued frames and
+    an I/O thread writes them in order. It flushes the memmaps (msync) only every flush_interval
+    seconds or flush_bytes bytes instead of after every frame. barrier waits until everything is
+    written and flushed, sequenceFinished calls it before the metadata is written. frameReady can
+    get a done callback that is called once the frame is written, until then the frame must not
+    change, so it can be a view into shared memory.
+
+    With streaming, the files are not made for the whole sequence up front. Every frame is
+    appended to a BigTIFF as it arrives, see tiff_stream, and the OME-XML is written at the end.
+    The writer process of the GUI takes it from the tiff_streaming setting.
+    """
     def __init__(self, folder: Path | str, datastore: RemoteDatastore|QOMEZarrDatastore|None = None,
                  settings:dict | None = None,
                  mm_config: dict|None = None,
                  subscriber: bool = False,
-                 advanced_ome: bool = False) -> None:
+                 advanced_ome: bool = False,
+                 write_behind: bool = True,
+                 max_queued: int = 64,
+                 flush_interval: float = 1.,
+                 flush_bytes: int = 2**28,
+                 streaming: bool = False) -> None:
         try:
             import tifffile  # noqa: F401
             import yaml
@@ -50,10 +74,25 @@ class OMETiffWriter:
         self.advanced_ome = advanced_ome
 
         self._mmaps: None | np.memmap = None
+        self.streaming = streaming
+        self._streams: None | list[StreamingTiff] = None
         self._current_sequence: None | useq.MDASequence = None
         self.n_grid_positions: int = 1
         self.preparing = False
         self.writing_frame = False
+        # Writers that get frames in batches switch this off and call flush after the batch
+        self.flush_frames = True
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._flush_requested = Event()
+        self._io_thread = None
+        # Frames the I/O thread could not write since the last barrier
+        self.write_failures = 0
+        self.unflushed_bytes = 0
+        self.last_flush = time.perf_counter()
 
     def sequenceStarted(self, seq: useq.MDASequence) -> None:
         self._set_sequence(seq)
@@ -65,64 +104,196 @@ class OMETiffWriter:
             ome.init_from_sequence(seq)
             self.ome_metadatas.append(ome)
 
-    def sequenceFinished(self, seq: useq.MDASequence, delay:bool = True) -> None:
-        if self.writing_frame or delay:
-            # log.debug("Delaying sequence finished to wait for last frame")
-            Timer(1, self.sequenceFinished, [seq, False]).start()
-            return
+    def sequenceFinished(self, seq: useq.MDASequence) -> None:
+        # All frames on disk before the metadata is written
+        self.barrier()
         from tifffile import tiffcomment
         if not self.advanced_ome:
+            # Only the memmap files have the metadata from the start
+            for stream in self._streams or []:
+                stream.close(self._ome_xml(stream))
+            self._streams = None
             return
         for g, metadata in enumerate(self.ome_metadatas):
             metadata.finalize_metadata()
-            if self.n_grid_positions > 1:
-                filename = f"{self._folder.parts[-1]}_g{str(g).zfill(2)}.ome.tiff"
-            else:
-                filename = f"{self._folder.parts[-1]}.ome.tiff"
-            tiffcomment(Path(self._folder)/filename, metadata.ome.to_xml().encode())
+            if self._streams:
+                self._streams[g].close(metadata.to_xml())
+                continue
+            tiffcomment(self._filename(g), metadata.to_xml().encode())
+        self._streams = None
+        self._first_meta = {}
         self._current_sequence = None
 
-    def frameReady(self, frame: np.ndarray, event: useq.MDAEvent, meta: dict | None = None) -> None:
-        self.writing_frame = True
-        if self.preparing:
-            Timer(0.5, self.frameReady, [frame, event, meta]).start()
-            return
+    def frameReady(self, frame: np.ndarray, event: useq.MDAEvent, meta: dict | None = None,
+                   done: Callable[[], None] | None = None) -> None:
         if event is None:
+            if done:
+                done()
             return
         elif isinstance(event, dict):
             event = MDAEvent(**event)
-        if self._mmaps is None:
+        if self._mmaps is None and self._streams is None:
+            # The files are made here, frames that come in meanwhile wait in the caller
             self.preparing = True
-            if not self._current_sequence:
-                # just in case sequenceStarted wasn't called
-                self._set_sequence(event.sequence)  # pragma: no cover
+            try:
+                if not self._current_sequence:
+                    # just in case sequenceStarted wasn't called
+                    self._set_sequence(event.sequence)  # pragma: no cover
+
+                if not (seq := self._current_sequence):
+                    raise NotImplementedError(
+                        "Writing zarr without a MDASequence not yet implemented"
+                    )
+                if self.streaming:
+                    self._first_meta = meta or {}
+                    self._streams = [StreamingTiff(self._filename(g))
+                                     for g in range(self.n_grid_positions)]
+                else:
+                    self._create_seq_memmap(frame, seq, meta)
+            finally:
+                self.preparing = False
+        if not self.write_behind:
+            self.writing_frame = True
+            try:
+                self._write(frame, event, meta)
+                if self.flush_frames:
+                    self.flush()
+            finally:
+                self.writing_frame = False
+                if done:
+                    done()
+            return
+        if self._io_thread is None or not self._io_thread.is_alive():
+            self._io_thread = Thread(target=self._io_loop, name="tiff_writer_io", daemon=True)
+            self._io_thread.start()
+        # Blocks if the I/O thread is max_queued frames behind
+        self._queue.put((frame, event, meta, done))
 
-            if not (seq := self._current_sequence):
-                raise NotImplementedError(
-                    "Writing zarr without a MDASequence not yet implemented"
-                )
+    def flush(self) -> None:
+        """msync the memmaps, with write_behind only the next time the I/O thread gets to it."""
+        if self.write_behind and self._io_thread is not None and self._io_thread.is_alive():
+            self._flush_requested.set()
+            return
+        self._flush()
 
-            mmap = self._create_seq_memmap(frame, seq, meta)[event.index.get("g", 0)]
-            self.preparing = False
-        else:
-            mmap = self._mmaps[event.index.get("g", 0)]
+    def barrier(self) -> None:
+        """Wait until all queued frames are written and flushed to disk.
 
-        # WRITE DATA TO DISK
-        index = tuple(event.index.get(k) for k in self._used_axes)
+        If the I/O thread died with frames still queued, these are dropped (their done callbacks
+        are called) and a RuntimeError is raised. It is also raised if the I/O thread could not
+        write some of the frames since the last barrier.
+        """
+        if self.write_behind:
+            with self._queue.all_tasks_done:
+                while self._queue.unfinished_tasks:
+                    if self._io_thread is None or not self._io_thread.is_alive():
+                        break
+                    self._queue.all_tasks_done.wait(0.1)
+            if self._queue.unfinished_tasks:
+                dropped = self._drop_queued()
+                raise RuntimeError(f"Tiff writer I/O thread stopped, {dropped} frames were "
+                                   "not written")
+        self._flush()
+        if self.write_failures:
+            failures, self.write_failures = self.write_failures, 0
+            raise RuntimeError(f"Tiff writer could not write {failures} frames")
+
+    def _drop_queued(self) -> int:
+        dropped = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item:
+                dropped += 1
+                if item[3]:
+                    item[3]()
+            self._queue.task_done()
+        # Tasks of items the thread took but never finished
+        with self._queue.all_tasks_done:
+            self._queue.unfinished_tasks = 0
+            self._queue.all_tasks_done.notify_all()
+        return dropped
+
+    def close(self) -> None:
+        if self._io_thread is not None and self._io_thread.is_alive():
+            self._queue.put(None)
+            self._io_thread.join()
+        self._flush()
+        self._close_streams()
 
+    def _close_streams(self) -> None:
+        for stream in self._streams or []:
+            stream.close()
+        self._streams = None
+
+    def _flush(self) -> None:
+        for mmap in self._mmaps or []:
+            mmap.flush()
+        for stream in self._streams or []:
+            stream.flush()
+        self.unflushed_bytes = 0
+        self.last_flush = time.perf_counter()
+
+    def _write(self, frame: np.ndarray, event: useq.MDAEvent, meta: dict | None) -> None:
         rotate = self._view_settings.get("rot", 0)
         while rotate > 0:
             frame = np.rot90(frame)
             rotate -= 90
 
-        mmap[index] = frame
-        mmap.flush()
+        # WRITE DATA TO DISK
+        if self._streams:
+            self._streams[event.index.get("g", 0)].write(frame, event.index)
+        else:
+            mmap = self._mmaps[event.index.get("g", 0)]
+            index = tuple(event.index.get(k) for k in self._used_axes)
+            mmap[index] = frame
+        self.unflushed_bytes += frame.nbytes
         if self.advanced_ome:
-            print("METADATA ", event.index)
             self.ome_metadatas[event.index.get("g", 0)].add_plane_from_image(frame, event, meta)
-        self.writing_frame = False
+
+    def _io_loop(self) -> None:
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                self._queue.task_done()
+                return
+            if item:
+                frame, event, meta, done = item
+                try:
+                    self._write(frame, event, meta)
+                except Exception:
+                    logger.exception(f"Could not write frame {event.index}")
+                    self.write_failures += 1
+                finally:
+                    if done:
+                        done()
+            try:
+                # Flushes are coalesced, the frames are in the page cache until then
+                if self.unflushed_bytes and (
+                        self._flush_requested.is_set() or self.unflushed_bytes >= self.flush_bytes
+                        or time.perf_counter() - self.last_flush >= self.flush_interval):
+                    self._flush_requested.clear()
+                    self._flush()
+            except Exception:
+                # e.g. the disk is full or gone, try again after flush_interval
+                logger.exception("Could not flush the tiff files")
+                self.unflushed_bytes = 0
+                self.last_flush = time.perf_counter()
+            finally:
+                if item:
+                    self._queue.task_done()
 
     # -------------------- private --------------------
+    def _filename(self, g: int) -> Path:
+        if self.n_grid_positions > 1:
+            return self._folder/f"{self._folder.parts[-1]}_g{str(g).zfill(2)}.ome.tiff"
+        return self._folder/f"{self._folder.parts[-1]}.ome.tiff"
+
     def _set_sequence(self, seq: useq.MDASequence | None) -> None:
         """Set the current sequence, and update the used axes."""
         self._folder.mkdir(parents=True, exist_ok=True)
@@ -150,8 +321,30 @@ class OMETiffWriter:
         )
         axes = (*self._used_axes, "y", "x")
         dtype = frame.dtype
+        metadata = {"axes": "".join(axes).upper(), **self._tiff_metadata(seq, meta)}
+
+        # TODO:
+        # there's a lot we could still capture, but it comes off the microscope
+        # over the course of the acquisition (such as stage positions, exposure times)
+        # ... one option is to accumulate these things and then use `tifffile.comment`
+        # to update the total metadata in sequenceFinished
+
+        self._mmaps = []
+        for g in range(self.n_grid_positions):
+            metadata["GridPosition"] = g
+            imwrite(self._filename(g), shape=shape, dtype=dtype, metadata=metadata)
+
+            # memory map numpy array to data in OME-TIFF file
+            _mmap = memmap(self._filename(g))
+            _mmap = cast("np.memmap", _mmap)
+            _mmap = _mmap.reshape(shape)
+            self._mmaps.append(_mmap)
+        return self._mmaps
+
+    def _tiff_metadata(self, seq: useq.MDASequence, meta: dict) -> dict[str, Any]:
+        """Metadata for tifffile from the sequence and the metadata of the first frame."""
         # see tifffile.tiffile for more metadata options
-        metadata: dict[str, Any] = {"axes": "".join(axes).upper()}
+        metadata: dict[str, Any] = {}
         if seq:
             if seq.time_plan and hasattr(seq.time_plan, "interval"):
                 interval = seq.time_plan.interval
@@ -171,35 +364,45 @@ class OMETiffWriter:
             metadata["PhysicalSizeY"] = pix
             metadata["PhysicalSizeXUnit"] = "µm"
             metadata["PhysicalSizeYUnit"] = "µm"
+        return metadata
 
-        # TODO:
-        # there's a lot we could still capture, but it comes off the microscope
-        # over the course of the acquisition (such as stage positions, exposure times)
-        # ... one option is to accumulate these things and then use `tifffile.comment`
-        # to update the total metadata in sequenceFinished
-
-        self._mmaps = []
-        for g in range(self.n_grid_positions):
-            metadata["GridPosition"] = g
-            if self.n_grid_positions > 1:
-                filename = f"{self._folder.parts[-1]}_g{str(g).zfill(2)}.ome.tiff"
-            else:
-                filename = f"{self._folder.parts[-1]}.ome.tiff"
+    def _ome_xml(self, stream: StreamingTiff) -> str | None:
+        """OME-XML of a streamed file from the sequence, for when there is no advanced_ome.
 
-            imwrite(Path(self._folder)/filename, shape=shape, dtype=dtype, metadata=metadata)
+        The planes are mapped to the pages with the records in the index of the file, so it does
+        not matter in which order the frames came or if some are missing. The size of each axis is
+        the largest index that was written.
+        """
+        from tifffile import OmeXml
 
-            # memory map numpy array to data in OME-TIFF file
-            _mmap = memmap(Path(self._folder)/filename)
-            _mmap = cast("np.memmap", _mmap)
-            _mmap = _mmap.reshape(shape)
-            self._mmaps.append(_mmap)
-        return self._mmaps
+        seq = self._current_sequence
+        if not stream.pages or seq is None:
+            return None
+        records = PlaneIndex(stream.path).records
+        index = {axis: records["index"][:, AXES.index(axis)] for axis in AXES}
+        shape = [int(index[axis].max()) + 1 for axis in self._used_axes]
+        metadata = self._tiff_metadata(seq, self._first_meta)
+        if "c" in self._used_axes and "Channel" in metadata:
+            names = metadata["Channel"]["Name"]
+            metadata["Channel"] = {"Name": names[:shape[self._used_axes.index("c")]]}
+        ome = OmeXml()
+        ome.addimage(stream.dtype, (*shape, *stream.shape),
+                     (int(np.prod(shape)), 1, 1, *stream.shape, 1),
+                     axes="".join(self._used_axes).upper() + "YX", **metadata)
+        planes = PlaneTable.from_columns(
+            the_c=np.maximum(index["c"], 0), the_z=np.maximum(index["z"], 0),
+            the_t=np.maximum(index["t"], 0), ifd=records["ifd"])
+        # One TiffData per page instead of the one for all pages in order
+        xml = re.sub(r"<TiffData [^>]*/>", "", ome.tostring(), count=1)
+        end = xml.index("</Pixels>")
+        return xml[:end] + "".join(planes.iter_xml()) + xml[end:]
 
     def __del__(self):
         if self._mmaps:
             for mmap in self._mmaps:
                 mmap.flush()
                 del mmap
+        self._close_streams()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,52 @@
-
-from .buffered_datastore import BufferedDataStore
+from .frame_pool import SharedFramePool, FrameOverwritten
+from .frame_descriptor import unpack, per_frame_meta, apply_delta
 import numpy as np
+from useq import MDAEvent
 
 class RemoteDatastore():
+    """Consumer side of a BufferedDataStore in another process.
+
+    get_frame takes the idx that was published with the frame, the handle (slot, seq, column).
+    It raises FrameOverwritten if the frame is not in the slot anymore. With copy=False it returns
+    a read-only view into shared memory instead of a copy, only do this for pinned frames and
+    release them when done.
+
+    read takes the values of a new_frame or new_live_frame message and also rebuilds event and
+    metadata from the descriptor and the metadata deltas. Every message of that kind has to go
+    through read, also the ones of frames that are skipped, or the deltas don't add up. read also
+    counts the frame as read or lost for the datastore, together with the depth of the message
+    queue of the consumer if given.
+    """
     def __init__(self, remote_datastore_name):
-        self.remote = BufferedDataStore(name=remote_datastore_name, create=False)
+        self.remote = SharedFramePool(name=remote_datastore_name, create=False)
         self.dtype = self.remote.dtype
+        self.meta = {"new_frame": {}, "new_live_frame": {}}
+
+    def read(self, index: tuple[int, int, int], shape: tuple[int, int], delta: dict,
+             kind: str = "new_frame", copy: bool = True, depth: int|None = None
+             ) -> tuple[np.ndarray, MDAEvent, dict]:
+        meta = self.meta[kind]
+        apply_delta(meta, delta)
+        try:
+            descriptor = self.remote.descriptor(index)
+            frame = self.get_frame(index, shape[0], shape[1], copy=copy)
+        except FrameOverwritten:
+            spilled = self.remote.unspill(index)
+            if spilled is None:
+                self.remote.account(index, lost=True, depth=depth)
+                raise
+            frame, descriptor = spilled
+        self.remote.account(index, depth=depth)
+        meta = dict(meta)
+        meta.update(per_frame_meta(descriptor))
+        return frame, unpack(descriptor), meta
+
+    def get_frame(self, index: tuple[int, int, int], width: int, height:int,
+                  copy: bool = True) -> np.ndarray:
+        return self.remote.get(index, (width, height), copy=copy)
+
+    def pinned(self, index: tuple[int, int, int]) -> bool:
+        return self.remote.pinned(index)
 
-    def get_frame(self, index: int, width: int, height:int):
-        index1 = index + width*height
-        if index1 > self.remote.shape[0]:
-            data = self.remote.take(range(index,index1), mode='wrap')
-        else:
-            data = self.remote[index:index1]
-        return np.reshape(data, [width, height])
\ No newline at end of file
+    def release(self, index: tuple[int, int, int]):
+        self.remote.release(index)
@@ -0,0 +1,111 @@
+"""BigTIFF files that grow frame by frame, with a sidecar index of where every plane is.
+
+The memmap writer makes the whole file for the sequence before the first frame, which is hundreds
+of GB for a long timelapse and leaves huge half empty files if the acquisition is cancelled.
+StreamingTiff appends every frame as a new page, so the file only has what was acquired. The pages
+are in the order the frames arrived in, the OME-XML that maps them to c, z and t is written into
+the description of the first page once the sequence is done.
+
+Next to name.ome.tiff, name.ome.tiff.idx has one INDEX record per page, with the index of the
+frame and the offset of its data in the file. PlaneIndex reads a plane with that, without parsing
+the TIFF.
+"""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+from isim_control.io.frame_descriptor import AXES
+
+INDEX = np.dtype([
+    ("index", "i4", (len(AXES),)),    # t, p, g, c, z, -1 for axes that are not in the event
+    ("ifd", "i8"),                    # page number
+    ("offset", "i8"),                 # of the data in the file
+    ("nbytes", "i8"),
+    ("shape", "i4", (2,)),
+    ("dtype", "S8"),
+])
+# First page until the OME-XML replaces it
+PLACEHOLDER = "OME-XML is written when the sequence is finished"
+
+
+def index_path(path: Path|str) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + ".idx")
+
+
+class StreamingTiff:
+    """Appends frames to a BigTIFF file and their records to the sidecar index."""
+    def __init__(self, path: Path|str):
+        from tifffile import TiffWriter
+        self.path = Path(path)
+        self.tiff = TiffWriter(self.path, bigtiff=True)
+        self.index_file = open(index_path(self.path), "wb")
+        self.record = np.zeros((), INDEX)
+        self.pages = 0
+        # Of the first frame, all frames of a file have the same
+        self.shape = None
+        self.dtype = None
+
+    def write(self, frame: np.ndarray, index: dict) -> int:
+        """Append frame as a page, returns the page number."""
+        offset, nbytes = self.tiff.write(frame, contiguous=False, returnoffset=True,
+                                         metadata=None,
+                                         description=PLACEHOLDER if self.pages == 0 else None)
+        self.record["index"] = [index.get(axis, -1) for axis in AXES]
+        self.record["ifd"] = self.pages
+        self.record["offset"] = offset
+        self.record["nbytes"] = nbytes
+        self.record["shape"] = frame.shape[-2:]
+        self.record["dtype"] = frame.dtype.str.encode()
+        self.index_file.write(self.record.tobytes())
+        if self.pages == 0:
+            self.shape, self.dtype = frame.shape[-2:], frame.dtype
+        self.pages += 1
+        return self.pages - 1
+
+    def flush(self, sync: bool = True):
+        """Push what was written to the file system, with sync also to the disk."""
+        for handle in (self.tiff.filehandle, self.index_file):
+            handle.flush()
+            if sync:
+                os.fsync(handle.fileno())
+
+    def close(self, description: str|None = None):
+        """Finish the file, description replaces the placeholder of the first page."""
+        self.tiff.close()
+        self.index_file.close()
+        if description is not None and self.pages:
+            from tifffile import tiffcomment
+            tiffcomment(self.path, description.encode())
+
+
+class PlaneIndex:
+    """Read single planes of a StreamingTiff file through its sidecar index.
+
+    The file can still be written to, refresh picks up the planes that were added.
+    """
+    def __init__(self, path: Path|str):
+        self.path = Path(path)
+        self.refresh()
+
+    def refresh(self):
+        self.records = np.fromfile(index_path(self.path), INDEX)
+        self.lookup = {tuple(record["index"]): n for n, record in enumerate(self.records)}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def record(self, **index) -> np.ndarray:
+        key = tuple(index.get(axis, -1) for axis in AXES)
+        if key not in self.lookup:
+            raise KeyError(f"No plane {index} in {self.path}")
+        return self.records[self.lookup[key]]
+
+    def read(self, **index) -> np.ndarray:
+        """The plane at e.g. t=3, c=1, axes that are not given are the ones the frame didn't have."""
+        record = self.record(**index)
+        return np.memmap(self.path, np.dtype(record["dtype"].decode()), "r",
+                         offset=int(record["offset"]), shape=tuple(record["shape"]))
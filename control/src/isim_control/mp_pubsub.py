@@ -1,6 +1,6 @@
-from threading import Thread, Timer
+from threading import Thread, Timer, Lock
+import logging
 import multiprocessing
-import zarr
 import numpy as np
 import time
 import os
@@ -12,25 +12,40 @@ from qtpy.QtWidgets import QApplication
 from isim_control.gui.dark_theme import set_dark
 from isim_control.settings_translate import useq_from_settings, load_settings
 from isim_control.io.remote_datastore import RemoteDatastore
+from isim_control.io.frame_pool import FrameOverwritten
+from isim_control.io.frame_descriptor import merge_frame_values
+from isim_control.settings_store import SettingsStore
 from isim_control.io.ome_tiff_writer import OMETiffWriter
 from isim_control.gui.assets.save_button import SaveButton
 from isim_control.gui._stack_viewer import StackViewer
 
-from isim_control.pubsub import Subscriber, Publisher, Broker
+from isim_control.pubsub import Subscriber, Publisher, Broker, BatchPublisher
 
 from pymmcore_plus import CMMCorePlus
-from pymmcore_plus.mda.handlers import OMEZarrWriter
+from isim_control.eda._util.zarr_saver import ChunkedOMEZarrWriter, OMEZarrWriter
 from useq import MDAEvent, MDASequence
 from psygnal import Signal
 
+from isim_control.startup import lazy_import, mark, report
+
+# Only needed by the zarr writer and storage
+zarr = lazy_import("zarr")
+
+logger = logging.getLogger(__name__)
+
 class Relay(Thread):
 
-    def __init__(self, mmcore: CMMCorePlus|None = None, subscriber: bool = False):
+    def __init__(self, mmcore: CMMCorePlus|None = None, subscriber: bool = False,
+                 batch: str|None = None, window: float = 0.05, name: str|None = None):
         super().__init__()
         self.pub_queue = multiprocessing.Queue()
         self.out_conn, self.in_conn = multiprocessing.Pipe()
-        self.pub = Publisher(self.pub_queue)
-        self.settings = None
+        # batch is the policy of a BatchPublisher for the frame messages, "all" or "latest"
+        if batch:
+            self.pub = BatchPublisher(self.pub_queue, policy=batch, window=window,
+                                      merge=merge_frame_values, name=name)
+        else:
+            self.pub = Publisher(self.pub_queue, name)
         if subscriber:
             self.sub = Subscriber(["control"],
                               {"set_relative_xy_position": [self._set_relative_xy_position],})
@@ -40,21 +55,17 @@ class Relay(Thread):
             self._mmc.mda.events.sequenceStarted.connect(self.sequenceStarted)
             self._mmc.mda.events.sequenceFinished.connect(self.sequenceFinished)
             self._mmc.events.XYStagePositionChanged.connect(self.XYStagePositionChanged)
-            self.system_state = self._mmc.getSystemState().dict()
 
-    def new_settings(self, settings:dict) -> None:
-        if self._mmc and settings['live'] == self.settings['live']:
-            print("UPDATE SYSTEM STATE")
-            self.system_state = self._mmc.getSystemState().dict()
-        self.settings = settings
+    def disconnect(self) -> None:
+        """Stop relaying the core events, for relays of retired worker processes."""
+        if getattr(self, "_mmc", None):
+            self._mmc.mda.events.sequenceStarted.disconnect(self.sequenceStarted)
+            self._mmc.mda.events.sequenceFinished.disconnect(self.sequenceFinished)
+            self._mmc.events.XYStagePositionChanged.disconnect(self.XYStagePositionChanged)
 
     def sequenceStarted(self, seq: MDASequence) -> None:
-        if self._mmc:
-            self.pub.publish("sequence", "sequence_started", [seq,
-                                                              self.system_state,
-                                                              self.settings])
-        else:
-            self.pub.publish("sequence", "sequence_started", [seq])
+        # Settings and system state are in the SettingsStore of the output GUI
+        self.pub.publish("sequence", "sequence_started", [seq])
 
     def sequenceFinished(self, seq: MDASequence) -> None:
         self.pub.publish("sequence", "sequence_finished", [seq])
@@ -72,41 +83,236 @@ class Relay(Thread):
 
 
 class RemoteOMETiffWriter(OMETiffWriter):
-    def __init__(self, *args, **kwargs):
+    """Writer in a long lived process, it only writes between a reset and the sequence_finished.
+
+    reset gets the version of the settings, they are read from the SettingsStore store. When it is
+    done with a sequence it sends "idle" over status, if given.
+    """
+    def __init__(self, *args, store: SettingsStore|None = None, status=None, **kwargs):
         super().__init__(*args, subscriber=False, **kwargs)
+        self.store = store
+        self.status = status
+        self.active = False
         self.sub = Subscriber(["datastore", "sequence"], {"reset": [self.reset],
                                               "new_frame": [self.ext_datastore_frame_ready],
+                                              "new_frames": [self.ext_datastore_frames_ready],
                                               "sequence_finished": [self.sequenceFinished]})
 
-    def reset(self, settings, mm_config):
-        print("Resetting writer", settings["path"])
+    def reset(self, version: int):
+        loaded, sections = self.store.snapshot(version=version)
+        settings, mm_config = sections["settings"], sections["system_state"]
+        logger.info(f"Resetting writer to settings version {loaded}, {settings['path']}")
+        # Files of the last sequence are done, the first frame makes new ones
+        try:
+            self.barrier()
+        except Exception:
+            logger.exception("Writer could not finish the last sequence")
+        self._close_streams()
+        self._mmaps = None
+        self.n_grid_positions = 1
         self._folder = Path(settings["path"])
+        self.streaming = settings.get("tiff_streaming", False)
         self._settings = settings
         self._mm_config = mm_config
         self.sequenceStarted(useq_from_settings(settings))
+        self.active = True
 
-    def ext_datastore_frame_ready(self, event: dict | MDAEvent | None, shape = None, idx = 0,
-                                  meta = {}):
-        if isinstance(self.datastore, RemoteDatastore):
-            frame = self.datastore.get_frame(idx, shape[0], shape[1])
-        else:
-            frame = self.datastore.get_frame(event)
-        self.frameReady(frame, event, meta)
+    def sequenceFinished(self, seq: MDASequence) -> None:
+        if not self.active:
+            return
+        try:
+            # Waits for the frames that are still queued for writing
+            super().sequenceFinished(seq)
+        except Exception:
+            logger.exception("Writer could not finish the sequence")
+        finally:
+            self.active = False
+            if self.status:
+                self.status.send(("idle", None))
+
+    def ext_datastore_frame_ready(self, idx: tuple[int, int, int], shape: tuple[int, int],
+                                  delta: dict):
+        if not self.active:
+            self.datastore.release(idx)
+            return
+        try:
+            # If the frame is pinned for the writer, it can be written straight from shared
+            # memory, it is released once it is on disk. Otherwise it could be overwritten.
+            frame, event, meta = self.datastore.read(idx, shape, delta,
+                                                     copy=not self.datastore.pinned(idx),
+                                                     depth=self.sub.depth)
+        except FrameOverwritten as e:
+            # Only happens if the datastore does not hold the frames for the writer
+            logging.error(f"Frame lost for writer: {e}")
+            self.datastore.release(idx)
+            return
+        try:
+            self.frameReady(frame, event, meta, done=lambda: self.datastore.release(idx))
+        except Exception:
+            self.datastore.release(idx)
+            raise
+
+    def ext_datastore_frames_ready(self, frames: list[list]):
+        """A batch of new_frame values, without write_behind the files are flushed at the end."""
+        self.flush_frames = False
+        try:
+            for values in frames:
+                self.ext_datastore_frame_ready(*values)
+        finally:
+            self.flush_frames = True
+            self.flush()
+
+def tiff_writer_process(queue, control, status, name, store_name):
+    """Writer that stays for many sequences, every sequence starts with a reset message.
 
-def tiff_writer_process(queue, settings, mm_config, in_conn, name):
+    Sends "ready" over status when it can take frames, exits when it gets False over control.
+    """
     datastore = RemoteDatastore(name)
-    writer = RemoteOMETiffWriter(settings["path"], datastore, settings, mm_config,
-                                 advanced_ome=True)
+    store = SettingsStore(store_name)
+    settings = store.get("settings")
+    writer = RemoteOMETiffWriter(settings["path"], datastore, settings, store.get("system_state"),
+                                 advanced_ome=True, store=store, status=status,
+                                 streaming=settings.get("tiff_streaming", False))
+    broker = Broker(pub_queue=queue, auto_start=False, name="writer_broker")
+    broker.attach(writer)
+    broker.start()
     print("Writer ready")
-    event = in_conn.recv()
-    if event:
-        broker = Broker(pub_queue=queue, auto_start=False, name="writer_broker")
-        broker.attach(writer)
-        broker.start()
-    else:
-        del datastore
-        writer.sub.stop()
-        del writer
+    mark("ready")
+    report()
+    status.send(("ready", None))
+    while control.recv():
+        # Activated for a sequence, the reset message follows on the queue
+        pass
+    broker.stop()
+    broker.join()
+    writer.close()
+
+
+class WorkerPool:
+    """Worker processes of one kind that are started before they are needed.
+
+    Starting a process means a new interpreter that imports Qt, tifffile, zarr etc., which takes
+    seconds on Windows. The pool keeps processes running, so that an acquisition does not wait for
+    that. Every worker has its own Relay, target is called as
+    target(queue, control, status, *args). The worker sends ("ready", info) and later ("idle", _)
+    over status, acquire sends True over control and False shuts it down.
+
+    With reuse, workers go back to the pool after a sequence and are handed out again once they
+    reported idle. Without reuse, a worker is only used once, like a viewer that keeps its window,
+    and a spare is started whenever one is handed out. Released workers that are not reused are
+    kept in retired, their broker keeps running so that shutdown can still close them.
+    """
+    def __init__(self, target, args: tuple, mmcore: CMMCorePlus|None = None, size: int = 1,
+                 reuse: bool = True, name: str = "worker", **relay_kwargs):
+        self.target = target
+        self.args = args
+        self._mmc = mmcore
+        self.size = size
+        self.reuse = reuse
+        self.name = name
+        self.relay_kwargs = relay_kwargs
+        self.workers = []
+        self.retired = []
+        self.spawning = 0
+        self.spawned = 0
+        self.lock = Lock()
+        for _ in range(size):
+            self.spawn_spare()
+
+    def spawn(self) -> dict:
+        try:
+            with self.lock:
+                self.spawned += 1
+                # Unique names, the datastore keeps its stats by publisher name
+                name = f"{self.name}_{self.spawned}"
+            relay = Relay(self._mmc, name=name, **self.relay_kwargs)
+            control_out, control_in = multiprocessing.Pipe()
+            status_in, status_out = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=self.target,
+                                              args=(relay.pub_queue, control_in, status_out,
+                                                    *self.args),
+                                              name=name)
+            process.start()
+            worker = {"relay": relay, "process": process, "control": control_out,
+                      "status": status_in, "state": "starting", "info": None}
+            with self.lock:
+                self.workers.append(worker)
+            return worker
+        finally:
+            with self.lock:
+                self.spawning -= 1
+
+    def spawn_spare(self):
+        with self.lock:
+            self.spawning += 1
+        Thread(target=self.spawn, name=f"{self.name}_spawn", daemon=True).start()
+
+    def poll(self):
+        with self.lock:
+            workers = list(self.workers)
+        for worker in workers:
+            while worker["status"].poll():
+                state, info = worker["status"].recv()
+                if state == "ready" and worker["state"] == "starting":
+                    worker["info"] = info
+                    worker["state"] = "idle"
+                elif state == "idle" and worker["state"] in ("busy", "finishing"):
+                    worker["state"] = "idle"
+                else:
+                    logger.warning(f"{worker['process'].name} sent {state} while "
+                                   f"{worker['state']}")
+
+    def acquire(self, timeout: float = 30) -> dict:
+        """Hand out an idle worker, waits for one to become ready if there is none."""
+        t0 = time.perf_counter()
+        while True:
+            self.poll()
+            idle = [worker for worker in self.workers if worker["state"] == "idle"]
+            if idle:
+                break
+            if not self.workers and not self.spawning:
+                self.spawn_spare()
+            if time.perf_counter() - t0 > timeout:
+                raise TimeoutError(f"No {self.name} process ready after {timeout} s")
+            time.sleep(0.05)
+        worker = idle[0]
+        worker["state"] = "busy"
+        worker["control"].send(True)
+        if not self.reuse:
+            with self.lock:
+                self.workers.remove(worker)
+            self.spawn_spare()
+        return worker
+
+    def release(self, worker: dict):
+        """The sequence of worker is over. Workers that are not reused don't get events anymore."""
+        if self.reuse:
+            if worker["state"] == "busy":
+                worker["state"] = "finishing"
+            return
+        worker["state"] = "retired"
+        worker["relay"].disconnect()
+        with self.lock:
+            self.retired.append(worker)
+
+    def shutdown(self, timeout: float = 5):
+        """Stop the workers in the pool and close the retired ones."""
+        while self.spawning:
+            time.sleep(0.05)
+        for worker in self.workers:
+            worker["relay"].pub.publish("stop", "stop", [])
+            worker["control"].send(False)
+        for worker in self.retired:
+            worker["relay"].pub.publish("gui", "shutdown", [])
+            worker["relay"].pub.publish("stop", "stop", [])
+            worker["control"].send(False)
+        for worker in self.workers + self.retired:
+            worker["process"].join(timeout)
+            if worker["process"].is_alive():
+                logger.warning(f"{worker['process'].name} did not stop, terminating it")
+                worker["process"].terminate()
+                worker["process"].join()
+            logger.debug(f"{worker['process'].name} process closed")
 
 
 class RemoteZarrWriter(OMEZarrWriter):
@@ -123,14 +329,17 @@ class RemoteZarrWriter(OMEZarrWriter):
         self.datastore = datastore
         self.pub = Publisher(pub_queue) or None
 
-    def frameReady(self, event: dict, shape: tuple[int, int], idx: int, meta: dict) -> None:
-        img = self.datastore.get_frame(idx, shape[0], shape[1])
-        super().frameReady(img, MDAEvent(**event), meta)
-        # self.frame_ready.emit(MDAEvent(**event))
+    def frameReady(self, idx: tuple[int, int, int], shape: tuple[int, int], delta: dict) -> None:
+        try:
+            img, event, meta = self.datastore.read(idx, shape, delta, depth=self.sub.depth)
+        except FrameOverwritten:
+            # The viewer fell behind, newer frames will follow
+            return
+        super().frameReady(img, event, meta)
         if self.pub:
             self.pub.publish("writer", "frame_ready", [event, img.shape, idx, meta])
 
-    def sequence_started(self, seq: MDASequence, mm_config: dict, settings:dict) -> None:
+    def sequence_started(self, seq: MDASequence, *_) -> None:
         self._used_axes = tuple(seq.used_axes)
         super().sequenceStarted(seq)
 
@@ -147,13 +356,22 @@ class RemoteZarrWriter(OMEZarrWriter):
             index = tuple(event.index.get(k) for k in self._used_axes)
         except AttributeError:
             self.sequence_started(event.sequence)
-        data: np.ndarray = ary[index]
+        data: np.ndarray = self.read_frame(ary, index)
         return data
 
+
+class ChunkedRemoteZarrWriter(RemoteZarrWriter, ChunkedOMEZarrWriter):
+    """RemoteZarrWriter that writes compressed blocks of chunks, see ChunkedOMEZarrWriter."""
+
+
 def zarr_writer_process(queue, settings, mm_config, out_conn, name, viewer_queue=None):
     broker = Broker(pub_queue=queue, auto_start=False)
     datastore = RemoteDatastore(name)
-    writer = RemoteZarrWriter(datastore, viewer_queue, store=settings["path"], overwrite=True)
+    if chunks := settings.get("zarr_chunks"):
+        writer = ChunkedRemoteZarrWriter(datastore, viewer_queue, store=settings["path"],
+                                         overwrite=True, chunks=chunks)
+    else:
+        writer = RemoteZarrWriter(datastore, viewer_queue, store=settings["path"], overwrite=True)
     broker.attach(writer)
     out_conn.send(True)
     broker.start()
@@ -166,8 +384,11 @@ class RemoteZarrStorage:
         self.sub = Subscriber(["writer", "sequence"], {"frame_ready": [self.frameReady],
                                                        "sequence_started": [self.sequenceStarted],})
 
-    def frameReady(self, event: dict, shape: tuple[int, int], idx: int, meta: dict) -> None:
-        self.frame_ready.emit(MDAEvent(**event))
+    def frameReady(self, event: dict|MDAEvent, shape: tuple[int, int], idx: tuple,
+                   meta: dict) -> None:
+        if isinstance(event, dict):
+            event = MDAEvent(**event)
+        self.frame_ready.emit(event)
 
     def sequenceStarted(self, seq: MDASequence) -> None:
         self._used_axes = tuple(seq.used_axes)
@@ -179,21 +400,36 @@ class RemoteZarrStorage:
 
 
 class RemoteViewer(StackViewer):
-    def __init__(self, size, transform, datastore):
+    def __init__(self, size, transform, datastore, store: SettingsStore|None = None):
         super().__init__(size=size, transform=transform, datastore=datastore, save_button=False)
         self.save_button = SaveButton(datastore)
         self.bottom_buttons.addWidget(self.save_button)
+        self.store = store
         self.sub = Subscriber(["writer", "gui"], {"frame_ready": [self.on_frame_ready],
-                                              "acquisition_start": [self.on_sequence_start,
-                                                                    self.save_button.sequenceStarted],
+                                              "acquisition_start": [self.on_sequence_start],
+                                              "settings_version": [self.on_settings_version],
                                               "shutdown": [self.close_me]})
 
-    def on_frame_ready(self, event: dict, shape: tuple[int, int], idx: int, meta: dict) -> None:
-        return super().frameReady(MDAEvent(**event))
-
-    def on_sequence_start(self, seq: MDASequence, *_) -> None:
+    def on_frame_ready(self, event: dict|MDAEvent, shape: tuple[int, int], idx: tuple,
+                       meta: dict) -> None:
+        # The viewer's own RemoteZarrWriter sends the event in process, no need to rebuild it
+        if isinstance(event, dict):
+            event = MDAEvent(**event)
+        return super().frameReady(event)
+
+    def on_sequence_start(self, seq: MDASequence, version: int|None = None) -> None:
+        if self.store is not None:
+            _, sections = self.store.snapshot(version=version)
+            self.save_button.sequenceStarted(seq, sections["system_state"], sections["settings"])
         return super().sequenceStarted(seq)
 
+    def on_settings_version(self, version: int, keys: list) -> None:
+        """Follow the save path, the settings saved with the data stay the ones it was taken with."""
+        if self.store is None or not any(not key or key[0] == "path" for key in keys):
+            return
+        _, sections = self.store.snapshot()
+        self.save_button.save_loc = Path(sections["settings"]["path"]).parent
+
     def close_me(self) -> None:
         print("VIEWER ASKED TO CLOSE")
         self.hide()
@@ -201,7 +437,7 @@ class RemoteViewer(StackViewer):
         self.close()
 
 
-def viewer_process(viewer_queue, in_pipe, out_pipe, name=None):
+def viewer_process(viewer_queue, control, status, name=None, store_name=None):
     app = QApplication([])
 
     set_dark(app)
@@ -218,11 +454,15 @@ def viewer_process(viewer_queue, in_pipe, out_pipe, name=None):
     transform = (view_settings.get("rot", 0),
                  view_settings.get("mirror_x", False),
                  view_settings.get("mirror_y", True))
-    viewer = RemoteViewer(size=(2048, 2048), transform=transform, datastore=datastore)
+    store = SettingsStore(store_name) if store_name else None
+    viewer = RemoteViewer(size=(2048, 2048), transform=transform, datastore=datastore,
+                          store=store)
     viewer.pixel_size = 0.056
-    out_pipe.send(int(viewer.winId()))
+    mark("ready")
+    report()
+    status.send(("ready", int(viewer.winId())))
 
-    event = in_pipe.recv()
+    event = control.recv()
     if event:
         broker = Broker(pub_queue=viewer_queue, auto_start=False, name="viewer_broker")
         broker.attach(viewer)
@@ -234,7 +474,8 @@ def viewer_process(viewer_queue, in_pipe, out_pipe, name=None):
         print("Viewer process closing")
         app.exit()
     else:
-        del remote_datastore
+        if isinstance(datastore, RemoteZarrWriter):
+            del remote_datastore
         datastore.sub.stop()
         del datastore
         viewer.close_me()
@@ -308,28 +549,28 @@ if __name__ == "__main__":
     # viewer_relay.pub.publish("stop", "stop", [])
 
     ## Viewer without writer and additional process for a tiff writer
-    writer_relay = Relay(mmc)
-    viewer_relay = Relay(mmc)
     settings["path"] = "C:/Users/stepp/Desktop/test"
-    buffered_datastore = BufferedDataStore(mmcore=mmc, create=True, publishers=[writer_relay.pub,
-                                                                                viewer_relay.pub])
-    writer_process = multiprocessing.Process(target=tiff_writer_process,
-                                            args=([writer_relay.pub_queue,
-                                                settings,
-                                                mmc.getSystemState().dict(),
-                                                writer_relay.out_conn,
-                                                buffered_datastore._shm.name]))
-
-    writer_process.start()
-    viewer_process.start()
-    viewer_relay.in_conn.recv()
-    writer_relay.in_conn.recv()
-
+    buffered_datastore = BufferedDataStore(mmcore=mmc, create=True)
+    store = SettingsStore(create=True)
+    version = store.update(settings=settings, system_state=mmc.getSystemState().dict())
+    writer_pool = WorkerPool(tiff_writer_process, (buffered_datastore.name, store.name), mmc,
+                             name="writer", batch="all", window=0.1)
+    viewer_pool = WorkerPool(viewer_process, (buffered_datastore.name, store.name), mmc,
+                             reuse=False, name="viewer", batch="latest")
+    writer = writer_pool.acquire()
+    viewer = viewer_pool.acquire()
+    buffered_datastore.add_publisher(writer["relay"].pub, "block")
+    buffered_datastore.add_publisher(viewer["relay"].pub)
+    viewer["relay"].pub.publish("gui", "acquisition_start", [useq_from_settings(settings),
+                                                             version])
+    writer["relay"].pub.publish("datastore", "reset", [version])
 
     mmc.mda.run(useq_from_settings(settings))
     time.sleep(2)
     while mmc.isSequenceRunning():
         time.sleep(1)
     print("Sending stop")
-    writer_relay.pub.publish("stop", "stop", [])
-    viewer_relay.pub.publish("stop", "stop", [])
+    writer_pool.release(writer)
+    viewer_pool.release(viewer)
+    writer_pool.shutdown()
+    viewer_pool.shutdown()
@@ -2,15 +2,21 @@ from pymmcore_plus import CMMCorePlus
 from pymmcore_plus.mda import MDAEngine
 import nidaqmx
 import nidaqmx.stream_writers
-from threading import Thread, Lock, Event
+from threading import Thread, Event
 import numpy as np
 import time
 import copy
+import logging
+import queue
 
-from useq import MDAEvent
+from useq import MDAEvent, MDASequence
 from isim_control.ni.devices import NIDeviceGroup
+from isim_control.ni.streaming import StreamingWriter
+from isim_control.ni.snap_worker import SnapWorker, SnapSlot
 from isim_control.settings import iSIMSettings
 
+logger = logging.getLogger(__name__)
+
 CONTINUOUS = nidaqmx.constants.AcquisitionType.CONTINUOUS
 WAIT_TIME = 2 #Seconds to wait before starting acq
 class AcquisitionEngine(MDAEngine):
@@ -27,7 +33,11 @@ class AcquisitionEngine(MDAEngine):
         self.task = self.device_group.task
         self.stream = self.device_group.stream
         self.mmc.mda.events.sequenceFinished.connect(self.on_sequence_end)
-        self.snap_lock = Lock()
+        # Made by the first snap, the compiled and streaming engines don't snap
+        self._snapper = None
+        self.slot = None
+        # Phase durations of the current event in ms, only recorded by the TimedAcquisitionEngine
+        self.timing = None
 
         self.running = Event()
 
@@ -36,10 +46,7 @@ class AcquisitionEngine(MDAEngine):
         # handle that in the NI device.
         t0 = time.perf_counter()
         sub_event = self._adjust_event_properties(event)
-        if self.use_filter_wheel:
-            set_filter = {"LED": "#NoFilter", "488": "488", "561": "561"}[sub_event.channel.config]
-            self.mmc.setProperty("FilterWheel", "Label", set_filter)
-            self.mmc.waitForDevice("FilterWheel")
+        self._set_filter(sub_event)
 
         super().setup_event(sub_event)
 
@@ -47,16 +54,21 @@ class AcquisitionEngine(MDAEngine):
             next_event = next(self.internal_event_iterator)
         except StopIteration:
             next_event = None
+        t_waveform = time.perf_counter()
         self.ni_data = self.device_group.get_data(event, next_event)
-        thread = Thread(target=self.snap_and_get, args=(event,))
+        self._record("waveform", t_waveform)
 
-        self.snap_lock.acquire()
-        thread.start()
+        # The previous snap has to be done before the camera is armed again
+        if self.slot is not None:
+            self.slot.triggered.wait()
+        self.slot = self.snapper.submit(event, self.emit_snap, data=self.timing)
         try:
             self.task.stop()
         except:
             pass
+        t_write = time.perf_counter()
         self.stream.write_many_sample(self.ni_data)
+        self._record("daq_write", t_write)
         # Delay the first frame a little so that things have time to set up
         if sum(sub_event.index.values()) == 0 and not self.eda:
             #Offset the time we needed to set up the acqusition in the runner
@@ -65,25 +77,67 @@ class AcquisitionEngine(MDAEngine):
             self.mmc._mda_runner._paused_time += WAIT_TIME
 
 
+    @property
+    def snapper(self) -> SnapWorker:
+        if self._snapper is None:
+            self._snapper = SnapWorker(self.mmc, name="acquisition_snap")
+        return self._snapper
+
+    def stop_snapper(self, timeout: float = 1):
+        if self._snapper is not None:
+            self._snapper.stop()
+            self._snapper.join(timeout)
+            self._snapper = None
+
     def exec_event(self, event: MDAEvent):
         # Check that the camera has been asked to snap and start the generation on the DAQ
-        self.snap_lock.acquire()
+        self.slot.armed.wait()
         self.task.start()
         return ()
 
-    def snap_and_get(self, event):
-        self.snap_lock.release()
-        self._mmc.snapImage()
-        self.snap_lock.release()
-        meta = self._mmc.getTags()
+    def emit_snap(self, slot: SnapSlot):
+        """Called by the snap worker with the read out slot."""
+        meta = slot.meta
         meta["ElapsedTime-ms"] = (meta["PerfCounter"] - self._t0) * 1000
-        self._mmc.mda.events.frameReady.emit(self._mmc.getImage(fix=False), event, meta)
+        t_dispatch = time.perf_counter()
+        self._mmc.mda.events.frameReady.emit(slot.image, slot.event, meta)
+        # The timing dict of the event this slot was submitted for
+        timing = slot.data
+        if timing is not None:
+            times = slot.times
+            timing["arm"] = (times["armed"] - times["submitted"])*1000
+            timing["snap"] = (times["triggered"] - times["armed"])*1000
+            timing["get_image"] = (times["read_out"] - times["triggered"])*1000
+            timing["dispatch"] = (time.perf_counter() - t_dispatch)*1000
+
+    def _record(self, phase: str, t0: float):
+        if self.timing is not None:
+            self.timing[phase] = (time.perf_counter() - t0)*1000
+
+    def pop_and_emit(self, event: MDAEvent, deadline: float) -> bool:
+        """Wait for the next image of a camera sequence acquisition and send it out for event."""
+        while self._mmc.getRemainingImageCount() == 0:
+            if time.perf_counter() > deadline:
+                logging.warning(f"No image from the camera for event {event.index}")
+                return False
+            time.sleep(0.001)
+        img, md = self._mmc.popNextImageAndMD(fix=False)
+        meta = dict(md)
+        meta["PerfCounter"] = time.perf_counter()
+        meta["ElapsedTime-ms"] = (meta["PerfCounter"] - self._t0) * 1000
+        self._mmc.mda.events.frameReady.emit(img, event, meta)
+        return True
 
     def on_sequence_end(self, sequence):
-        self.snap_lock.acquire()
+        if self.slot is not None:
+            self.slot.triggered.wait()
         self.task.wait_until_done()
         self.task.stop()
-        self.snap_lock.release()
+        if self.slot is not None:
+            # Let the last frame go out before the sequence is finished
+            self.slot.free.wait(5)
+            self.slot = None
+        self.stop_snapper()
         self.running.clear()
         if self.previous_exposure != self._mmc.getExposure():
             self._mmc.setExposure(self.previous_exposure)
@@ -122,6 +176,12 @@ class AcquisitionEngine(MDAEngine):
             self._mmc.waitForDevice(self.mmc.getCameraDevice())
             print("EXPOSURE SET FOR ACQ", exposure)
 
+    def _set_filter(self, event: MDAEvent):
+        if self.use_filter_wheel:
+            set_filter = {"LED": "#NoFilter", "488": "488", "561": "561"}[event.channel.config]
+            self.mmc.setProperty("FilterWheel", "Label", set_filter)
+            self.mmc.waitForDevice("FilterWheel")
+
     def _adjust_event_properties(self, event):
         """We want the exposure set in the Channel to be the 'real' exposure,
            so we set the exposure of the event to None, so that it's not set in the MDAEngine setup
@@ -134,34 +194,266 @@ class AcquisitionEngine(MDAEngine):
             event_dict['y_pos'] = event_dict['y_pos'] + self.start_xy_position[1]
         return MDAEvent(**event_dict)
 
-class TimedAcquisitionEngine(AcquisitionEngine):
+def compile_blocks(sequence: MDASequence, split_axes: tuple[str] = ("t", "p", "g")
+                   ) -> list[list[MDAEvent]]:
+    """Split the events of a sequence into blocks that can be played without software in between.
+
+    A new block is started whenever one of the split_axes changes. By default this is one block per
+    time point and position, so the whole z/c stack is played in one go.
+    """
+    blocks = []
+    last_key = None
+    for event in sequence.iter_events():
+        key = tuple(event.index.get(axis, 0) for axis in split_axes)
+        if key != last_key:
+            blocks.append([])
+            last_key = key
+        blocks[-1].append(event)
+    return blocks
+
+
+class CompiledAcquisitionEngine(AcquisitionEngine):
+    """Plays a whole block of events as one generation on the DAQ.
+
+    The waveforms of all events in a block (by default one time point at one position) are
+    concatenated by the NIDeviceGroup and written to the task once. The camera runs a sequence
+    acquisition and gets its triggers from the camera row of the program, so there is no stop,
+    write and start of the task between the frames of a block. This is what channels_then_slices
+    in the old Micro-Manager based control did.
+    """
     def __init__(self, mmc: CMMCorePlus, device_group: NIDeviceGroup = None,
                  settings: dict|None = None):
         super().__init__(mmc, device_group, settings)
+        self.blocks = []
+        self.block_index = 0
+        self.event_in_block = 0
+        self.frame_timeout = 5  # seconds on top of the expected duration of the block
+
+    def setup_sequence(self, sequence):
+        super().setup_sequence(sequence)
+        split_axes = ("t", "p", "g", "c") if self.use_filter_wheel else ("t", "p", "g")
+        self.blocks = compile_blocks(self.sequence, split_axes)
+        self.block_index = 0
+        self.event_in_block = 0
+
+    def setup_event(self, event: MDAEvent):
+        if self.eda:
+            return super().setup_event(event)
+        if self.event_in_block > 0:
+            # Everything for this event is already running on the DAQ and the camera
+            return
+        t0 = time.perf_counter()
+        block = self.blocks[self.block_index]
+        if block[0].index != event.index:
+            logging.warning(f"Event {event.index} does not start block {block[0].index}")
+        sub_event = self._adjust_event_properties(event)
+        self._set_filter(sub_event)
+        MDAEngine.setup_event(self, sub_event)
+
+        try:
+            next_event = self.blocks[self.block_index + 1][0]
+        except IndexError:
+            next_event = None
+        self.ni_data = self.device_group.get_sequence_data(block, next_event)
+        self._stop_block()
+        self.device_group.update_task(self.settings, n_points=self.ni_data.shape[1])
+        self.stream.write_many_sample(self.ni_data)
+        self._mmc.startSequenceAcquisition(len(block), 0, True)
+        if sum(sub_event.index.values()) == 0:
+            self.mmc._mda_runner._paused_time +=time.perf_counter() - t0
+            time.sleep(WAIT_TIME)
+            self.mmc._mda_runner._paused_time += WAIT_TIME
+
+    def exec_event(self, event: MDAEvent):
+        if self.eda:
+            return super().exec_event(event)
+        block = self.blocks[self.block_index]
+        if self.event_in_block == 0:
+            self.task.start()
+            self.block_deadline = (time.perf_counter() + self.frame_timeout +
+                                   self.ni_data.shape[1]/self.settings['ni']['sample_rate'])
+        self.event_in_block += 1
+        if self.event_in_block == len(block):
+            self.block_index += 1
+            self.event_in_block = 0
+        self.pop_and_emit(event, self.block_deadline)
+        return ()
+
+    def _stop_block(self):
+        if self._mmc.isSequenceRunning():
+            self._mmc.stopSequenceAcquisition()
+        try:
+            self.task.wait_until_done(timeout=self.frame_timeout)
+        except Exception:
+            pass
+        try:
+            self.task.stop()
+        except Exception:
+            pass
+
+    def on_sequence_end(self, sequence):
+        if self.eda:
+            return super().on_sequence_end(sequence)
+        self._stop_block()
+        # Back to the timing of one frame for live mode and snaps
+        self.device_group.update_task(self.settings)
+        self.running.clear()
+        if self.previous_exposure != self._mmc.getExposure():
+            self._mmc.setExposure(self.previous_exposure)
+            print("EXPOSURE RESET FOR LIVE", self.previous_exposure)
+
+
+class StreamingAcquisitionEngine(AcquisitionEngine):
+    """Keeps the DAQ generating continuously for the whole sequence.
+
+    setup_event hands the event and the lookahead next_event to a StreamingWriter, which renders
+    the waveform in its producer thread while the previous frame is still being played, and
+    exec_event returns right away. The camera runs a continuous sequence acquisition and a drain
+    thread matches the images to the events in the order they were played.
+
+    Events that need the hardware to move (new channel for the filter wheel, new position or grid
+    tile for the stage) wait until all frames before them are played, meanwhile the stream holds
+    the galvo and stage values with the camera and lasers off.
+    """
+    def __init__(self, mmc: CMMCorePlus, device_group: NIDeviceGroup = None,
+                 settings: dict|None = None):
+        super().__init__(mmc, device_group, settings)
+        self.writer = StreamingWriter(self.device_group)
+        self.played = queue.Queue()
+        self.drain_thread = None
+        self.frame_timeout = 5
+        self.last_event = None
+
+    def setup_sequence(self, sequence):
+        super().setup_sequence(sequence)
+        self.played = queue.Queue()
+        self.last_event = None
+        if self.eda:
+            # The events come one by one, they are snapped like in the AcquisitionEngine
+            return
+        self._mmc.startContinuousSequenceAcquisition(0)
+        self.writer.start(next(self.sequence.iter_events()))
+        self.drain_thread = Thread(target=self._drain, name="frame_drain", daemon=True)
+        self.drain_thread.start()
+
+    def setup_event(self, event: MDAEvent):
+        if self.eda:
+            return super().setup_event(event)
+        sub_event = self._adjust_event_properties(event)
+        if self._moves_hardware(sub_event):
+            self.writer.wait_until_played()
+        self._set_filter(sub_event)
+        MDAEngine.setup_event(self, sub_event)
+        self.last_event = sub_event
+        try:
+            next_event = next(self.internal_event_iterator)
+        except StopIteration:
+            next_event = None
+        self.writer.submit(event, next_event)
+
+    def _moves_hardware(self, event: MDAEvent) -> bool:
+        """The filter wheel or the stage have to move for event."""
+        last = self.last_event
+        if last is None:
+            return False
+        channel = event.channel.config if event.channel else None
+        last_channel = last.channel.config if last.channel else None
+        return (channel != last_channel or (event.x_pos, event.y_pos) != (last.x_pos, last.y_pos)
+                or any(event.index.get(axis) != last.index.get(axis) for axis in ("p", "g")))
+
+    def exec_event(self, event: MDAEvent):
+        if self.eda:
+            return super().exec_event(event)
+        self.played.put(event)
+        return ()
+
+    def _drain(self):
+        while True:
+            event = self.played.get()
+            if event is None:
+                break
+            # The frame can only arrive once everything queued before it has been generated
+            deadline = (time.perf_counter() + self.frame_timeout + self.writer.lead_time +
+                        self.device_group.n_points()/self.settings['ni']['sample_rate'])
+            self.pop_and_emit(event, deadline)
+
+    def on_sequence_end(self, sequence):
+        if self.eda:
+            return super().on_sequence_end(sequence)
+        self.writer.wait_until_played()
+        self.played.put(None)
+        if self.drain_thread is not None:
+            self.drain_thread.join(self.frame_timeout)
+        self.writer.stop()
+        logger.debug(f"DAQ stream {self.writer.stats()}")
+        if self._mmc.isSequenceRunning():
+            self._mmc.stopSequenceAcquisition()
+        # Back to finite generation of one frame for live mode and snaps
+        self.device_group.update_task(self.settings)
+        self.running.clear()
+        if self.previous_exposure != self._mmc.getExposure():
+            self._mmc.setExposure(self.previous_exposure)
+            logger.debug(f"Exposure reset for live to {self.previous_exposure}")
+
+
+class TimedAcquisitionEngine(AcquisitionEngine):
+    """AcquisitionEngine that records how long the phases of every event take.
+
+    timings has one dict per event with the durations in ms of waveform generation, DAQ write,
+    snap, getImage and frameReady dispatch, and the time the frame arrived. Listeners can add their
+    own phases with record_phase, see isim_control.ni.benchmark.
+    """
+    def __init__(self, mmc: CMMCorePlus, device_group: NIDeviceGroup = None,
+                 settings: dict|None = None, verbose: bool = True):
+        super().__init__(mmc, device_group, settings)
+        self.verbose = verbose
+        self.timings = {}
         self.mmc.mda.events.frameReady.connect(self.on_frame)
 
     def on_sequence_end(self, sequence):
-        self.show_timing()
+        if self.verbose:
+            self.show_timing()
         return super().on_sequence_end(sequence)
 
     def setup_sequence(self, sequence):
-        self.frame_times = np.zeros(sequence.sizes['t'])
+        self.timings = {}
         return super().setup_sequence(sequence)
 
+    def setup_event(self, event: MDAEvent):
+        self.timing = {}
+        self.timings[self._key(event)] = self.timing
+        return super().setup_event(event)
+
     def on_frame(self, image, event, meta):
-        self.frame_times[event.index['t']] = time.perf_counter()*1000
+        self.record_phase(event, "frame", time.perf_counter()*1000)
+
+    def record_phase(self, event: MDAEvent, phase: str, value: float):
+        timing = self.timings.get(self._key(event))
+        if timing is not None:
+            timing[phase] = value
+
+    def frame_times(self) -> np.ndarray:
+        return np.array([timing["frame"] for timing in self.timings.values() if "frame" in timing])
+
+    def expected_cycle_time(self) -> float:
+        """Length of the waveform played for one frame in ms, the fastest possible cycle time."""
+        return self.device_group.n_points()/self.settings['ni']['sample_rate']*1000
 
     def show_timing(self):
-        frame_times = self.frame_times[self.frame_times != 0]
+        frame_times = self.frame_times()
+        if len(frame_times) < 2:
+            print("Not enough frames for timing", len(frame_times))
+            return
         mean_offset = np.nanmean(np.diff(frame_times))
         std = np.nanstd(np.diff(frame_times))
         print(round(mean_offset*100)/100, "±", round(std*100)/100, "ms, max",
               max(np.diff(frame_times)), "#", len(frame_times))
-        print("Excpected fastest cycle time: ",
-              self.settings['exposure_time']*1000 + 2*float(self.mmc.getProperty("PrimeB_Camera", "Timing-ReadoutTimeNs"))/1e6 +
-              + 8 + 3)
+        print("Excpected fastest cycle time: ", round(self.expected_cycle_time()*100)/100)
         print()
 
+    @staticmethod
+    def _key(event: MDAEvent) -> tuple:
+        return tuple(sorted(event.index.items()))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+"""Timing benchmark for the acquisition path, runs headless on the demo core and a simulated DAQ.
+
+Every case is run with the TimedAcquisitionEngine, the phase timings of all events are summarized
+with p50/p95/p99 and the achieved cycle time is compared to the length of the waveform for one
+frame. The writer only queues the frames in writer_put, the time to get them on disk after the
+last frame is writer_barrier_ms. Results can be saved as JSON and compared to a previous run:
+
+    python -m isim_control.ni.benchmark --output new.json --baseline old.json --threshold 0.2
+
+The exit code is 1 if a phase or the cycle time got slower than the baseline by more than
+threshold (relative) and tolerance (ms).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import useq
+
+from isim_control.settings import iSIMSettings
+
+PHASES = ("waveform", "daq_write", "arm", "snap", "get_image", "dispatch", "datastore_put",
+          "writer_put")
+PERCENTILES = (50, 95, 99)
+
+CASES = {
+    "single_100ms": {"exposure": 100},
+    "single_20ms": {"exposure": 20},
+    "two_channels": {"exposure": 20, "channels": ("488", "561")},
+    "three_channels": {"exposure": 20, "channels": ("488", "561", "LED")},
+    "z_stack_10": {"exposure": 20, "z_steps": 10},
+    "grid_2x2": {"exposure": 20, "grid": (2, 2)},
+    "twitchers": {"exposure": 50, "twitchers": True},
+}
+
+
+def case_settings(exposure: float = 100, channels: tuple[str] = ("488",), z_steps: int = 0,
+                  grid: tuple[int, int]|None = None, twitchers: bool = False,
+                  loops: int = 10) -> iSIMSettings:
+    settings = iSIMSettings(
+        channels=tuple({"config": channel, "exposure": exposure} for channel in channels),
+        time_plan={"interval": 0, "loops": loops},
+        z_plan={"range": z_steps - 1, "step": 1} if z_steps > 1 else None,
+        grid_plan={"rows": grid[0], "columns": grid[1]} if grid else None,
+        twitchers=twitchers,
+    )
+    settings.calculate_ni_settings(exposure)
+    return settings
+
+
+def timed(engine, function, phase: str):
+    """Wrap a frameReady listener so that its duration is recorded as phase of the event."""
+    def listener(img, event, meta):
+        t0 = time.perf_counter()
+        function(img, event, meta)
+        engine.record_phase(event, phase, (time.perf_counter() - t0)*1000)
+    return listener
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    values = np.asarray(values)
+    stats = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    stats["mean"] = float(values.mean())
+    stats["max"] = float(values.max())
+    stats["n"] = len(values)
+    return stats
+
+
+def summarize(engine) -> dict:
+    timings = list(engine.timings.values())
+    phases = {phase: percentiles([timing[phase] for timing in timings if phase in timing])
+              for phase in PHASES}
+    frame_times = engine.frame_times()
+    cycles = np.diff(frame_times)
+    expected = engine.expected_cycle_time()
+    cycle = percentiles(list(cycles))
+    cycle["theoretical"] = expected
+    if cycles.size:
+        cycle["efficiency"] = expected/float(np.median(cycles))
+    return {"events": len(timings), "frames": len(frame_times),
+            "phases": phases, "cycle_ms": cycle}
+
+
+def run_case(setup: dict, name: str, params: dict, loops: int = 10) -> dict:
+    settings = case_settings(loops=loops, **params)
+    engine = setup["acq_engine"]
+    setup["devices"].update_settings(settings)
+    engine.update_settings(settings)
+    engine.adjust_camera_exposure(settings['camera']['exposure']*1000)
+    sequence = useq.MDASequence(**settings['acquisition'])
+    t0 = time.perf_counter()
+    setup["mmc"].mda.run(sequence)
+    result = summarize(engine)
+    result["params"] = params
+    result["wall_s"] = time.perf_counter() - t0
+    print(f"{name}: {result['frames']} frames, cycle p50 "
+          f"{result['cycle_ms'].get('p50', float('nan')):.2f} ms "
+          f"(theoretical {result['cycle_ms']['theoretical']:.2f} ms)")
+    return result
+
+
+def run_benchmark(cases: dict = CASES, loops: int = 10, writer: bool = True) -> dict:
+    from isim_control.ni.simulated import headless_setup, headless_teardown
+
+    setup = headless_setup(case_settings(), engine="timed")
+    mmc, engine, datastore = setup["mmc"], setup["acq_engine"], setup["datastore"]
+    engine.verbose = False
+    # Time the listeners that would otherwise hide in the dispatch phase
+    mmc.mda.events.frameReady.disconnect(datastore.new_frame)
+    mmc.mda.events.frameReady.connect(timed(engine, datastore.new_frame, "datastore_put"))
+    folder = None
+    if writer:
+        from isim_control.io.ome_tiff_writer import OMETiffWriter
+        folder = tempfile.TemporaryDirectory()
+    results = {}
+    try:
+        for name, params in cases.items():
+            if writer:
+                # Written like the GUI writes them
+                tiff_writer = OMETiffWriter(Path(folder.name)/name,
+                                            streaming=iSIMSettings()["tiff_streaming"])
+                barrier_ms = []
+                def finish(seq, tiff_writer=tiff_writer, barrier_ms=barrier_ms):
+                    # frameReady only queues the frame, the writing is waited for here
+                    t0 = time.perf_counter()
+                    tiff_writer.barrier()
+                    barrier_ms.append((time.perf_counter() - t0)*1000)
+                    tiff_writer.sequenceFinished(seq)
+                mmc.mda.events.sequenceStarted.connect(tiff_writer.sequenceStarted)
+                mmc.mda.events.sequenceFinished.connect(finish)
+                put = timed(engine, tiff_writer.frameReady, "writer_put")
+                mmc.mda.events.frameReady.connect(put)
+            results[name] = run_case(setup, name, params, loops)
+            if writer:
+                mmc.mda.events.sequenceStarted.disconnect(tiff_writer.sequenceStarted)
+                mmc.mda.events.sequenceFinished.disconnect(finish)
+                mmc.mda.events.frameReady.disconnect(put)
+                tiff_writer.close()
+                del tiff_writer
+                results[name]["writer_barrier_ms"] = barrier_ms[0] if barrier_ms else None
+    finally:
+        headless_teardown(setup)
+        if folder:
+            folder.cleanup()
+    return {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "loops": loops,
+                     "python": platform.python_version(), "machine": platform.node()},
+            "cases": results}
+
+
+def compare(results: dict, baseline: dict, threshold: float = 0.2,
+            tolerance: float = 1.0, percentile: str = "p95") -> list[str]:
+    """List of regressions of results against baseline.
+
+    A phase regressed if its percentile got slower by more than threshold (relative) and
+    tolerance (ms), the cycle time is compared at p50 and the writer barrier as it is.
+    """
+    regressions = []
+    def check(case, what, new, old):
+        if new is None or old is None:
+            return
+        if new > old*(1 + threshold) and new - old > tolerance:
+            regressions.append(f"{case} {what}: {old:.2f} -> {new:.2f} ms")
+
+    for case, result in results["cases"].items():
+        old = baseline["cases"].get(case)
+        if old is None:
+            continue
+        for phase, stats in result["phases"].items():
+            check(case, f"{phase} {percentile}", stats.get(percentile),
+                  old["phases"].get(phase, {}).get(percentile))
+        check(case, "cycle p50", result["cycle_ms"].get("p50"), old["cycle_ms"].get("p50"))
+        check(case, "writer barrier", result.get("writer_barrier_ms"),
+              old.get("writer_barrier_ms"))
+    return regressions
+
+
+def main(argv: list[str]|None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--cases", nargs="*", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--loops", type=int, default=10, help="time points per case")
+    parser.add_argument("--output", type=Path, help="save the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="JSON of a previous run to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="allowed slowdown in ms")
+    parser.add_argument("--no-writer", action="store_true", help="don't write OME-TIFFs")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark({name: CASES[name] for name in args.cases}, args.loops,
+                            writer=not args.no_writer)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.threshold,
+                              args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
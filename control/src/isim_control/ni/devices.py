@@ -1,9 +1,13 @@
 
-from typing import Protocol
+from typing import Protocol, Callable, Hashable
+from collections import OrderedDict
+from threading import Lock
 import numpy as np
-from scipy import ndimage
 import useq
 import nidaqmx
+import nidaqmx.stream_writers
+
+from isim_control.ni import waveforms
 
 class DAQDevice(Protocol):
     """A device that can be controlled with data from an NIDAQ card."""
@@ -11,8 +15,12 @@ class DAQDevice(Protocol):
     def set_daq_settings(self, settings: dict) -> None:
         """Set sampling_rate and cycle time."""
 
-    def one_frame(self, settings: dict) -> np.ndarray:
-        """Return one frame that fits to the settings passed in."""
+    def one_frame(self, settings: dict, out: np.ndarray|None = None) -> np.ndarray:
+        """Return one frame that fits to the settings passed in.
+
+        If out is given, the frame is written into it (cut to the length of out) and out is
+        returned instead of a new array.
+        """
 
     def plot(self):
         """Plot the daq_data for one frame with matplotlib."""
@@ -23,8 +31,53 @@ class DAQDevice(Protocol):
             plt.step(x, daq_data[channel,:])
 
 
+class WaveformCache:
+    """Small LRU cache for waveform rows that only depend on a few settings.
+
+    Rows are stored read-only, so they can be handed out without copying. get_data copies them into
+    the output buffer of the NIDeviceGroup. Entries can be replaced from another thread (see
+    NIDeviceGroup.patch_power) while live is reading.
+    """
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self._rows = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, factory: Callable[[], np.ndarray]) -> np.ndarray:
+        with self._lock:
+            rows = self._rows.get(key)
+            if rows is not None:
+                self.hits += 1
+                self._rows.move_to_end(key)
+                return rows
+        self.misses += 1
+        return self.put(key, factory())
+
+    def peek(self, key: Hashable) -> np.ndarray|None:
+        with self._lock:
+            return self._rows.get(key)
+
+    def put(self, key: Hashable, rows: np.ndarray) -> np.ndarray:
+        rows.flags.writeable = False
+        with self._lock:
+            self._rows[key] = rows
+            self._rows.move_to_end(key)
+            if len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+        return rows
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+    def __len__(self):
+        return len(self._rows)
+
+
 class NIDeviceGroup():
-    def __init__(self, settings: dict = None):
+    def __init__(self, settings: dict = None, simulated: bool = False):
         self.galvo = Galvo()
         self.camera = Camera()
         self.aotf = AOTF()
@@ -32,27 +85,141 @@ class NIDeviceGroup():
         self.stage = Stage()
         self.led = LED()
         self.settings = settings or {}
+        # Galvo, camera and twitcher only depend on the timing, AOTF and LED on channel and power
+        self.static_cache = WaveformCache(maxsize=4)
+        self.channel_cache = WaveformCache(maxsize=16)
+        # Rendering the channel rows sets state on the LED, patch_power runs in another thread
+        self._render_lock = Lock()
+        # Output buffer that is handed to the stream writer, rows are filled in place per event
+        self.buffer = None
+        self.program = None
+        self.simulated = simulated
         self.task, self.stream = self.make_task(settings)
+        # (sample_rate, samps_per_chan) the task is configured for, see update_task
+        self.task_timing = None
 
     def get_data(self, event: useq.MDAEvent, next_event: useq.MDAEvent|None = None, live=False):
-        galvo = self.galvo.one_frame(self.settings['ni'])[:-self.settings['ni']['readout_points']//3]
+        """Fill the output buffer for this event and return it.
+
+        The same array is returned on every call, it is only valid until the next call.
+        """
         try:
             z_relative = True if self.settings['acquisition']['z_plan'].get('top', False) and not live else False
         except AttributeError:
             z_relative = False
-        stage = self.stage.one_frame(self.settings['ni'], event, next_event, z_relative)[:-self.settings['ni']['readout_points']//3]
-        camera = self.camera.one_frame(self.settings['ni'])[:-self.settings['ni']['readout_points']//3]
-        aotf = self.aotf.one_frame(self.settings, event, live)[:, :-self.settings['ni']['readout_points']//3]
-        led = self.led.one_frame(self.settings, event, live)[:, :-self.settings['ni']['readout_points']//3]
         twitchers = self.settings['ni']['twitchers'] if not live else self.settings['live']['twitchers']
+        static = self.static_rows(twitchers)
+        channel = self.channel_rows(event, live)
+        buffer = self.get_buffer()
+        buffer[0] = static[0]
+        self.stage.one_frame(self.settings['ni'], event, next_event, z_relative, out=buffer[1])
+        buffer[2] = static[1]
+        buffer[3:7] = channel
+        buffer[7] = static[2]
+        # led[0, -1:] = np.ones(1)*6
+        return buffer
+
+    def get_sequence_data(self, events: list[useq.MDAEvent],
+                          next_event: useq.MDAEvent|None = None, live=False) -> np.ndarray:
+        """Concatenate the frames for all events into one program that is played in one go.
+
+        next_event is the first event after the block, the stage moves there during the last
+        readout. Like get_data, the returned array is reused for the next program.
+        """
+        n_points = self.n_points()
+        program = self.get_program_buffer(len(events)*n_points)
+        for idx, event in enumerate(events):
+            following = events[idx + 1] if idx + 1 < len(events) else next_event
+            program[:, idx*n_points:(idx + 1)*n_points] = self.get_data(event, following, live)
+        return program
+
+    def n_points(self) -> int:
+        """Number of samples per channel that are written for one frame."""
+        ni = self.settings['ni']
+        return ni['total_points'] + ni['readout_points'] + (-ni['readout_points']//3)
+
+    def get_buffer(self) -> np.ndarray:
+        """The 8xN output buffer, only reallocated if the number of samples changed."""
+        n_points = self.n_points()
+        if self.buffer is None or self.buffer.shape[1] != n_points:
+            self.buffer = np.zeros((8, n_points), dtype=np.float64, order='C')
+        return self.buffer
+
+    def get_program_buffer(self, n_points: int) -> np.ndarray:
+        """8xN buffer for a whole block of events, see get_sequence_data."""
+        if self.program is None or self.program.shape[1] != n_points:
+            self.program = np.zeros((8, n_points), dtype=np.float64, order='C')
+        return self.program
+
+    def static_rows(self, twitchers: bool) -> np.ndarray:
+        """Galvo, camera and twitcher rows, these don't change between events."""
+        ni = self.settings['ni']
+        key = (ni['sample_rate'], ni['exposure_points'], ni['readout_points'], bool(twitchers))
+        return self.static_cache.get(key, lambda: self._make_static_rows(twitchers))
+
+    def channel_rows(self, event: useq.MDAEvent, live: bool = False) -> np.ndarray:
+        """AOTF (blank, 488, 561) and LED rows for the channel of the event."""
+        powers = self.settings['live']['ni']['laser_powers'] if live else self.settings['ni']['laser_powers']
+        channel = event.channel.config if event.channel else None
+        key = self._channel_key(channel, powers.get(str(channel).lower()))
+        return self.channel_cache.get(key, lambda: self._make_channel_rows(event, live))
+
+    def patch_power(self, channel: str, old_power: float, live: bool = False) -> bool:
+        """Update the cached rows of a channel after its power changed.
+
+        Only the row of that line is rendered again, the others are copied from the rows for the
+        old power. get_data picks the new rows up with the next frame, so a running live loop does
+        not have to be stopped. Returns False if there was nothing cached to patch.
+        """
+        powers = self.settings['live']['ni']['laser_powers'] if live else self.settings['ni']['laser_powers']
+        channel = str(channel).lower()
+        config = "LED" if channel == "led" else channel
+        old_rows = self.channel_cache.peek(self._channel_key(config, old_power))
+        if old_rows is None:
+            return False
+        rows = old_rows.copy()
+        with self._render_lock:
+            if channel == "led":
+                self.led.one_frame(self.settings, useq.MDAEvent(channel=config), live,
+                                   out=rows[3:])
+            else:
+                row = {"488": 1, "561": 2}[channel]
+                waveforms.render(self.aotf.segments(self.settings['ni'], powers[channel]/10),
+                                 out=rows[row])
+        self.channel_cache.put(self._channel_key(config, powers[channel]), rows)
+        return True
+
+    def _channel_key(self, channel: str|None, power: float|None) -> tuple:
+        ni = self.settings['ni']
+        return (channel, power, ni['sample_rate'], ni['exposure_points'], ni['readout_points'],
+                ni['total_points'])
+
+    def clear_cache(self):
+        """Has to be called if the parameters of one of the devices are changed."""
+        self.static_cache.clear()
+        self.channel_cache.clear()
+
+    def _make_static_rows(self, twitchers: bool) -> np.ndarray:
+        rows = np.empty((3, self.n_points()))
+        self.galvo.one_frame(self.settings['ni'], out=rows[0])
+        self.camera.one_frame(self.settings['ni'], out=rows[1])
         if twitchers:
-            twitcher = self.twitcher.one_frame(self.settings['ni'])[:-self.settings['ni']['readout_points']//3]
+            self.twitcher.one_frame(self.settings['ni'], out=rows[2])
         else:
-            twitcher = np.ones(galvo.shape)*5
-        # led[0, -1:] = np.ones(1)*6
-        return np.vstack([galvo, stage, camera, aotf, led, twitcher])
+            rows[2] = 5
+        return rows
+
+    def _make_channel_rows(self, event: useq.MDAEvent, live: bool = False) -> np.ndarray:
+        rows = np.empty((4, self.n_points()))
+        with self._render_lock:
+            self.aotf.one_frame(self.settings, event, live, out=rows[:3])
+            self.led.one_frame(self.settings, event, live, out=rows[3:])
+        return rows
 
     def make_task(self, settings):
+        if self.simulated:
+            from isim_control.ni.simulated import make_simulated_task
+            return make_simulated_task(settings)
         task = nidaqmx.Task()
         task.ao_channels.add_ao_voltage_chan('Dev1/ao0') # galvo channel
         task.ao_channels.add_ao_voltage_chan('Dev1/ao1') # z stage
@@ -74,10 +241,27 @@ class NIDeviceGroup():
         self.settings = settings
         self.update_task(settings)
 
-    def update_task(self, settings):
+    def update_task(self, settings, n_points: int|None = None):
+        """Set the timing of the task, by default for one frame.
+
+        Pass n_points to prepare the task for a longer program, see get_sequence_data.
+        """
+        if n_points is None:
+            n_points = settings['ni']['total_points'] + settings['ni']['readout_points']//3*2
+        timing = (self.settings['ni']['sample_rate'], n_points)
+        if timing == self.task_timing:
+            return
         self.task.timing.cfg_samp_clk_timing(rate=self.settings['ni']['sample_rate'],
-                                samps_per_chan=settings['ni']['total_points'] +
-                                settings['ni']['readout_points']//3*2,)
+                                samps_per_chan=n_points,)
+        self.task_timing = timing
+
+
+def fill_out(frame: np.ndarray, out: np.ndarray|None) -> np.ndarray:
+    """Copy frame into out if given, cutting it to the length of out."""
+    if out is None:
+        return frame
+    out[...] = frame[..., :out.shape[-1]]
+    return out
 
 
 def makePulse(start, end, offset, n_points):
@@ -94,47 +278,44 @@ class Galvo(DAQDevice):
         self.offset = -0.075  # -0.15
         self.amp = 0.2346  # 0.2346
 
-    def one_frame(self, settings: dict) -> np.ndarray:
+    def one_frame(self, settings: dict, out: np.ndarray|None = None) -> np.ndarray:
         #TODO: Sweeps per frame not possible anymore!
+        return waveforms.render(self.segments(settings), out)
+
+    def segments(self, settings: dict) -> list[tuple]:
+        """Readout ramp to the start, scan with overshoot on both sides, readout ramp back."""
         readout_length = settings['readout_points']
         n_points = settings['exposure_points']
-
-        galvo_frame = np.linspace(-self.amp, self.amp, n_points)
         overshoot_points = int(np.ceil(round(readout_length/20)/2))
-        scan_increment = galvo_frame[-1] - galvo_frame[-2]
+        scan_increment = 2*self.amp/max(n_points - 1, 1)
         self.overshoot_amp =  scan_increment * (overshoot_points + 1)
-        overshoot_0 = np.linspace(-self.amp - self.overshoot_amp, -self.amp - scan_increment,
-                                  overshoot_points)
-        overshoot_1 = np.linspace(self.amp + scan_increment, self.amp + self.overshoot_amp,
-                                  overshoot_points)
-        galvo_frame = np.hstack((overshoot_0, galvo_frame, overshoot_1)) + self.offset
-        galvo_frame = self.add_readout(galvo_frame, readout_length)
-        return galvo_frame
-
-    def add_readout(self, frame, readout_length):
-        readout_length = readout_length - int(np.ceil(round(readout_length/20)/2))
-        readout_delay0 = np.linspace(self.offset, -self.amp+self.offset-self.overshoot_amp,
-                                     int(np.floor(readout_length*0.9)))
-        readout_delay0 = np.hstack([readout_delay0,
-                                    np.ones(int(np.ceil(readout_length*0.1)))*readout_delay0[-1]])
-        readout_delay1 = np.linspace(self.offset + self.amp + self.overshoot_amp, self.offset,
-                                     int(np.floor(readout_length*0.5)))
-        readout_delay11 = np.ones(int(np.ceil(readout_length*0.5)))*self.offset
-        return np.hstack([readout_delay0, frame, readout_delay1, readout_delay11])
+        start = -self.amp - self.overshoot_amp + self.offset
+        stop = self.amp + self.overshoot_amp + self.offset
+        readout_length = readout_length - overshoot_points
+        return [
+            waveforms.ramp(np.floor(readout_length*0.9), self.offset, start),
+            waveforms.hold(np.ceil(readout_length*0.1), start),
+            waveforms.ramp(overshoot_points, start, -self.amp - scan_increment + self.offset),
+            waveforms.ramp(n_points, -self.amp + self.offset, self.amp + self.offset),
+            waveforms.ramp(overshoot_points, self.amp + scan_increment + self.offset, stop),
+            waveforms.ramp(np.floor(readout_length*0.5), stop, self.offset),
+            waveforms.hold(np.ceil(readout_length*0.5), self.offset),
+        ]
 
 
 class Camera(DAQDevice):
         def __init__(self):
             self.pulse_voltage = 5
 
-        def one_frame(self, settings: dict) -> np.ndarray:
-            camera_frame = makePulse(self.pulse_voltage, 0, 0, settings['exposure_points'])
-            camera_frame = self.add_readout(camera_frame, settings['readout_points'])
-            return camera_frame
+        def one_frame(self, settings: dict, out: np.ndarray|None = None) -> np.ndarray:
+            return waveforms.render(self.segments(settings), out)
 
-        def add_readout(self, frame, readout_points):
-            readout_delay = np.zeros(readout_points)
-            return np.hstack([frame, readout_delay, readout_delay])
+        def segments(self, settings: dict) -> list[tuple]:
+            """Short trigger pulse at the start of the exposure, like makePulse."""
+            n_points = settings['exposure_points']
+            n_up = round(10/n_points*n_points)
+            return [waveforms.hold(n_up, self.pulse_voltage),
+                    waveforms.hold(n_points - n_up + 2*settings['readout_points'], 0)]
 
 
 class Twitcher(DAQDevice):
@@ -144,60 +325,76 @@ class Twitcher(DAQDevice):
         # self.freq = 2400  # Full cycle Hz
         self.n_waves = 240
         self.offset = 5
+        self._frame = np.empty(0)
+        self._smoothed = np.empty(0)
 
-    def one_frame(self, settings: dict) -> np.ndarray:
+    def one_frame(self, settings: dict, out: np.ndarray|None = None) -> np.ndarray:
         # wavelength = 1/self.freq*settings["sample_rate"]  # seconds
         # n_waves = (settings['exposure_points'])/wavelength
 
         points_per_wave = int(np.ceil(settings['exposure_points']/self.n_waves))
-        up = np.linspace(-1, 1, points_per_wave//2 + 1)
-        down = np.linspace(1, -1, points_per_wave//2 + 1)
-        start = np.linspace(0, -1, points_per_wave//4 + 1)
-        end = np.linspace(-1, 0, points_per_wave//4 + 1)
-        frame = np.hstack((start[:-1], np.tile(np.hstack((up[:-1], down[:-1])),
-                                               round(self.n_waves + 20)), end))
-        missing_points = settings['total_points'] + settings['readout_points'] - frame.shape[0]
-        frame = np.hstack([np.ones(int(np.floor(missing_points/2)))*frame[0],
-                           frame,
-                           np.ones(int(np.ceil(missing_points/2)))*frame[-1]])
-
-        frame = ndimage.gaussian_filter1d(frame, points_per_wave/20)
-        frame = frame*(self.amp/frame.max()) + self.offset
-        return frame
+        quarter = points_per_wave//4
+        half = points_per_wave//2
+        n_frame = settings['total_points'] + settings['readout_points']
+        missing_points = n_frame - (quarter + 2*half*round(self.n_waves + 20) + quarter + 1)
+        n_before = int(np.floor(missing_points/2))
+        if self._frame.shape[0] != n_frame:
+            self._frame = np.empty(n_frame)
+        frame = self._frame
+        # Hold, ramp down into the triangle train, ramp back up to 0 and hold
+        edge = 0 if quarter else -1
+        n_start = n_before + quarter
+        n_train = 2*half*round(self.n_waves + 20)
+        waveforms.render([waveforms.hold(n_before, edge),
+                          waveforms.ramp(quarter, 0, -1 + 1/max(quarter, 1))], out=frame[:n_start])
+        waveforms.triangle_train(round(self.n_waves + 20), half,
+                                 out=frame[n_start:n_start + n_train])
+        waveforms.render([waveforms.ramp(quarter + 1, -1, 0),
+                          waveforms.hold(np.ceil(missing_points/2), edge)],
+                         out=frame[n_start + n_train:])
+
+        # Only the ends of the train have to be filtered, the rest is the same for every period
+        self._smoothed = waveforms.smooth_periodic(frame, points_per_wave/20, n_start,
+                                                   n_start + n_train, 2*half,
+                                                   out=self._smoothed if
+                                                   self._smoothed.shape == frame.shape else None)
+        if out is None:
+            out = np.empty(n_frame)
+        out[...] = self._smoothed[:out.shape[-1]]
+        out *= self.amp/self._smoothed.max()
+        out += self.offset
+        return out
 
 
 class AOTF(DAQDevice):
     def __init__(self):
         self.blank_voltage = 10
 
-    def one_frame(self, settings: dict, event:useq.MDAEvent, live=False) -> np.ndarray:
+    def one_frame(self, settings: dict, event:useq.MDAEvent, live=False,
+                  out: np.ndarray|None = None) -> np.ndarray:
         if live:
             laser_powers = settings['live']['ni']['laser_powers']
         else:
             laser_powers = settings['ni']['laser_powers']
             # settings['ni']['laser_powers'] = settings['live']['ni']['laser_powers']
         settings = settings['ni']
-        n_points = settings['exposure_points']
-
-        blank = np.ones(n_points) * self.blank_voltage
+        if out is None:
+            out = np.empty((3, settings['exposure_points'] + 2*settings['readout_points']))
         if event.channel.config == '488':
-            aotf_488 = np.ones(n_points) * laser_powers['488']/10
-            aotf_561 = np.zeros(n_points)
+            levels = (self.blank_voltage, laser_powers['488']/10, 0)
         elif event.channel.config == '561':
-            aotf_488 = np.zeros(n_points)
-            aotf_561 = np.ones(n_points) * laser_powers['561']/10
+            levels = (self.blank_voltage, 0, laser_powers['561']/10)
         else:
-            aotf_488 = np.zeros(n_points)
-            aotf_561 = np.zeros(n_points)
-            blank = np.zeros(n_points)
-        aotf = np.vstack((blank, aotf_488, aotf_561))
-        aotf = self.add_readout(aotf, settings['readout_points'])
-        return aotf
-
-    def add_readout(self, frame: np.ndarray, readout_points: int) -> np.ndarray:
-        readout_delay = np.zeros((frame.shape[0], readout_points))
-        frame = np.hstack([readout_delay, frame,  readout_delay])
-        return frame
+            levels = (0, 0, 0)
+        for row, level in zip(out, levels):
+            waveforms.render(self.segments(settings, level), out=row)
+        return out
+
+    def segments(self, settings: dict, level: float) -> list[tuple]:
+        """On for the exposure, off during the readout on both sides."""
+        return [waveforms.hold(settings['readout_points'], 0),
+                waveforms.hold(settings['exposure_points'], level),
+                waveforms.hold(settings['readout_points'], 0)]
 
 
 class Stage(DAQDevice):
@@ -207,11 +404,18 @@ class Stage(DAQDevice):
         self.max_v = 10
 
     def one_frame(self, settings: dict, event: useq.MDAEvent,
-                  next_event: useq.MDAEvent|None = None, relative: bool = False) -> np.ndarray:
+                  next_event: useq.MDAEvent|None = None, relative: bool = False,
+                  out: np.ndarray|None = None) -> np.ndarray:
         height_offset = 0 if event.z_pos is None else event.z_pos
         if relative:
             height_offset = settings['relative_z'] if event.z_pos is None else (event.z_pos - settings['relative_z'])
         height_offset = self.convert_z(height_offset)
+        if out is not None:
+            # Only two levels, so fill the buffer directly without building the frame
+            n_current = settings['readout_points'] + settings['exposure_points']
+            out[:n_current] = height_offset
+            out[n_current:] = self.next_height(height_offset, settings, next_event, relative)
+            return out
         stage_frame = (np.ones(settings['readout_points'] + settings['exposure_points']) *
                        height_offset)
         stage_frame = self.add_readout(stage_frame, settings, next_event, relative)
@@ -220,16 +424,19 @@ class Stage(DAQDevice):
     def convert_z(self, z_um):
         return (z_um/self.calibration) * self.max_v
 
+    def next_height(self, height: float, settings: dict, next_event: useq.MDAEvent|None,
+                    relative: bool|float = False) -> float:
+        """Voltage to move to during readout, to be ready for the next event."""
+        if next_event is None or next_event.z_pos is None:
+            return self.convert_z(height)
+        if relative:
+            return self.convert_z(next_event.z_pos - settings['relative_z'])
+        return self.convert_z(next_event.z_pos)
+
     def add_readout(self, frame, settings, next_event:useq.MDAEvent|None,
                     relative: bool|float = False):
-        if next_event is None or next_event.z_pos is None:
-            height_offset = frame[-1]
-        else:
-            if relative:
-                height_offset = next_event.z_pos - settings['relative_z']
-            else:
-                height_offset = next_event.z_pos
-        readout_delay = np.ones(settings['readout_points'])*self.convert_z(height_offset)
+        height = self.next_height(frame[-1], settings, next_event, relative)
+        readout_delay = np.ones(settings['readout_points'])*height
         frame = np.hstack([frame, readout_delay])
         return frame
 
@@ -240,7 +447,8 @@ class LED(DAQDevice):
         self.speed_adjustment = 1.002
         self.low_power_adj = {0: 1, 1: 1, 2: 1, 3: 0.86, 4: 0.95, 5: 0.97, 6: 0.978}
 
-    def one_frame(self, settings: dict, event:useq.MDAEvent, live=False) -> np.ndarray:
+    def one_frame(self, settings: dict, event:useq.MDAEvent, live=False,
+                  out: np.ndarray|None = None) -> np.ndarray:
         if live:
             power = settings['live']['ni']['laser_powers']['led']
         else:
@@ -254,24 +462,24 @@ class LED(DAQDevice):
             speed_adjust = 1.002
         settings = settings['ni']
         if event.channel.config.lower() != 'led':
+            if out is not None:
+                out[...] = 0
+                return out
             return np.expand_dims(np.zeros(settings['total_points'] +
                                            settings['readout_points']), 0)
         self.adjusted_readout = (settings['readout_points'] / settings['sample_rate']
                                  * speed_adjust)
-        n_points = (settings['total_points'] -
-                    round(self.adjusted_readout * settings['sample_rate']))
-        led = np.ones(n_points) * power/10
-        led = np.expand_dims(led, 0)
-        led = self.add_readout(led, settings)
-        return led
-
-    def add_readout(self, frame:np.ndarray, settings: dict) -> np.ndarray:
-        n_shift = (round(settings['readout_points']) -
-                   round(settings['sample_rate'] * self.adjusted_readout))
-        readout_delay0 = np.zeros((frame.shape[0], settings['readout_points'] - n_shift))
-        readout_delay1 = np.zeros((frame.shape[0], settings["readout_points"]))
-        frame = np.hstack([readout_delay0, frame, readout_delay1])
-        return frame
+        if out is None:
+            out = np.empty((1, settings['total_points'] + settings['readout_points']))
+        return waveforms.render(self.segments(settings, power), out=out)
+
+    def segments(self, settings: dict, power: float) -> list[tuple]:
+        """On for the exposure, shifted so that the rolling readout of the camera is covered."""
+        n_adjusted = round(self.adjusted_readout * settings['sample_rate'])
+        n_shift = round(settings['readout_points']) - n_adjusted
+        return [waveforms.hold(settings['readout_points'] - n_shift, 0),
+                waveforms.hold(settings['total_points'] - n_adjusted, power/10),
+                waveforms.hold(settings['readout_points'], 0)]
 
 
 def main(settings: dict = None, data: np.ndarray = None):
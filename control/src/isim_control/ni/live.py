@@ -1,15 +1,23 @@
 import numpy as np
 import nidaqmx
-import nidaqmx
+import nidaqmx.errors
+import nidaqmx.stream_writers
 from pymmcore_plus import CMMCorePlus
 from threading import Timer
 import time
 from isim_control.ni.devices import NIDeviceGroup
+from isim_control.ni.snap_worker import SnapWorker, SnapSlot
 from useq import MDAEvent
 from threading import Thread, Lock, Event
+from typing import Callable
 import logging
+import queue
 
 CONTINUOUS = nidaqmx.constants.AcquisitionType.CONTINUOUS
+ALLOW_REGENERATION = nidaqmx.constants.RegenerationMode.ALLOW_REGENERATION
+NO_REGENERATION = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION
+FIRST_SAMPLE = nidaqmx.constants.WriteRelativeTo.FIRST_SAMPLE
+CURRENT_WRITE_POSITION = nidaqmx.constants.WriteRelativeTo.CURRENT_WRITE_POSITION
 
 class LiveEngine():
     def __init__(self,
@@ -22,6 +30,7 @@ class LiveEngine():
         self.fps = 5
         self.timer = None
         self.devices = device_group
+        self.snapper = SnapWorker(self._mmc, n_slots=2, name="live_snap")
 
         if task is None:
             self.task = nidaqmx.Task()
@@ -38,11 +47,19 @@ class LiveEngine():
                                                  settings['ni']['readout_points']//3*2)
         else:
             self.task = task
+        if self.devices is not None and self.task is self.devices.task:
+            self.stream = self.devices.stream
+        else:
+            self.stream = nidaqmx.stream_writers.AnalogMultiChannelWriter(self.task.out_stream,
+                                                                          auto_start=False)
 
+    def make_timer(self, interval: float):
+        return LiveTimer(interval, self.settings, self.task, self.devices, self._mmc,
+                         stream=self.stream, snapper=self.snapper)
 
     def _on_sequence_started(self):
         "STARTING LIVE"
-        self.timer = LiveTimer(1/self.fps, self.settings, self.task, self.devices, self._mmc)
+        self.timer = self.make_timer(1/self.fps)
         self.timer.start()
         logging.debug("Live started from LiveEngine")
 
@@ -65,18 +82,23 @@ class LiveEngine():
                 return
             self.timer = None
             #print("Now restarting")
-            self.timer = LiveTimer(0, self.settings, self.task, self.devices, self._mmc)
+            self.timer = self.make_timer(0)
             self.timer.start()
 
     def snap(self):
         if self.timer:
             return
         self.timer = LiveTimer(1/self.fps, self.settings, self.task, self.devices, self._mmc,
-                                snap_mode=True)
+                                snap_mode=True, stream=self.stream, snapper=self.snapper)
         self.timer.stop_event.set()
         self.timer.start()
         self.timer = None
 
+    def between_frames(self, function: Callable[[], None]):
+        """Apply a settings change between two live frames, without stopping live."""
+        if self.timer is None or not self.timer.call_between_frames(function):
+            function()
+
     def update_settings(self, settings):
         self.settings = settings['live']
         if self.timer:
@@ -85,63 +107,92 @@ class LiveEngine():
         self.fps = self.settings['fps']
 
 
-class LiveTimer(Timer):
+class BetweenFrames:
+    """Settings changes that are run by the live thread between two frames.
+
+    Needs pending, pending_lock and running on the class that uses it.
+    """
+    def call_between_frames(self, function: Callable[[], None]) -> bool:
+        """Run function in the live thread before the next frame is written.
+
+        Returns False if the timer is not running anymore, the caller has to run it then.
+        """
+        with self.pending_lock:
+            if not self.running:
+                return False
+            self.pending.put(function)
+            return True
+
+    def run_pending(self):
+        while True:
+            try:
+                function = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                function()
+            except Exception as e:
+                logging.error(f"Settings update in live failed: {e}")
+
+
+class LiveTimer(BetweenFrames, Timer):
     def __init__(self, interval:float, settings: dict, task: nidaqmx.Task, devices: NIDeviceGroup,
-                 mmcore: CMMCorePlus, snap_mode=False):
+                 mmcore: CMMCorePlus, snap_mode=False,
+                 stream: nidaqmx.stream_writers.AnalogMultiChannelWriter|None = None,
+                 snapper: SnapWorker|None = None):
         super().__init__(interval, None)
         self.settings = settings
         self.task = task
+        self.stream = stream or nidaqmx.stream_writers.AnalogMultiChannelWriter(task.out_stream,
+                                                                                auto_start=False)
         self.devices = devices
         self._mmc = mmcore
         self.snap_mode = snap_mode
+        self.snapper = snapper or SnapWorker(mmcore, n_slots=2, name="live_snap")
         self.running = False
-        self.snapping = False
 
-        self.snap_lock = Lock()
         self.stop_event = Event()
-        self.snapping = Event()
+        self.pending = queue.SimpleQueue()
+        self.pending_lock = Lock()
 
     def run(self):
         self.running = True
-        thread = None
+        slot = None
         while not self.finished.wait(self.interval):
             if self.stop_event.is_set() and not self.snap_mode:
                 break
-            thread = Thread(target=self.snap_and_get)
-            self.snap_lock.acquire()
-            thread.start()
-            self.task.write(self.one_frame())
+            # The previous snap has to be done before the camera is armed again, and before
+            # settings changes touch the camera exposure or the DAQ rows
+            if slot is not None:
+                slot.triggered.wait()
+                if slot.error is not None:
+                    self.request_cancel()
+                    break
+            self.run_pending()
+            slot = self.snapper.submit(MDAEvent(channel=self.settings['channel']), self.emit)
+            self.stream.write_many_sample(self.one_frame())
             # logging.debug("NI task written")
-            self.snap_lock.acquire()
+            slot.armed.wait()
             self.task.start()
             # logging.debug("NI task started, trigger sent to camera")
             self.task.wait_until_done()
             self.task.stop()
             if self.stop_event.is_set():
                 break
-        #print("Waiting for THREAD")
-        if thread:
-            thread.join(0.2)
         # We resend the data in case the camera has not finished and needs an additional trigger
-        while self.snapping.is_set():
-            self.task.write(self.one_frame(clean_up=True))
+        if slot is not None:
+            slot.triggered.wait(0.2)
+        while slot is not None and not slot.triggered.is_set():
+            self.stream.write_many_sample(self.one_frame(clean_up=True))
             self.task.start()
             self.task.wait_until_done()
             self.task.stop()
-        self.running = False
+        with self.pending_lock:
+            self.running = False
+        self.run_pending()
 
-    def snap_and_get(self):
-        self.snap_lock.release()
-        try:
-            self.snapping.set()
-            self._mmc.snapImage()
-            self.snapping.clear()
-            self._mmc.events.liveFrameReady.emit(self._mmc.getImage(fix=False),
-                                                 MDAEvent(channel=self.settings['channel']),
-                                                 self._mmc.getTags())
-        except Exception as e:
-            self.request_cancel()
-        self.snap_lock.release()
+    def emit(self, slot: SnapSlot):
+        self._mmc.events.liveFrameReady.emit(slot.image, slot.event, slot.meta)
 
     def request_cancel(self):
         self.stop_event.set()
@@ -149,14 +200,146 @@ class LiveTimer(Timer):
     def one_frame(self, clean_up=False):
         event = MDAEvent(channel={'config':self.settings['channel']})
         next_event = event
+        # This is the output buffer of the device group, it is rewritten for every frame
         ni_data = self.devices.get_data(event, next_event, live=True)
         if not clean_up:
             return ni_data
-        ni_data[-2, :] = np.zeros(ni_data.shape[1])
-        ni_data[3, :] = np.zeros(ni_data.shape[1])
+        ni_data[-2, :] = 0
+        ni_data[3, :] = 0
         return ni_data
 
 
+class ContinuousLiveEngine(LiveEngine):
+    """Live with the camera in sequence acquisition and the DAQ regenerating one frame.
+
+    The frame rate is only limited by exposure and readout, see ContinuousLiveTimer. Snaps still
+    use the LiveTimer.
+    """
+    def make_timer(self, interval: float):
+        return ContinuousLiveTimer(self.settings, self.task, self.devices, self._mmc,
+                                   stream=self.stream)
+
+
+class ContinuousLiveTimer(BetweenFrames, Thread):
+    """Plays the live waveform continuously and sends out the newest frame of the camera buffer.
+
+    The waveform is written once to the regenerating task. The generation is only restarted if
+    channel, twitchers or timing change. New powers are written over the buffer of the running
+    task, with the rows that the runner patched with patch_power. Settings changes that need the camera (exposure) are run between frames with
+    camera and task stopped, like for the LiveTimer. Has the parts of the LiveTimer interface that
+    LiveEngine and iSIMRunner use.
+    """
+    def __init__(self, settings: dict, task: nidaqmx.Task, devices: NIDeviceGroup,
+                 mmcore: CMMCorePlus,
+                 stream: nidaqmx.stream_writers.AnalogMultiChannelWriter|None = None,
+                 poll_time: float = 0.001):
+        super().__init__(name="continuous_live", daemon=True)
+        self.settings = settings
+        self.task = task
+        self.stream = stream or nidaqmx.stream_writers.AnalogMultiChannelWriter(task.out_stream,
+                                                                                auto_start=False)
+        self.devices = devices
+        self._mmc = mmcore
+        self.poll_time = poll_time
+        self.interval = 0  # Not used, the camera sets the pace
+        self.running = False
+        self.stop_event = Event()
+        self.pending = queue.SimpleQueue()
+        self.pending_lock = Lock()
+        self.frames = 0
+        self._waveform_key = None
+        self._power_key = None
+
+    def request_cancel(self):
+        self.stop_event.set()
+
+    def run(self):
+        self.running = True
+        try:
+            self._start_generation()
+            self._mmc.startContinuousSequenceAcquisition(0)
+            while not self.stop_event.is_set():
+                if not self.pending.empty():
+                    self._apply_pending()
+                elif self.waveform_key() != self._waveform_key:
+                    self._stop_generation()
+                    self._start_generation()
+                elif self.power_key() != self._power_key:
+                    self._rewrite_buffer()
+                if not self._emit_newest():
+                    time.sleep(self.poll_time)
+        except Exception as e:
+            logging.error(f"Continuous live failed: {e}")
+        finally:
+            self._mmc.stopSequenceAcquisition()
+            self._stop_generation()
+            self.task.out_stream.regen_mode = NO_REGENERATION
+            self.devices.update_task(self.devices.settings)
+            with self.pending_lock:
+                self.running = False
+            self.run_pending()
+
+    def waveform_key(self) -> tuple:
+        """What the generation is restarted for, everything but the powers."""
+        ni = self.devices.settings['ni']
+        return (self.settings['channel'], self.devices.settings['live']['twitchers'],
+                ni['sample_rate'], ni['total_points'], ni['readout_points'])
+
+    def power_key(self) -> tuple:
+        return tuple(sorted(self.devices.settings['live']['ni']['laser_powers'].items()))
+
+    def _start_generation(self):
+        event = MDAEvent(channel={'config': self.settings['channel']})
+        self._waveform_key = self.waveform_key()
+        self._power_key = self.power_key()
+        frame = self.devices.get_data(event, event, live=True)
+        self.task.timing.cfg_samp_clk_timing(rate=self.devices.settings['ni']['sample_rate'],
+                                             sample_mode=CONTINUOUS,
+                                             samps_per_chan=frame.shape[1])
+        self.task.out_stream.regen_mode = ALLOW_REGENERATION
+        self.devices.task_timing = None
+        self.stream.write_many_sample(frame)
+        self.task.start()
+
+    def _rewrite_buffer(self):
+        """Write the frame with the new powers over the whole buffer, the task keeps running."""
+        event = MDAEvent(channel={'config': self.settings['channel']})
+        self._power_key = self.power_key()
+        frame = self.devices.get_data(event, event, live=True)
+        out_stream = self.task.out_stream
+        out_stream.relative_to = FIRST_SAMPLE
+        out_stream.offset = 0
+        try:
+            self.stream.write_many_sample(frame)
+        finally:
+            out_stream.relative_to = CURRENT_WRITE_POSITION
+
+    def _stop_generation(self):
+        try:
+            self.task.stop()
+        except nidaqmx.errors.DaqError as e:
+            logging.warning(f"Stopping live task: {e}")
+
+    def _apply_pending(self):
+        self._mmc.stopSequenceAcquisition()
+        self._stop_generation()
+        self.run_pending()
+        self._start_generation()
+        self._mmc.startContinuousSequenceAcquisition(0)
+
+    def _emit_newest(self) -> bool:
+        """Send out the newest image, older ones are dropped. False if there was none."""
+        if self._mmc.getRemainingImageCount() == 0:
+            return False
+        while self._mmc.getRemainingImageCount() > 1:
+            self._mmc.popNextImage()
+        img, md = self._mmc.popNextImageAndMD(fix=False)
+        self.frames += 1
+        self._mmc.events.liveFrameReady.emit(img, MDAEvent(channel=self.settings['channel']),
+                                             dict(md))
+        return True
+
+
 if __name__ == "__main__":
     from qtpy.QtWidgets import QApplication, QGridLayout, QWidget
     from pymmcore_widgets import LiveButton, ImagePreview, StageWidget
@@ -0,0 +1,345 @@
+"""Simulated NI backend, so the acquisition path can be run and profiled without a DAQ.
+
+SimulatedTask and SimulatedWriter have the parts of nidaqmx.Task and AnalogMultiChannelWriter that
+are used in this package. The task plays the written samples at the configured sample rate in wall
+clock time and calls on_trigger for every rising edge on the camera row.
+
+Only the waveform output is simulated. The demo camera does not wait for these triggers, it makes
+its frame whenever the engine snaps, so a missing or late trigger does not show up as a missing or
+late frame. Compare the trigger count to the number of frames to check the camera row.
+"""
+from __future__ import annotations
+
+import collections
+import logging
+import time
+from threading import Thread, Event, Lock, current_thread
+from typing import Callable
+
+import numpy as np
+import nidaqmx
+import nidaqmx.errors
+
+FINITE = nidaqmx.constants.AcquisitionType.FINITE
+CONTINUOUS = nidaqmx.constants.AcquisitionType.CONTINUOUS
+ALLOW_REGENERATION = nidaqmx.constants.RegenerationMode.ALLOW_REGENERATION
+FIRST_SAMPLE = nidaqmx.constants.WriteRelativeTo.FIRST_SAMPLE
+CURRENT_WRITE_POSITION = nidaqmx.constants.WriteRelativeTo.CURRENT_WRITE_POSITION
+
+CAMERA_ROW = 2
+TRIGGER_THRESHOLD = 2.5  # V
+PLAYER_PERIOD = 0.001  # s
+
+
+class SimulatedChannels:
+    def __init__(self):
+        self.names = []
+
+    def add_ao_voltage_chan(self, physical_channel: str, *args, **kwargs):
+        self.names.append(physical_channel)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class SimulatedTiming:
+    def __init__(self):
+        self.samp_clk_rate = 1000
+        self.samp_quant_samp_mode = FINITE
+        self.samp_quant_samp_per_chan = 1000
+
+    def cfg_samp_clk_timing(self, rate: float, source: str = "", active_edge=None,
+                            sample_mode=FINITE, samps_per_chan: int = 1000):
+        self.samp_clk_rate = rate
+        self.samp_quant_samp_mode = sample_mode
+        self.samp_quant_samp_per_chan = samps_per_chan
+
+
+class SimulatedOutStream:
+    def __init__(self, task: SimulatedTask):
+        self._task = task
+        self.regen_mode = ALLOW_REGENERATION
+        # Only FIRST_SAMPLE with offset 0 is simulated, it replaces the regenerated buffer
+        self.relative_to = CURRENT_WRITE_POSITION
+        self.offset = 0
+
+    @property
+    def total_samp_per_chan_generated(self) -> int:
+        return self._task.generated
+
+    @property
+    def output_buf_size(self) -> int:
+        timing = self._task.timing
+        if timing.samp_quant_samp_mode == CONTINUOUS:
+            return max(timing.samp_quant_samp_per_chan, 1000)
+        return timing.samp_quant_samp_per_chan
+
+    @property
+    def space_avail(self) -> int:
+        return max(self.output_buf_size - self._task.fifo_size, 0)
+
+
+class SimulatedTask:
+    """Drop-in for the nidaqmx.Task used by NIDeviceGroup.
+
+    Finite tasks stop after samps_per_chan samples, continuous tasks either regenerate what was
+    written (like ALLOW_REGENERATION) or raise an underflow error on the next write if they run out
+    of samples. on_trigger callbacks are called from the player thread with the sample index of the
+    rising edge on the camera row.
+    """
+    def __init__(self, name: str = "simulated", camera_row: int = CAMERA_ROW,
+                 on_trigger: Callable[[int], None] | None = None):
+        self.name = name
+        self.camera_row = camera_row
+        self.ao_channels = SimulatedChannels()
+        self.timing = SimulatedTiming()
+        self.out_stream = SimulatedOutStream(self)
+        self.triggers = [on_trigger] if on_trigger else []
+        self.n_triggers = 0
+
+        self._fifo = collections.deque()
+        self._written = []  # everything written since the last stop, for regeneration
+        self.fifo_size = 0
+        self.generated = 0
+        self._last_camera = 0.
+        self._error = None
+        self._lock = Lock()
+        self._running = Event()
+        self._done = Event()
+        self._done.set()
+        self._player = None
+
+    # nidaqmx.Task API -------------------------------------------------------------------------
+    def write(self, data, auto_start=False, timeout: float = 10.0) -> int:
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim == 1:
+            data = data.reshape((-1, 1)) if len(self.ao_channels) > 1 else data.reshape((1, -1))
+        return self._write(data, timeout)
+
+    def start(self):
+        if self._running.is_set():
+            return
+        self._error = None
+        self.generated = 0
+        self._last_camera = 0.
+        self._done.clear()
+        self._running.set()
+        self._t0 = time.perf_counter()
+        self._player = Thread(target=self._play, name=f"{self.name}_player", daemon=True)
+        self._player.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._player is not None and self._player is not current_thread():
+            self._player.join()
+        self._player = None
+        with self._lock:
+            self._fifo.clear()
+            self._written = []
+            self.fifo_size = 0
+        self._done.set()
+
+    def wait_until_done(self, timeout: float = 10.0):
+        if not self._done.wait(timeout):
+            raise nidaqmx.errors.DaqError("Wait Until Done did not indicate that the task was "
+                                          "done within the specified timeout.", -200560)
+        self._raise_error()
+
+    def is_task_done(self) -> bool:
+        return self._done.is_set()
+
+    def close(self):
+        self.stop()
+
+    # internals -------------------------------------------------------------------------------
+    def _write(self, data: np.ndarray, timeout: float = 10.0) -> int:
+        self._raise_error()
+        if data.shape[0] != max(len(self.ao_channels), 1):
+            raise nidaqmx.errors.DaqError(f"Data for {data.shape[0]} channels written to a task "
+                                          f"with {len(self.ao_channels)} channels.", -200524)
+        deadline = time.perf_counter() + timeout
+        if (self.out_stream.relative_to == FIRST_SAMPLE and self._running.is_set()
+                and self.out_stream.regen_mode == ALLOW_REGENERATION):
+            # Rewrite of the buffer of a running regenerating task, played from the next sample
+            data = data.copy()
+            with self._lock:
+                self._fifo = collections.deque([data])
+                self._written = [data]
+                self.fifo_size = data.shape[1]
+            return data.shape[1]
+        if self.timing.samp_quant_samp_mode == CONTINUOUS and self._running.is_set():
+            while self.out_stream.space_avail < data.shape[1]:
+                if time.perf_counter() > deadline:
+                    raise nidaqmx.errors.DaqError("Write cannot be performed, because the number "
+                                                  "of samples is too large.", -200292)
+                time.sleep(PLAYER_PERIOD)
+                self._raise_error()
+        data = data.copy()
+        with self._lock:
+            self._fifo.append(data)
+            self._written.append(data)
+            self.fifo_size += data.shape[1]
+        return data.shape[1]
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _play(self):
+        rate = self.timing.samp_clk_rate
+        finite = self.timing.samp_quant_samp_mode == FINITE
+        total = self.timing.samp_quant_samp_per_chan
+        regenerate = self.out_stream.regen_mode == ALLOW_REGENERATION
+        while self._running.is_set():
+            due = int((time.perf_counter() - self._t0)*rate) - self.generated
+            if finite:
+                due = min(due, total - self.generated)
+            if due > 0:
+                played = self._consume(due)
+                if played < due:
+                    if regenerate and not finite and self._written:
+                        with self._lock:
+                            self._fifo.extend(self._written)
+                            self.fifo_size += sum(chunk.shape[1] for chunk in self._written)
+                    elif not finite:
+                        self._error = nidaqmx.errors.DaqError(
+                            "Onboard device memory underflow. Because of system and/or bus-"
+                            "bandwidth limitations, the driver could not write data to the "
+                            "device fast enough to keep up with the device output rate.",
+                            -200290)
+                        logging.warning(f"{self.name}: output underflow after "
+                                        f"{self.generated} samples")
+                        break
+            if finite and (self.generated >= total or (self.fifo_size == 0 and
+                                                       self.generated > 0)):
+                break
+            time.sleep(PLAYER_PERIOD)
+        self._running.clear()
+        self._done.set()
+
+    def _consume(self, n_samples: int) -> int:
+        """Take up to n_samples from the FIFO and fire the triggers in them."""
+        edges = []
+        played = 0
+        with self._lock:
+            while played < n_samples and self._fifo:
+                chunk = self._fifo[0]
+                n_take = min(n_samples - played, chunk.shape[1])
+                camera = chunk[self.camera_row, :n_take] if chunk.shape[0] > self.camera_row \
+                    else np.zeros(n_take)
+                high = camera > TRIGGER_THRESHOLD
+                previous = np.concatenate(([self._last_camera > TRIGGER_THRESHOLD], high[:-1]))
+                rising = np.flatnonzero(high & ~previous)
+                edges.extend(self.generated + played + rising)
+                if n_take:
+                    self._last_camera = camera[-1]
+                if n_take == chunk.shape[1]:
+                    self._fifo.popleft()
+                else:
+                    self._fifo[0] = chunk[:, n_take:]
+                played += n_take
+            self.fifo_size -= played
+            self.generated += played
+        for edge in edges:
+            self.n_triggers += 1
+            for callback in self.triggers:
+                callback(int(edge))
+        return played
+
+
+class SimulatedWriter:
+    """Drop-in for nidaqmx.stream_writers.AnalogMultiChannelWriter on a SimulatedTask."""
+    def __init__(self, task: SimulatedTask, auto_start: bool = False):
+        self._task = task
+        self.auto_start = auto_start
+
+    def write_many_sample(self, data: np.ndarray, timeout: float = 10.0) -> int:
+        written = self._task._write(data, timeout)
+        if self.auto_start:
+            self._task.start()
+        return written
+
+
+def make_simulated_task(settings: dict, on_trigger: Callable[[int], None] | None = None
+                        ) -> tuple[SimulatedTask, SimulatedWriter]:
+    """Simulated version of NIDeviceGroup.make_task with the same eight channels."""
+    task = SimulatedTask(on_trigger=on_trigger)
+    for channel in range(8):
+        task.ao_channels.add_ao_voltage_chan(f'Sim1/ao{channel}')
+    task.timing.cfg_samp_clk_timing(rate=settings['ni']['sample_rate'],
+                                    samps_per_chan=settings['ni']['total_points'] +
+                                    settings['ni']['readout_points']//3*2,)
+    task.out_stream.regen_mode = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION
+    return task, SimulatedWriter(task, auto_start=False)
+
+
+def headless_setup(settings: dict | None = None, config: str | None = None,
+                   engine: str = "event", continuous_live: bool = False):
+    """Set up core, devices, engines, runner and datastore with the demo camera and a simulated DAQ.
+
+    engine can be "event", "compiled", "streaming" or "timed", continuous_live selects the
+    ContinuousLiveEngine. The camera frames are not gated on the simulated triggers, see the module
+    docstring. Returns a dict with all components, call headless_teardown with it when
+    done.
+    """
+    from pathlib import Path
+    from isim_control.core import ISIMCore, add_live_frame_signal
+    from isim_control.settings import iSIMSettings
+    from isim_control.ni import acquisition, live
+    from isim_control.ni.devices import NIDeviceGroup
+    from isim_control.pubsub import Broker, Publisher
+    from isim_control.runner import iSIMRunner
+    from isim_control.io.buffered_datastore import BufferedDataStore
+
+    mmc = ISIMCore()
+    mmc.loadSystemConfiguration(config or Path(__file__).parent / "testing" / "MMConfig_demo.cfg")
+    add_live_frame_signal(mmc)
+    mmc.setAutoShutter(False)
+    # The waveforms are chosen by channel name, give the demo config the iSIM channels
+    for channel, label in (("488", "Chroma-HQ480"), ("561", "Chroma-HQ570"), ("LED", "Chroma-D360")):
+        mmc.defineConfig("Channel", channel, "Excitation", "Label", label)
+    settings = settings or iSIMSettings()
+
+    devices = NIDeviceGroup(settings, simulated=True)
+    engine_class = {"event": acquisition.AcquisitionEngine,
+                    "compiled": acquisition.CompiledAcquisitionEngine,
+                    "streaming": acquisition.StreamingAcquisitionEngine,
+                    "timed": acquisition.TimedAcquisitionEngine}[engine]
+    acq_engine = engine_class(mmc, devices, settings)
+    live_class = live.ContinuousLiveEngine if continuous_live else live.LiveEngine
+    live_engine = live_class(task=devices.task, mmcore=mmc, settings=settings,
+                             device_group=devices)
+    mmc.mda.set_engine(acq_engine)
+
+    broker = Broker()
+    runner = iSIMRunner(mmc, live_engine=live_engine, acquisition_engine=acq_engine,
+                        devices=devices, settings=settings, publisher=Publisher(broker.pub_queue))
+    broker.attach(runner)
+    datastore = BufferedDataStore(mmcore=mmc, create=True, publishers=[], live_frames=True,
+                                  capacity=int(2E8))
+    return {"mmc": mmc, "settings": settings, "devices": devices, "acq_engine": acq_engine,
+            "live_engine": live_engine, "broker": broker, "runner": runner,
+            "datastore": datastore}
+
+
+def headless_teardown(setup: dict):
+    setup["broker"].stop()
+    setup["runner"].stop()
+    setup["devices"].task.close()
+    setup["datastore"].close()
+
+
+if __name__ == "__main__":
+    from useq import MDASequence
+    from isim_control.settings import iSIMSettings
+
+    settings = iSIMSettings(time_plan={"interval": 0, "loops": 20})
+    setup = headless_setup(settings, engine="timed")
+    triggers = []
+    setup["devices"].task.triggers.append(triggers.append)
+    setup["acq_engine"].adjust_camera_exposure(settings['camera']['exposure']*1000)
+    setup["mmc"].mda.run(MDASequence(**settings['acquisition']))
+    frames = settings['acquisition']['time_plan']['loops']
+    print(f"Camera triggers sent by the simulated DAQ: {len(triggers)} for {frames} frames")
+    headless_teardown(setup)
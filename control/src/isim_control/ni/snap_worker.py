@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import logging
+import queue
+import time
+from threading import Thread, Event
+from typing import Callable, Any
+
+from pymmcore_plus import CMMCorePlus
+from useq import MDAEvent
+
+
+class SnapSlot:
+    """One snap in the ring of a SnapWorker, reused for every n_slots-th snap.
+
+    armed is set right before snapImage is called, so the camera waits for the trigger after it.
+    triggered is set when snapImage returned, read_out when image and meta are in the slot. free is
+    set once the callback is done with the slot and it can be used again. times has the
+    perf_counter at each of these states.
+    """
+    def __init__(self, index: int):
+        self.index = index
+        self.armed = Event()
+        self.triggered = Event()
+        self.read_out = Event()
+        self.free = Event()
+        self.free.set()
+        self.event = None
+        self.callback = None
+        self.data = None
+        self.image = None
+        self.meta = None
+        self.error = None
+        self.times = {}
+
+    def reset(self, event: MDAEvent|None, callback: Callable[[SnapSlot], None]|None, data: Any):
+        self.armed.clear()
+        self.triggered.clear()
+        self.read_out.clear()
+        self.free.clear()
+        self.event = event
+        self.callback = callback
+        self.data = data
+        self.image = None
+        self.meta = None
+        self.error = None
+        self.times = {"submitted": time.perf_counter()}
+
+    def _set(self, state: str):
+        self.times[state] = time.perf_counter()
+        getattr(self, state).set()
+
+    def wait(self, state: str = "read_out", timeout: float|None = None) -> bool:
+        return getattr(self, state).wait(timeout)
+
+
+class SnapWorker(Thread):
+    """Long lived thread that snaps images for an engine, one after the other.
+
+    submit hands out the next slot of a preallocated ring and puts it in the job queue. It blocks
+    while that slot is still in use, so there are at most n_slots snaps in flight. The engine waits
+    for armed before it starts the DAQ task, and for triggered before it arms the next snap.
+    Read out slots are handed to a second persistent thread that calls the callbacks, so a slow
+    frameReady does not delay arming the next snap.
+    """
+    def __init__(self, mmcore: CMMCorePlus, n_slots: int = 4, name: str = "snap_worker"):
+        super().__init__(name=name, daemon=True)
+        self._mmc = mmcore
+        self.slots = [SnapSlot(idx) for idx in range(n_slots)]
+        self.jobs = queue.Queue(maxsize=n_slots)
+        self.results = queue.Queue()
+        self.next_slot = 0
+        self.snaps = 0
+        self.dispatcher = Thread(target=self._dispatch, name=f"{name}_dispatch", daemon=True)
+        self.dispatcher.start()
+        self.start()
+
+    def submit(self, event: MDAEvent|None = None,
+               callback: Callable[[SnapSlot], None]|None = None, data: Any = None,
+               timeout: float|None = None) -> SnapSlot:
+        slot = self.slots[self.next_slot]
+        if not slot.free.wait(timeout):
+            raise TimeoutError(f"Snap slot {slot.index} was not freed in time")
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        slot.reset(event, callback, data)
+        self.jobs.put(slot)
+        return slot
+
+    def stop(self):
+        """Finish the snaps that are submitted, then end both threads."""
+        self.jobs.put(None)
+
+    def join(self, timeout: float|None = None):
+        super().join(timeout)
+        self.dispatcher.join(timeout)
+
+    def run(self):
+        while True:
+            slot = self.jobs.get()
+            if slot is None:
+                self.results.put(None)
+                break
+            try:
+                slot._set("armed")
+                self._mmc.snapImage()
+                slot._set("triggered")
+                slot.meta = self._mmc.getTags()
+                slot.image = self._mmc.getImage(fix=False)
+            except Exception as e:
+                logging.error(f"Snap failed: {e}")
+                slot.error = e
+            # Nobody must wait forever for a snap that failed
+            slot.armed.set()
+            slot.triggered.set()
+            slot._set("read_out")
+            self.snaps += 1
+            self.results.put(slot)
+
+    def _dispatch(self):
+        while True:
+            slot = self.results.get()
+            if slot is None:
+                break
+            try:
+                if slot.callback is not None and slot.error is None:
+                    slot.callback(slot)
+            except Exception as e:
+                logging.error(f"Snap callback failed: {e}")
+            finally:
+                slot.image = None
+                slot._set("free")
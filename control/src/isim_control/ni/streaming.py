@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import logging
+import queue
+import time
+from threading import Thread, Event
+
+import numpy as np
+import nidaqmx
+import nidaqmx.errors
+import useq
+
+from isim_control.ni.devices import NIDeviceGroup
+
+CONTINUOUS = nidaqmx.constants.AcquisitionType.CONTINUOUS
+NO_REGENERATION = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION
+
+
+class StreamingWriter:
+    """Keeps the FIFO of a continuous, non-regenerating task topped up from background threads.
+
+    A producer thread renders the waveforms of submitted events into one of two preallocated
+    buffers, while a writer thread keeps about lead_time seconds of samples in the DAQ FIFO. If no
+    event is ready, short idle chunks are written that hold the galvo, stage and twitcher at their
+    last value with camera, AOTF and LED off. So the generation never stops between frames.
+
+    The headroom (samples written but not generated yet) is tracked for every write, min_headroom
+    and underruns show how close the stream got to running dry.
+    """
+    def __init__(self, device_group: NIDeviceGroup, lead_time: float = 0.05,
+                 idle_time: float = 0.01):
+        self.device_group = device_group
+        self.task = device_group.task
+        self.stream = device_group.stream
+        self.lead_time = lead_time
+        self.idle_time = idle_time
+
+        self.events = queue.Queue(maxsize=1)
+        self.ready = queue.Queue()
+        self.free = queue.Queue()
+        self.stop_requested = Event()
+        self.producer = None
+        self.writer = None
+
+        self.samples_written = 0
+        self.headroom = 0
+        self.min_headroom = None
+        self.underruns = 0
+        self.submitted = 0
+        self.frames_written = 0
+        self.idle_written = 0
+        self.generated = 0
+        # Samples written up to the end of the last frame
+        self.frames_end = 0
+        self._dry = False
+
+    def start(self, first_event: useq.MDAEvent):
+        settings = self.device_group.settings
+        self.sample_rate = settings['ni']['sample_rate']
+        self.lead_points = int(self.lead_time*self.sample_rate)
+        self.low_water = int(self.idle_time*self.sample_rate)
+        n_points = self.device_group.n_points()
+        self.buffers = [np.zeros((8, n_points)), np.zeros((8, n_points))]
+        self.free = queue.Queue()
+        for idx in range(len(self.buffers)):
+            self.free.put(idx)
+        self.ready = queue.Queue()
+        self.stop_requested.clear()
+        self.samples_written = 0
+        self.min_headroom = None
+        self.underruns = 0
+        self.submitted = 0
+        self.frames_written = 0
+        self.idle_written = 0
+        self.generated = 0
+        self.frames_end = 0
+        self._dry = False
+
+        # Hold the values the first frame starts with until it is played
+        self.idle = np.zeros((8, max(self.low_water, 1)))
+        self._hold(self.device_group.get_data(first_event, first_event))
+
+        self.task.timing.cfg_samp_clk_timing(rate=self.sample_rate, sample_mode=CONTINUOUS,
+                                             samps_per_chan=max(4*n_points, 2*self.lead_points))
+        self.task.out_stream.regen_mode = NO_REGENERATION
+        # The task has to be set back to finite timing by update_task afterwards
+        self.device_group.task_timing = None
+        while self.samples_written < self.lead_points and not self.stop_requested.is_set():
+            self._write(self.idle)
+        self.task.start()
+
+        self.producer = Thread(target=self._produce, name="waveform_producer", daemon=True)
+        self.writer = Thread(target=self._top_up, name="daq_writer", daemon=True)
+        self.producer.start()
+        self.writer.start()
+
+    def submit(self, event: useq.MDAEvent, next_event: useq.MDAEvent|None = None):
+        """Queue an event to be played. Blocks if the next event is still waiting to be rendered."""
+        self.submitted += 1
+        self.events.put((event, next_event))
+
+    def wait_until_played(self, timeout: float = 5):
+        """Wait until all submitted events are written and generated by the DAQ.
+
+        The idle chunks written after the last frame are not waited for.
+        """
+        deadline = time.perf_counter() + timeout
+        while (self.frames_written < self.submitted or self.generated < self.frames_end):
+            if time.perf_counter() > deadline or self.stop_requested.is_set():
+                logging.warning("Streaming writer did not play all events in time")
+                return
+            time.sleep(0.001)
+
+    def stop(self):
+        self.stop_requested.set()
+        for thread in (self.producer, self.writer):
+            if thread is not None:
+                thread.join(1)
+        try:
+            self.task.stop()
+        except nidaqmx.errors.DaqError:
+            pass
+
+    def stats(self) -> dict:
+        return {"headroom_ms": self.headroom/self.sample_rate*1000,
+                "min_headroom_ms": (self.min_headroom or 0)/self.sample_rate*1000,
+                "underruns": self.underruns,
+                "frames": self.frames_written,
+                "idle_chunks": self.idle_written}
+
+    def _produce(self):
+        while not self.stop_requested.is_set():
+            try:
+                event, next_event = self.events.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            idx = self.free.get()
+            self.buffers[idx][:] = self.device_group.get_data(event, next_event)
+            self.ready.put(idx)
+
+    def _top_up(self):
+        while not self.stop_requested.is_set():
+            self._update_headroom()
+            if self.headroom >= self.lead_points:
+                time.sleep(self.idle_time/4)
+                continue
+            try:
+                idx = self.ready.get_nowait()
+            except queue.Empty:
+                self._write(self.idle)
+                self.idle_written += 1
+                continue
+            self._write(self.buffers[idx])
+            self._hold(self.buffers[idx])
+            self.frames_end = self.samples_written
+            self.frames_written += 1
+            self.free.put(idx)
+
+    def _write(self, data: np.ndarray):
+        try:
+            self.stream.write_many_sample(data)
+        except nidaqmx.errors.DaqError as e:
+            self.underruns += 1
+            logging.error(f"DAQ stream write failed: {e}")
+            self.stop_requested.set()
+            return
+        self.samples_written += data.shape[1]
+
+    def _update_headroom(self):
+        generated = self.task.out_stream.total_samp_per_chan_generated
+        self.generated = generated
+        self.headroom = self.samples_written - generated
+        if self.min_headroom is None or self.headroom < self.min_headroom:
+            self.min_headroom = self.headroom
+        if generated and self.headroom <= 0:
+            if not self._dry:
+                self.underruns += 1
+                logging.warning("DAQ FIFO ran dry")
+            self._dry = True
+            return
+        self._dry = False
+        if generated and self.headroom < self.low_water:
+            logging.warning(f"Low DAQ FIFO headroom: {self.headroom/self.sample_rate*1000:.1f} ms")
+
+    def _hold(self, frame: np.ndarray):
+        """Idle data continues galvo, stage and twitcher from the end of frame, the rest is off."""
+        self.idle[:] = 0
+        self.idle[0] = frame[0, -1]
+        self.idle[1] = frame[1, -1]
+        self.idle[7] = frame[7, -1]
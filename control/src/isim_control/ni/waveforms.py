@@ -0,0 +1,133 @@
+"""Vectorized waveform synthesis for the DAQ devices.
+
+A waveform is described by a segment table, one row (n_points, start, stop) per segment. A segment
+is a linear ramp from start to stop over n_points samples including both ends, like np.linspace, so
+a hold is a ramp with start == stop. render fills the segments of a table straight into a
+preallocated row, instead of stacking many small arrays. For the few segments of a frame this is a
+lot faster than np.interp over knots. Long periodic parts like the triangle train of the twitcher
+are computed in closed form.
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+
+import numpy as np
+
+from isim_control.startup import lazy_import
+
+# scipy takes long to import, it is only needed once the first waveform is smoothed
+ndimage = lazy_import("scipy.ndimage")
+
+
+def ramp(n_points: int, start: float, stop: float) -> tuple[int, float, float]:
+    return (max(int(n_points), 0), start, stop)
+
+
+def hold(n_points: int, value: float) -> tuple[int, float, float]:
+    return (max(int(n_points), 0), value, value)
+
+
+def table_length(table: list[tuple[int, float, float]]) -> int:
+    return int(sum(segment[0] for segment in table))
+
+
+_samples = np.arange(0, dtype=np.float64)
+
+
+def samples(n_points: int) -> np.ndarray:
+    """0, 1, ... n_points - 1 as floats, sliced from one array that only grows."""
+    global _samples
+    if _samples.shape[0] < n_points:
+        _samples = np.arange(max(n_points, 2*_samples.shape[0]), dtype=np.float64)
+        _samples.flags.writeable = False
+    return _samples[:n_points]
+
+
+def render(table: list[tuple[int, float, float]], out: np.ndarray|None = None) -> np.ndarray:
+    """Evaluate a segment table into out, which is cut to the length of out if given.
+
+    If out is longer than the table, the last value is held until the end of out.
+    """
+    if out is None:
+        out = np.empty(table_length(table))
+    n_out = out.shape[-1]
+    index = 0
+    value = 0.
+    for n_points, start, stop in table:
+        n_points = min(n_points, n_out - index)
+        if n_points <= 0:
+            continue
+        segment = out[..., index:index + n_points]
+        if start == stop or n_points == 1:
+            segment[...] = start
+        else:
+            # Like np.linspace, but without allocating
+            np.multiply(samples(n_points), (stop - start)/(n_points - 1), out=segment)
+            segment += start
+            segment[..., -1] = stop
+        index += n_points
+        value = segment[..., -1]
+    out[..., index:] = value
+    return out
+
+
+def triangle_train(n_periods: int, half_period: int, low: float = -1., high: float = 1.,
+                   out: np.ndarray|None = None) -> np.ndarray:
+    """n_periods of up and down ramps between low and high, without the closing sample.
+
+    Same as tiling np.linspace(low, high, half_period + 1)[:-1] and the way back down.
+    """
+    if out is None:
+        out = np.empty(2*half_period*n_periods)
+    # 0 at low, 1 at high, back to 0 at the end of the period
+    period = 1 - np.abs(samples(2*half_period)/half_period - 1)
+    period = period*(high - low) + low
+    out.reshape(n_periods, 2*half_period)[:] = period
+    return out
+
+
+@lru_cache(maxsize=16)
+def gaussian_kernel(sigma: float, truncate: float = 4.0) -> np.ndarray:
+    """The kernel that ndimage.gaussian_filter1d would use, computed once per sigma."""
+    radius = int(truncate*float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5/sigma**2*x**2)
+    kernel /= kernel.sum()
+    kernel.flags.writeable = False
+    return kernel
+
+
+def smooth(row: np.ndarray, sigma: float, out: np.ndarray|None = None) -> np.ndarray:
+    """Gaussian smoothing with a cached kernel, equal to ndimage.gaussian_filter1d(row, sigma)."""
+    if sigma <= 0:
+        if out is None:
+            return row.copy()
+        out[...] = row
+        return out
+    return ndimage.correlate1d(row, gaussian_kernel(sigma), mode='reflect', output=out)
+
+
+def smooth_periodic(row: np.ndarray, sigma: float, start: int, stop: int, period: int,
+                    out: np.ndarray|None = None) -> np.ndarray:
+    """Like smooth, for a row that repeats with period between start and stop.
+
+    Inside the periodic part the result is one smoothed period tiled, only the edges are filtered.
+    A period of 0 (fewer samples than waves at short exposures) is smoothed as a whole.
+    """
+    if sigma <= 0 or period <= 0:
+        return smooth(row, sigma, out)
+    radius = (len(gaussian_kernel(sigma)) - 1)//2
+    if stop - start < 2*radius + period:
+        return smooth(row, sigma, out)
+    if out is None:
+        out = np.empty_like(row)
+    kernel = gaussian_kernel(sigma)
+    one_period = ndimage.correlate1d(row[start:start + period], kernel, mode='wrap')
+    inner_start, inner_stop = start + radius, stop - radius
+    n_periods = -(-(inner_stop - start)//period)
+    out[inner_start:inner_stop] = np.tile(one_period, n_periods)[radius:inner_stop - start]
+    head = ndimage.correlate1d(row[:inner_start + radius], kernel, mode='reflect')
+    out[:inner_start] = head[:inner_start]
+    tail = ndimage.correlate1d(row[inner_stop - radius:], kernel, mode='reflect')
+    out[inner_stop:] = tail[radius:]
+    return out
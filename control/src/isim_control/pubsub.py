@@ -1,102 +1,237 @@
+"""Publish/subscribe between the parts of the program, also across processes.
+
+Every process has a Broker that reads its pub_queue (a multiprocessing.Queue) and puts the messages
+into the queues of the attached subscribers. Subscribers always live in the process of their broker,
+so their queues are plain queue.SimpleQueues and a message is not pickled again for each of them.
+A Publisher in the same process as the broker of its queue skips the pub_queue and routes directly,
+so only messages that really cross a process are pickled.
+
+In process, the values are passed as they are, not as copies: all subscribers of a message get the
+same objects, and the publisher still has them. Neither side may change them after publishing,
+publish a copy if the values are changed afterwards. A publisher that ever went through the
+pub_queue (because the broker was not running yet) keeps using it, so its later messages can't
+overtake the ones still queued. Messages of one publisher arrive in the order they were published.
+
+stop lets the broker route what is still in its pub_queue before the subscribers are stopped, they
+handle everything they got before. Messages that are routed after that are dropped and logged.
+"""
 from __future__ import annotations
+import logging
 import multiprocessing
+import os
+import queue
+import weakref
 from _queue import Empty
-from threading import Thread
+from threading import Thread, Timer, Lock
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Brokers of this process by id of their pub_queue, for publishers to route in process
+_local_brokers = weakref.WeakValueDictionary()
+
+
+def local_broker(pub_queue) -> Broker | None:
+    broker = _local_brokers.get(id(pub_queue))
+    # A forked process inherits the dict, but not the threads of the brokers in it
+    if (broker is None or broker.pub_queue is not pub_queue or broker.pid != os.getpid()
+        or broker.stop_requested):
+        return None
+    return broker
+
 
 class Broker(Thread):
     def __init__(self, pub_queue: multiprocessing.Queue | None = None,
                  auto_start: bool = True, name:str = None):
         super().__init__(name=name)
         self.subscribers = set()
+        # (topic, message) -> subscribers that have a route for it
+        self.index = {}
+        # Direct routes from other threads and the broker thread don't interleave per subscriber
+        self.route_lock = Lock()
         self.pub_queue = pub_queue or multiprocessing.Queue()
+        self.pid = os.getpid()
         self.stop_requested = False
+        # The subscribers are stopped, nothing can be routed to them anymore
+        self.closed = False
+        _local_brokers[id(self.pub_queue)] = self
         if auto_start:
             self.start()
 
     def attach(self, subscriber: Subscriber):
         self.subscribers.add(subscriber)
+        for topic in subscriber.sub.topics:
+            for message in subscriber.sub.routes.keys():
+                self.index.setdefault((topic, message), []).append(subscriber)
 
     def route(self, topic, message: str, values: list):
-        for subscriber in self.subscribers:
-            if topic in subscriber.sub.topics:
-                # print(self.name, topic, subscriber, message)
-                if message in subscriber.sub.routes.keys():
-                    subscriber.sub.sub_queue.put({"event": message,
-                                                "values": values})
+        with self.route_lock:
+            if self.closed:
+                logger.warning(f"Broker {self.name} is stopped, {topic} {message} is dropped")
+                return
+            for subscriber in self.index.get((topic, message), ()):
+                subscriber.sub.sub_queue.put((message, values))
         if topic == "stop":
             self.stop()
 
     def run(self):
         while True:
             try:
-                message = self.pub_queue.get(timeout=0.5)
-                self.route(message["topic"], message["event"], message["values"])
+                message = self.pub_queue.get(timeout=None if not self.stop_requested else 0.5)
             except Empty:
-                # print("Broker", self.name)
-                if self.stop_requested:
-                    # while not self.pub_queue.empty():
-                    #     self.pub_queue.get()
-                    # self.pub_queue.close()
-                    # self.pub_queue.join_thread()
-                    # del self.pub_queue
-                    break
-                else:
-                    continue
+                break
+            except (OSError, EOFError):
+                break
+            if message is None:
+                # Sent by stop from another thread, route what is left and finish
+                continue
+            self.route(message["topic"], message["event"], message["values"])
+        self._stop_subscribers()
 
     def stop(self):
+        if self.stop_requested:
+            return
         self.stop_requested = True
-        for subscriber in self.subscribers:
-            subscriber.sub.stop()
+        try:
+            # Wake up run if it is waiting for a message
+            self.pub_queue.put(None)
+        except (OSError, ValueError):
+            pass
+        if not self.is_alive():
+            # Nothing left to route, run stops them otherwise
+            self._stop_subscribers()
+
+    def _stop_subscribers(self):
+        with self.route_lock:
+            if self.closed:
+                return
+            self.closed = True
+            for subscriber in self.subscribers:
+                subscriber.sub.stop()
 
 
 
 class Publisher():
-    def __init__(self, pub_queue: multiprocessing.Queue):
+    def __init__(self, pub_queue: multiprocessing.Queue, name: str | None = None):
         self.pub_queue = pub_queue
+        self.name = name
+        self.queued = False
 
     def publish(self, topic, message, values: list = None):
         values = [] if values is None else values
+        broker = None if self.queued else local_broker(self.pub_queue)
+        if broker is not None:
+            return broker.route(topic, message, values)
+        self.queued = True
         return self.pub_queue.put({"topic": topic,
                                    "event": message,
                                    "values": values})
 
 
+class BatchPublisher(Publisher):
+    """Publisher that coalesces frequent messages like new_frame.
+
+    The batched messages are held back for up to window seconds or max_count messages. With the
+    policy "all", they go out as one message with an s appended (new_frame -> new_frames) and the
+    list of all values, nothing is lost. With "latest" only the newest values of every batched
+    message go out, as a normal message. Use this for viewers that can't keep up anyway, never for
+    consumers that hold their frames. Other messages first send what is held back, so they don't
+    overtake the frames.
+    """
+    def __init__(self, pub_queue: multiprocessing.Queue, policy: str = "all",
+                 window: float = 0.05, max_count: int = 32,
+                 batched: tuple[str] = ("new_frame", "new_live_frame"),
+                 merge: Callable[[list, list], list]|None = None, name: str | None = None):
+        super().__init__(pub_queue, name)
+        if policy not in ("all", "latest"):
+            raise ValueError(f"Unknown batch policy {policy}")
+        self.policy = policy
+        self.window = window
+        self.max_count = max_count
+        self.batched = batched
+        self.merge = merge
+        # (topic, message) -> list of values, in order of the first message
+        self.pending = {}
+        self.count = 0
+        # Messages that were dropped by the latest policy, per message
+        self.coalesced = {}
+        self.lock = Lock()
+        self.timer = None
+
+    def publish(self, topic, message, values: list = None):
+        if message not in self.batched:
+            self.flush()
+            return super().publish(topic, message, values)
+        values = [] if values is None else values
+        with self.lock:
+            batch = self.pending.setdefault((topic, message), [])
+            if self.policy == "latest" and batch:
+                batch[0] = self.merge(batch[0], values) if self.merge else values
+                self.coalesced[message] = self.coalesced.get(message, 0) + 1
+            else:
+                batch.append(values)
+            self.count += 1
+            full = self.count >= self.max_count
+            if not full and self.timer is None:
+                self.timer = Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending, self.count = self.pending, {}, 0
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            # Publish while holding the lock, a concurrent flush must not overtake this one
+            for (topic, message), batch in pending.items():
+                if self.policy == "latest":
+                    super().publish(topic, message, batch[-1])
+                else:
+                    super().publish(topic, message + "s", [batch])
+
+
 class Subscriber(Thread):
     def __init__(self, topics:list[str], routes: dict):
         super().__init__()
         self.topics = topics
         self.routes = routes
-        self.sub_queue = multiprocessing.Queue()
+        self.sub_queue = queue.SimpleQueue()
         self.stop_requested = False
         self.start()
 
+    @property
+    def depth(self) -> int:
+        """Messages waiting to be handled."""
+        return self.sub_queue.qsize()
+
     def receive(self, message, values: list):
         callbacks = self.routes.get(message, [])
         for callback in callbacks:
             callback(*values)
 
     def run(self):
+        while True:
+            item = self.sub_queue.get()
+            if item is None:
+                break
+            self.receive(*item)
+        # Put after the sentinel, while stop was called
         while True:
             try:
-                message = self.sub_queue.get(timeout=0.5)
-                # self.sub_queue._thread.name = ", ".join(self.topics)
-                self.receive(message["event"], message["values"])
+                item = self.sub_queue.get_nowait()
             except Empty:
-                # print("Subscriber", self.topics)
-                if self.stop_requested:
-                    # while not self.sub_queue.empty():
-                    #     self.sub_queue.get()
-                    # self.sub_queue.close()
-                    # self.sub_queue.join_thread()
-                    # del self.sub_queue
-                    break
-                else:
-                    continue
-            except OSError:
                 break
+            if item is not None:
+                self.receive(*item)
 
     def stop(self):
-        self.stop_requested = True
+        if not self.stop_requested:
+            self.stop_requested = True
+            # Everything that is queued before is still handled
+            self.sub_queue.put(None)
 
 
 class GUI:
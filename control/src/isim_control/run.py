@@ -1,23 +1,26 @@
 import copy
 import os
+import logging
 
-from pymmcore_widgets import StageWidget, GroupPresetTableWidget
-from qtpy.QtWidgets import QApplication
-from qtpy.QtCore import Signal, Qt
-
-from isim_control.core import ISIMCore
-from isim_control.gui.dark_theme import set_dark
-from isim_control.settings_translate import save_settings, load_settings
-from isim_control.pubsub import Publisher, Broker
-from isim_control.runner import iSIMRunner
-from isim_control.gui.main_window import iSIM_StageWidget, MainWindow
-
+from isim_control import startup
 
-import logging
 os.environ["PYMM_STRICT_INIT_CHECKS"] = 'true'
 os.environ["PYMM_PARALLEL_INIT"] = 'true'
 
 def main():
+    # The imports are in here, the worker processes import this module again on Windows
+    with startup.phase("imports"):
+        from pymmcore_widgets import StageWidget, GroupPresetTableWidget
+        from qtpy.QtWidgets import QApplication
+        from qtpy.QtCore import Qt, QTimer
+
+        from isim_control.core import ISIMCore, add_live_frame_signal
+        from isim_control.gui.dark_theme import set_dark
+        from isim_control.settings_translate import save_settings, load_settings
+        from isim_control.pubsub import Publisher, Broker
+        from isim_control.runner import iSIMRunner
+        from isim_control.gui.main_window import iSIM_StageWidget, MainWindow
+
     logger = logging.getLogger(__name__)
     ch = logging.StreamHandler()
     ch.setLevel(logging.DEBUG)
@@ -34,13 +37,7 @@ def main():
     set_dark(app)
 
 
-    #This is hacky, might just want to make our own preview
-    events_class = mmc.events.__class__
-    new_cls = type(
-        events_class.__name__, events_class.__bases__,
-        {**events_class.__dict__, 'liveFrameReady': Signal(object, object, dict)},
-    )
-    mmc.events.__class__ = new_cls
+    add_live_frame_signal(mmc)
 
     settings = load_settings()
 
@@ -49,7 +46,8 @@ def main():
     print("Loading system config")
     try:
 
-        mmc.loadSystemConfiguration("C:/iSIM/iSIM/mm-configs/pymmcore_plus.cfg")
+        with startup.phase("system_config"):
+            mmc.loadSystemConfiguration("C:/iSIM/iSIM/mm-configs/pymmcore_plus.cfg")
         print("System loaded")
         mmc.setCameraDevice("PrimeB_Camera")
         mmc.setProperty("PrimeB_Camera", "TriggerMode", "Edge Trigger")
@@ -64,15 +62,25 @@ def main():
 
         #Backend
         broker = Broker()
-        from isim_control.ni import live, acquisition, devices
-        isim_devices = devices.NIDeviceGroup(settings=settings)
-        acq_engine = acquisition.AcquisitionEngine(mmc, isim_devices, settings)
-        live_engine = live.LiveEngine(task=acq_engine.task, mmcore=mmc, settings=settings,
-                                        device_group=isim_devices)
+        with startup.phase("import_ni"):
+            from isim_control.ni import live, acquisition, devices
+        with startup.phase("ni_devices"):
+            isim_devices = devices.NIDeviceGroup(settings=settings)
+        if settings['ni'].get('streaming', False):
+            acq_engine = acquisition.StreamingAcquisitionEngine(mmc, isim_devices, settings)
+        elif settings['ni'].get('compiled_sequence', False):
+            acq_engine = acquisition.CompiledAcquisitionEngine(mmc, isim_devices, settings)
+        else:
+            acq_engine = acquisition.AcquisitionEngine(mmc, isim_devices, settings)
+        live_class = (live.ContinuousLiveEngine if settings['live'].get('continuous', False)
+                      else live.LiveEngine)
+        live_engine = live_class(task=acq_engine.task, mmcore=mmc, settings=settings,
+                                 device_group=isim_devices)
         mmc.mda.set_engine(acq_engine)
 
-        from isim_control.io.monogram import MonogramCC
-        monogram = MonogramCC(mmcore=mmc, publisher=Publisher(broker.pub_queue))
+        with startup.phase("monogram"):
+            from isim_control.io.monogram import MonogramCC
+            monogram = MonogramCC(mmcore=mmc, publisher=Publisher(broker.pub_queue))
         broker.attach(monogram)
         stage = iSIM_StageWidget(mmc)
     except FileNotFoundError:
@@ -91,8 +99,9 @@ def main():
     from isim_control.io.keyboard import KeyboardListener
     key_listener = KeyboardListener(mmc=mmc)
 
-    from isim_control.gui.preview import iSIMPreview
-    preview = iSIMPreview(mmcore=mmc)
+    with startup.phase("preview"):
+        from isim_control.gui.preview import iSIMPreview
+        preview = iSIMPreview(mmcore=mmc)
 
     runner = iSIMRunner(mmc,
                         live_engine=live_engine,
@@ -105,7 +114,9 @@ def main():
     default_settings = copy.deepcopy(settings)
 
     #GUI
-    frame = MainWindow(Publisher(broker.pub_queue), settings)
+    startup.mark("backend_ready")
+    with startup.phase("main_window"):
+        frame = MainWindow(Publisher(broker.pub_queue), settings)
     broker.attach(frame)
     broker.attach(frame.mda_window)
     frame.update_from_settings(default_settings)
@@ -118,35 +129,51 @@ def main():
     group_presets.table_wdg.cellWidget(row,1).setDisabled(True)
     group_presets.show() # needed to keep events alive?
 
-    from isim_control.gui.output import OutputGUI
-    output = OutputGUI(mmc, settings, broker, Publisher(broker.pub_queue))
-
-    from isim_control.gui import position_history
-    history_relay, history_broker, history_process = position_history.main_mp(mmc, output.buffered_datastore)
-
-
     app.installEventFilter(key_listener)
 
     stage.show()
     preview.show()
     frame.show()
     mmc.setProperty("PrimeB_Camera", "PreampOffLimit",10000)
+    startup.mark("window_shown")
+
+    # The output (viewer and writer processes) and the position history import vispy, zarr,
+    # ome_types etc. Start them once the main window is up, the run button is enabled when the
+    # output is ready.
+    output = None
+    history = None
+    def start_output():
+        nonlocal output, history
+        with startup.phase("output"):
+            from isim_control.gui.output import OutputGUI
+            output = OutputGUI(mmc, settings, broker, Publisher(broker.pub_queue))
+        with startup.phase("position_history"):
+            from isim_control.gui import position_history
+            history = position_history.main_mp(mmc, output.buffered_datastore)
+        startup.mark("output_ready")
+        startup.report("main")
+    QTimer.singleShot(100, start_output)
+
     app.exec_()
 
-    # Clean things up
-    history_relay.pub.publish("gui", "shutdown", [])
-    history_relay.pub.publish("stop", "stop", [])
-    history_broker.stop()
-    history_relay.sub.stop()
-    history_process.join()
-    logging.debug("History process closed")
+    # Clean things up, the settings first so they are kept if something below fails
+    full_settings = frame.get_full_settings(runner.settings)
+    save_settings(full_settings)
 
+    # history and output are None if the window was closed before they started or they failed
+    if history is not None:
+        history_relay, history_broker, history_process = history
+        history_relay.pub.publish("gui", "shutdown", [])
+        history_relay.pub.publish("stop", "stop", [])
+        history_broker.stop()
+        history_relay.sub.stop()
+        history_process.join()
+        logging.debug("History process closed")
 
     broker.stop()
-    full_settings = frame.get_full_settings(runner.settings)
-    save_settings(full_settings)
-    output.shutdown()
-    logging.debug("Output GUI closed")
+    if output is not None:
+        output.shutdown()
+        logging.debug("Output GUI closed")
 
     # mmc.setXYPosition(0, 0)
     if monogram:
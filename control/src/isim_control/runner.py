@@ -5,7 +5,9 @@ from isim_control.settings import iSIMSettings
 from isim_control.ni import live, acquisition, devices
 from isim_control.settings_translate import useq_from_settings
 
+import copy
 import time
+from functools import reduce
 from threading import Timer
 
 import logging
@@ -100,26 +102,43 @@ class iSIMRunner:
         self.last_restart = time.perf_counter()
 
     def _on_settings_change(self, keys, value):
-        orig_live_exposure = self.settings['live']['exposure']
+        keys = list(keys)
+        try:
+            # The MDA window sends all settings with keys == [], only what differs is routed
+            old_value = copy.deepcopy(self.settings.get_by_path(keys))
+        except (KeyError, TypeError):
+            old_value = None
         self.settings.set_by_path(keys, value)
-        if keys == ['live', 'exposure'] and orig_live_exposure != value:
-            restart = False
-            self.settings.calculate_ni_settings(value)
-            if self.live_engine.timer:
-                self.live_engine._on_sequence_stopped()
-                restart = True
-            self.mmc.setExposure(self.settings['camera']['exposure']*1000)
-            self.mmc.waitForDevice(self.mmc.getCameraDevice())
-            self.devices.update_settings(self.settings)
-            self.live_engine.update_settings(self.settings)
-            if restart:
-                Timer(0.5, self.live_engine._on_sequence_started).start()
+        paths = [keys + path for path in self.settings.changed_paths(old_value, value)]
+        changed = set().union(*(self.settings.dependents(path) for path in paths))
+        if 'timing' in changed:
+            # Applied between two live frames, the DAQ task and the LiveTimer keep running. The
+            # acquisition timing is calculated when it is started.
+            exposure = self.settings['live']['exposure']
+            self.live_engine.between_frames(lambda: self._apply_live_exposure(exposure))
+        elif 'channel_rows' in changed:
+            # Only the row of this line is rendered again, live uses it with the next frame
+            for path in paths:
+                if path[-2:-1] == ['laser_powers']:
+                    old_power = reduce(lambda d, key: (d or {}).get(key), path[len(keys):],
+                                       old_value)
+                    self.devices.patch_power(path[-1], old_power, live=path[0] == 'live')
+        # Other channel and static rows are made when they are first used, their cache keys have
+        # the powers and the twitcher setting
         self.live_engine.update_settings(self.settings)
         self.acquisition_engine.update_settings(self.settings)
 
         # if keys == ['live', 'channel']:
         #     self.mmc.setProperty("DStateDevice", "Label", value.upper())
 
+    def _apply_live_exposure(self, exposure):
+        if self.acquisition_engine.running.is_set():
+            # Live timing is calculated again when live is started after the acquisition
+            return
+        self.settings.calculate_ni_settings(exposure)
+        self.mmc.setExposure(self.settings['camera']['exposure']*1000)
+        self.mmc.waitForDevice(self.mmc.getCameraDevice())
+        self.devices.update_settings(self.settings)
 
     def stop(self):
         self.sub.stop()
@@ -9,6 +9,21 @@ class iSIMSettings(dict):
     Different components can request views into the dict that are necessary for them to function.
     It includes information for the NIDAQ, pymmcore-plus etc.
     """
+    # What has to be updated if the value at a key path changes, see dependents
+    # timing: calculate_ni_settings, camera exposure and task timing, all waveform rows
+    # channel_rows: AOTF and LED rows, static_rows: galvo, camera and twitcher rows
+    DEPENDENCIES = {
+        ('live', 'exposure'): {'timing', 'static_rows', 'channel_rows'},
+        ('camera', 'readout_time'): {'timing', 'static_rows', 'channel_rows'},
+        ('ni', 'sample_rate'): {'timing', 'static_rows', 'channel_rows'},
+        ('live', 'ni', 'laser_powers'): {'channel_rows'},
+        ('ni', 'laser_powers'): {'channel_rows'},
+        ('live', 'twitchers'): {'static_rows'},
+        ('ni', 'twitchers'): {'static_rows'},
+        ('live', 'fps'): {'live_interval'},
+        ('live', 'channel'): {'live_channel'},
+        ('acquisition',): {'acquisition'},
+    }
     def __init__(
         self,
         laser_powers: dict = {'488': 15, '561': 80, 'led': 50},
@@ -41,15 +56,29 @@ class iSIMSettings(dict):
             self['camera']['readout_time'] = camera_readout_time
 
             self['save'] = True
+            # What the acquisition does if the writer falls behind: block, drop or spill to disk
+            self['writer_policy'] = "block"
             self['path'] = "C:/Users/stepp/Desktop/MyTIFF.ome.tiff"
+            # Append the frames to the tiff as they come instead of making it up front, see
+            # tiff_stream. Cancelled acquisitions don't leave files of the full size behind.
+            self['tiff_streaming'] = True
+            # Chunk sizes of the zarr stores, e.g. {"z": 8}, see ChunkedOMEZarrWriter. None writes
+            # every plane as its own chunk.
+            self['zarr_chunks'] = None
 
             self['ni'] = {}
             self['ni']['twitchers'] = twitchers
             self['ni']['relative_z'] = relative_z
             self['ni']['laser_powers'] = laser_powers
             self['ni']['sample_rate'] = ni_sample_rate
+            # Play a whole time point as one DAQ program, see CompiledAcquisitionEngine
+            self['ni']['compiled_sequence'] = False
+            # Keep the DAQ generating for the whole sequence, see StreamingAcquisitionEngine
+            self['ni']['streaming'] = False
 
             self['live'] = {"channel": "561", "fps": 5, "twitchers": False}
+            # Camera in sequence acquisition and DAQ regenerating, see ContinuousLiveEngine
+            self['live']['continuous'] = False
             self['live']['ni'] = {"laser_powers": {'488': 50, '561': 50, 'led': 100}}
             self['live']['exposure'] = 100
 
@@ -78,6 +107,32 @@ class iSIMSettings(dict):
                                                     self['ni']['sample_rate']))
         self['ni']['total_points'] = self['ni']['exposure_points'] + self['ni']['readout_points']
 
+    def dependents(self, keys: list) -> set[str]:
+        """Everything that depends on the value at keys.
+
+        keys can be more or less specific than the paths in DEPENDENCIES, ['live', 'ni'] affects
+        the live laser powers, ['live', 'ni', 'laser_powers', '488'] only those. Keys that are not
+        known don't need any update.
+        """
+        keys = tuple(keys)
+        affected = set()
+        for path, dependents in self.DEPENDENCIES.items():
+            n_common = min(len(path), len(keys))
+            if path[:n_common] == keys[:n_common]:
+                affected |= dependents
+        return affected
+
+    @staticmethod
+    def changed_paths(old, new) -> list[list]:
+        """Key paths, relative to old and new, of the values that differ between them."""
+        if not isinstance(old, dict) or not isinstance(new, dict):
+            return [] if old == new else [[]]
+        paths = []
+        for key in old.keys() | new.keys():
+            for path in iSIMSettings.changed_paths(old.get(key), new.get(key)):
+                paths.append([key, *path])
+        return paths
+
     def get_by_path(self, items):
         """Access a nested object by item sequence."""
         return reduce(operator.getitem, items, self)
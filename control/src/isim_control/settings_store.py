@@ -0,0 +1,213 @@
+"""Settings and system state in shared memory, so the processes don't get them with every message.
+
+The output GUI writes the iSIMSettings and the system state of the core into a SettingsStore. Every
+update gets a new version, the other processes are only sent the version and the keys that changed
+and read the snapshot from the store when they need it. The system state is kept up to date in the
+background by SystemStateCache instead of calling getSystemState, which takes about a second.
+"""
+from __future__ import annotations
+
+import logging
+import pickle
+import time
+from multiprocessing import shared_memory
+from threading import Event, Lock, Thread
+
+import numpy as np
+from pymmcore_plus import CMMCorePlus
+
+logger = logging.getLogger(__name__)
+
+# seq is odd while the producer writes, version counts the updates, length of the pickled data
+_HEADER = np.dtype([("seq", "i8"), ("version", "i8"), ("length", "i8")])
+
+
+class SettingsStore:
+    """Versioned snapshot of named sections, e.g. "settings" and "system_state".
+
+    The process that creates the store is the only one that calls update, the others attach with
+    the name and call snapshot.
+    """
+    def __init__(self, name: str|None = None, create: bool = False, size: int = 2**20):
+        self._writeable = create
+        self._shm = shared_memory.SharedMemory(name=name, create=create,
+                                               size=size if create else 0)
+        self.header = np.ndarray((), _HEADER, buffer=self._shm.buf)
+        self.data = np.ndarray((self._shm.size - _HEADER.itemsize,), np.uint8,
+                               buffer=self._shm.buf, offset=_HEADER.itemsize)
+        if create:
+            self.header[()] = (0, 0, 0)
+        self.sections = {}
+        self._version = -1
+        self.lock = Lock()
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def version(self) -> int:
+        return int(self.header["version"])
+
+    def update(self, **sections) -> int:
+        """Replace the given sections, returns the new version."""
+        with self.lock:
+            self.sections.update(sections)
+            data = np.frombuffer(pickle.dumps(self.sections, pickle.HIGHEST_PROTOCOL), np.uint8)
+            if data.size > self.data.size:
+                raise ValueError(f"Settings of {data.size} bytes don't fit into the store of "
+                                 f"{self.data.size} bytes")
+            header = self.header.reshape(1)
+            header["seq"] += 1
+            self.data[:data.size] = data
+            header["length"] = data.size
+            header["version"] += 1
+            header["seq"] += 1
+            self._version = int(header["version"][0])
+            return self._version
+
+    def snapshot(self, timeout: float = 1., version: int|None = None) -> tuple[int, dict]:
+        """Version and sections of the last update, only unpickled if the version changed.
+
+        The store only has the last update. If version is given and the store has moved on since,
+        this is logged as an error and the newer sections are returned.
+        """
+        loaded, sections = self._snapshot(timeout)
+        if version is not None and loaded != version:
+            logger.error(f"Settings version {version} was asked for, the store has {loaded}")
+        return loaded, sections
+
+    def _snapshot(self, timeout: float) -> tuple[int, dict]:
+        t0 = time.perf_counter()
+        while True:
+            seq = int(self.header["seq"])
+            if seq % 2 == 0:
+                version = int(self.header["version"])
+                if version == self._version:
+                    return version, self.sections
+                data = self.data[:int(self.header["length"])].tobytes()
+                if int(self.header["seq"]) == seq:
+                    self.sections = pickle.loads(data) if data else {}
+                    self._version = version
+                    return version, self.sections
+            if time.perf_counter() - t0 > timeout:
+                raise TimeoutError("Settings store is not updated")
+            time.sleep(0.001)
+
+    def get(self, section: str, default=None):
+        return self.snapshot()[1].get(section, default)
+
+    def close(self) -> None:
+        self.header = None
+        self.data = None
+        self._shm.close()
+        if self._writeable:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                logger.debug("Settings store %s was already unlinked", self._shm.name)
+
+
+class SystemStateCache:
+    """getSystemState().dict() of the core, kept current in the background.
+
+    It starts from getSystemStateCache, which does not ask the devices, and then sweeps all device
+    properties in a thread. After that, the propertyChanged events keep it up to date and a sweep
+    every interval seconds catches what the devices changed without telling. hold is set while live
+    or an acquisition runs, the periodic sweeps are skipped then and a running sweep is cancelled,
+    so they don't compete with them for the core. state can be read at any time without waiting, changed has the
+    devices that changed since the last pop_changed.
+    """
+    def __init__(self, mmcore: CMMCorePlus, interval: float|None = 60.):
+        self._mmc = mmcore
+        self.interval = interval
+        self.sweeps = 0
+        self._lock = Lock()
+        self._cancel = Event()
+        self._stop = Event()
+        self._held = False
+        self._sweep_thread = None
+        # Events during a sweep, they are newer than what the sweep read
+        self._pending = None
+        self.state = self._mmc.getSystemStateCache().dict()
+        self.changed = set(self.state)
+        self._mmc.events.propertyChanged.connect(self._on_property_changed)
+        self._mmc.events.systemConfigurationLoaded.connect(self.refresh)
+        self.refresh()
+        if interval:
+            Thread(target=self._reconcile, name="system_state_reconcile", daemon=True).start()
+
+    def refresh(self, block: bool = False):
+        """Sweep all device properties in the background, if there is no sweep running."""
+        with self._lock:
+            if self._sweep_thread is None or not self._sweep_thread.is_alive():
+                self._cancel.clear()
+                self._pending = {}
+                self._sweep_thread = Thread(target=self._sweep, name="system_state_sweep",
+                                            daemon=True)
+                self._sweep_thread.start()
+            thread = self._sweep_thread
+        if block:
+            thread.join()
+
+    def cancel(self, *_):
+        self._cancel.set()
+
+    def hold(self, held: bool = True):
+        """No periodic sweeps while held, a running one is cancelled."""
+        self._held = held
+        if held:
+            self.cancel()
+
+    def stop(self):
+        self._stop.set()
+        self.cancel()
+
+    def _sweep(self):
+        t0 = time.perf_counter()
+        state = {}
+        for device in self._mmc.getLoadedDevices():
+            if self._cancel.is_set():
+                logger.debug("System state sweep cancelled")
+                with self._lock:
+                    self._pending = None
+                return
+            properties = {}
+            try:
+                for prop in self._mmc.getDevicePropertyNames(device):
+                    properties[prop] = self._mmc.getProperty(device, prop)
+            except RuntimeError as e:
+                logger.debug(f"Could not read the properties of {device}: {e}")
+                properties = self.state.get(device, {})
+            state[device] = properties
+        with self._lock:
+            for (device, prop), value in self._pending.items():
+                state.setdefault(device, {})[prop] = value
+            self._pending = None
+            self.changed |= {device for device in state.keys() | self.state.keys()
+                             if state.get(device) != self.state.get(device)}
+            self.state = state
+            self.sweeps += 1
+        logger.debug(f"System state sweep took {time.perf_counter() - t0:.2f} s")
+
+    def _reconcile(self):
+        while not self._stop.wait(self.interval):
+            if not self._held and not self._mmc.mda.is_running():
+                self.refresh()
+
+    def _on_property_changed(self, device: str, prop: str, value: str):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[(device, prop)] = value
+            self.state.setdefault(device, {})[prop] = value
+            self.changed.add(device)
+
+    def snapshot(self) -> dict:
+        """Copy of state, the property events can't change it while it is pickled."""
+        with self._lock:
+            return {device: dict(properties) for device, properties in self.state.items()}
+
+    def pop_changed(self) -> set[str]:
+        with self._lock:
+            changed, self.changed = self.changed, set()
+        return changed
@@ -0,0 +1,140 @@
+"""Startup profile, how long the imports and the init steps of every process take.
+
+Set ISIM_STARTUP_PROFILE to a file name to switch it on. isim_control/__init__ then times every
+module that is imported for the first time, and run.main and the worker processes time their init
+steps with phase. report appends one JSON line per record to the file, with the process name and
+pid, so the main process and the subprocesses can write to the same file. To see the breakdown:
+
+    python -m isim_control.startup startup.jsonl
+
+lazy_import is for heavy modules that are only needed later, the module is loaded on the first
+attribute access.
+"""
+from __future__ import annotations
+
+import builtins
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+ENV = "ISIM_STARTUP_PROFILE"
+
+_t0 = time.perf_counter()
+_records = []
+_stack = []
+_original_import = None
+
+
+def enabled() -> bool:
+    return bool(os.environ.get(ENV))
+
+
+def lazy_import(name: str):
+    """Module name, only executed when one of its attributes is used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    # Time spent in nested imports is subtracted from the self time of the parent
+    _stack.append(0.)
+    t0 = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        total = time.perf_counter() - t0
+        nested = _stack.pop()
+        if _stack:
+            _stack[-1] += total
+        _records.append({"kind": "import", "name": name, "seconds": total,
+                         "self": total - nested, "depth": len(_stack)})
+
+
+def install():
+    """Time all imports from here on, see the module docstring."""
+    global _original_import
+    if _original_import is None:
+        _original_import = builtins.__import__
+        builtins.__import__ = _timed_import
+
+
+@contextmanager
+def phase(name: str):
+    """Time an init step, nested imports are counted in it as well."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _original_import is not None:
+            _records.append({"kind": "phase", "name": name,
+                             "seconds": time.perf_counter() - t0})
+
+
+def mark(name: str):
+    """Seconds since the process started importing isim_control, e.g. window shown."""
+    if _original_import is not None:
+        _records.append({"kind": "mark", "name": name, "seconds": time.perf_counter() - _t0})
+
+
+def report(process: str|None = None):
+    """Append the records so far to the file in ISIM_STARTUP_PROFILE."""
+    if not enabled() or _original_import is None:
+        return
+    process = process or multiprocessing.current_process().name
+    records = [{"process": process, "pid": os.getpid(), **record} for record in _records]
+    _records.clear()
+    with open(os.environ[ENV], "a") as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+
+
+def summary(path: str, top: int = 15) -> dict:
+    """Per process: the marks, the phases and the top level packages with the most import time."""
+    processes = {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            process = processes.setdefault(f"{record['process']} ({record['pid']})",
+                                           {"imports": {}, "phases": {}, "marks": {}})
+            if record["kind"] == "import":
+                package = record["name"].split(".")[0]
+                imports = process["imports"]
+                imports[package] = imports.get(package, 0.) + record["self"]
+            else:
+                process[record["kind"] + "s"][record["name"]] = record["seconds"]
+    for process in processes.values():
+        process["imports"] = dict(sorted(process["imports"].items(), key=lambda item: -item[1])
+                                  [:top])
+    return processes
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Summarize an iSIM startup profile")
+    parser.add_argument("path")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+    result = summary(args.path)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for process, data in result.items():
+            print(process)
+            for kind in ("marks", "phases", "imports"):
+                for name, seconds in data[kind].items():
+                    print(f"  {kind[:-1]:7s} {name:40s} {seconds:8.3f} s")
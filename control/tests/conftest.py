@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+import useq
+
+
+@pytest.fixture
+def sequence():
+    """2 time points of 5 z planes, z is the fast axis."""
+    return useq.MDASequence(time_plan={"interval": 0, "loops": 2},
+                            z_plan={"range": 4, "step": 1},
+                            axis_order="tpcz")
+
+
+@pytest.fixture
+def run(sequence):
+    """Feeds the first n_frames of sequence to a writer, returns the frames by (t, z)."""
+    def run(writer, n_frames=None):
+        frames = {}
+        writer.sequenceStarted(sequence)
+        for event in list(sequence)[:n_frames]:
+            frame = np.random.randint(0, 4000, (32, 24), dtype=np.uint16)
+            frames[(event.index["t"], event.index["z"])] = frame
+            writer.frameReady(frame, event, {})
+        return frames
+    return run
@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from useq import MDAEvent
+
+pytest.importorskip("pymmcore_plus")
+from isim_control.io.buffered_datastore import BufferedDataStore
+from isim_control.io.frame_pool import FrameOverwritten
+from isim_control.io.remote_datastore import RemoteDatastore
+
+CAPACITY = int(1E5)
+
+
+class Signal:
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self, callback):
+        self.callbacks.append(callback)
+
+
+class StubCore:
+    """Only what BufferedDataStore asks of the core."""
+    def __init__(self):
+        self.events = SimpleNamespace(liveFrameReady=Signal())
+        self.mda = SimpleNamespace(events=SimpleNamespace(sequenceStarted=Signal(),
+                                                          frameReady=Signal()))
+
+    def getImageWidth(self):
+        return 64
+
+    def getImageHeight(self):
+        return 64
+
+
+class RecordingPublisher:
+    def __init__(self, name):
+        self.name = name
+        self.messages = []
+
+    def publish(self, topic, message, values):
+        self.messages.append((message, values))
+
+
+@pytest.fixture
+def datastore():
+    datastore = BufferedDataStore(mmcore=StubCore(), create=True, capacity=CAPACITY,
+                                  slot_size=64*64)
+    remote = RemoteDatastore(datastore.name)
+    yield datastore, remote
+    remote.remote.close()
+    datastore.close()
+
+
+def test_connects_to_the_core(datastore):
+    datastore, _ = datastore
+    mmc = datastore.mmc
+    assert mmc.mda.events.frameReady.callbacks == [datastore.new_frame]
+    assert mmc.mda.events.sequenceStarted.callbacks == [datastore.sequence_started]
+    assert mmc.events.liveFrameReady.callbacks == []
+
+
+def test_frames_reach_the_consumers(datastore):
+    datastore, remote = datastore
+    writer, viewer = RecordingPublisher("writer"), RecordingPublisher("viewer")
+    datastore.add_publisher(writer, "block")
+    datastore.add_publisher(viewer)
+    frame = np.arange(64*64, dtype=np.uint16).reshape(64, 64)
+    event = MDAEvent(index={"t": 1, "c": 0}, channel={"config": "488"}, exposure=20)
+    datastore.new_frame(frame, event, {"Camera": "Demo", "ElapsedTime-ms": 5.})
+    datastore.new_frame(frame + 1, event, {"Camera": "Demo", "Binning": "2",
+                                           "ElapsedTime-ms": 10.})
+
+    (message, values), = writer.messages[:1]
+    assert message == "new_frame"
+    assert datastore.pinned(values[0])
+    data, read_event, meta = remote.read(*values)
+    np.testing.assert_array_equal(data, frame)
+    assert read_event.index == {"t": 1, "c": 0}
+    assert read_event.channel.config == "488"
+    assert meta == {"Camera": "Demo", "ElapsedTime-ms": 5.}
+    assert not datastore.held(values[0][0])
+    # The second frame only carries what changed, the elapsed time is in the descriptor
+    assert writer.messages[1][1][2] == {"Binning": "2"}
+    # The viewer does not pin
+    assert viewer.messages[0][1][0][2] == datastore.column(viewer)
+    assert not datastore.pinned(viewer.messages[0][1][0])
+
+    stats = datastore.stats()
+    assert stats["writer"]["sent"] == 2 and stats["writer"]["read"] == 1
+    assert stats["writer"]["held_slots"] == 1
+    datastore.sequence_started()
+    assert datastore.stats()["writer"]["sent"] == 0
+    assert datastore.last_meta["new_frame"] is None
+
+
+def test_overwritten_frames_are_lost(datastore):
+    datastore, remote = datastore
+    viewer = RecordingPublisher("viewer")
+    datastore.add_publisher(viewer)
+    event = MDAEvent(index={"t": 0})
+    for n in range(datastore.n_slots + 1):
+        datastore.new_frame(np.full((64, 64), n, np.uint16), event, {})
+    with pytest.raises(FrameOverwritten):
+        remote.read(*viewer.messages[0][1])
+    assert datastore.stats()["viewer"]["lost"] == 1
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from isim_control.io.frame_pool import SharedFramePool, FrameOverwritten, _HEAD, _RECORD
+
+SLOT_SIZE = 64
+
+
+@pytest.fixture
+def pool():
+    # Room for exactly two slots
+    pool = SharedFramePool(create=True, capacity=_HEAD + 2*(_RECORD.itemsize + 2*SLOT_SIZE),
+                           slot_size=SLOT_SIZE, dtype=np.uint16)
+    consumer = SharedFramePool(name=pool.name)
+    yield pool, consumer
+    consumer.close()
+    pool.close()
+
+
+def frame(value):
+    return np.full((8, 8), value, np.uint16)
+
+
+def test_wraps_around_and_detects_overwrite(pool):
+    pool, consumer = pool
+    assert pool.n_slots == 2
+    handles = [(*pool.put(frame(i)), -1) for i in range(3)]
+    assert handles[2][0] == handles[0][0]
+    with pytest.raises(FrameOverwritten):
+        consumer.get(handles[0])
+    np.testing.assert_array_equal(consumer.get(handles[1]), frame(1))
+    np.testing.assert_array_equal(consumer.get(handles[2]), frame(2))
+
+
+def test_pinned_slots_are_not_reused(pool):
+    pool, consumer = pool
+    handles = [(*pool.put(frame(i), pin=(0,)), 0) for i in range(2)]
+    assert consumer.pinned(handles[0])
+    with pytest.raises(TimeoutError):
+        pool.put(frame(2), timeout=0.05)
+    np.testing.assert_array_equal(consumer.get(handles[0]), frame(0))
+    assert not pool.held(handles[0][0])
+    slot, _ = pool.put(frame(2), timeout=0.05)
+    assert slot == handles[0][0]
+    assert pool.held_by(0)[0] == 1
+    pool.release_all(0)
+    assert pool.held_by(0)[0] == 0
+    assert not consumer.pinned(handles[1])
+
+
+def test_spills_the_oldest_frame(pool):
+    pool, consumer = pool
+    pool.spill_columns = {1}
+    handles = [(*pool.put(frame(i), pin=(1,)), 1) for i in range(2)]
+    pool.put(frame(2), pin=(1,), timeout=0.05)
+    assert pool.spilled == 1
+    assert not consumer.pinned(handles[0])
+    with pytest.raises(FrameOverwritten):
+        consumer.get(handles[0])
+    spilled, _ = consumer.unspill(handles[0])
+    np.testing.assert_array_equal(spilled, frame(0))
+    assert consumer.unspill(handles[0]) is None
+    np.testing.assert_array_equal(consumer.get(handles[1]), frame(1))
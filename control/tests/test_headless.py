@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip("nidaqmx")
+pytest.importorskip("pymmcore_plus.mda")
+from useq import MDASequence
+
+from isim_control.ni.simulated import headless_setup, headless_teardown
+from isim_control.settings import iSIMSettings
+
+
+@pytest.mark.parametrize("engine", ["event", "compiled", "streaming", "timed"])
+def test_sequence_on_engine(engine):
+    settings = iSIMSettings(time_plan={"interval": 0, "loops": 3},
+                            channels=({"config": "488", "exposure": 100},
+                                      {"config": "561", "exposure": 100}))
+    setup = headless_setup(settings, engine=engine)
+    frames = []
+    setup["mmc"].mda.events.frameReady.connect(lambda img, event, *_: frames.append(event.index))
+    try:
+        setup["acq_engine"].adjust_camera_exposure(settings['camera']['exposure']*1000)
+        setup["mmc"].mda.run(MDASequence(**settings['acquisition']))
+    finally:
+        headless_teardown(setup)
+    assert len(frames) == 6
+    assert {(index["t"], index["c"]) for index in frames} == {(t, c) for t in range(3)
+                                                            for c in range(2)}
@@ -0,0 +1,29 @@
+import re
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ome_types")
+from isim_control.io.ome_metadata import PlaneTable
+
+
+def test_plane_table_grows_and_writes_xml():
+    table = PlaneTable(capacity=2)
+    for n in range(5):
+        table.append(the_c=n % 2, the_z=0, the_t=n // 2, ifd=n, delta_t=10.*n,
+                     exposure=None, position_x=1.5, position_y=None, position_z=None)
+    assert len(table) == 5
+    assert len(table.data) >= 5
+    np.testing.assert_array_equal(table.planes["ifd"], np.arange(5))
+
+    xml = "".join(table.iter_xml(prefix="ome:", batch=2))
+    tiff_data = re.findall(r"<ome:TiffData [^>]*/>", xml)
+    planes = re.findall(r"<ome:Plane [^>]*/>", xml)
+    assert len(tiff_data) == len(planes) == 5
+    # All TiffData elements come before the planes
+    assert xml.index("<ome:Plane ") > xml.rindex("<ome:TiffData ")
+    assert 'FirstC="1" FirstT="1" FirstZ="0" IFD="3"' in tiff_data[3]
+    assert 'DeltaT="40.0"' in planes[4]
+    # Missing values are left out
+    assert "ExposureTime" not in planes[0] and "PositionY" not in planes[0]
+    assert 'PositionX="1.5"' in planes[0]
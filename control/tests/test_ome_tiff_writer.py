@@ -0,0 +1,61 @@
+import re
+
+import numpy as np
+import pytest
+import useq
+
+pytest.importorskip("psygnal")
+pytest.importorskip("pymmcore_plus.mda.handlers")
+from isim_control.io.ome_tiff_writer import OMETiffWriter
+
+
+SEQUENCE = useq.MDASequence(time_plan={"interval": 0, "loops": 4})
+
+
+def test_barrier_raises_after_failed_writes(tmp_path, monkeypatch):
+    writer = OMETiffWriter(tmp_path/"acq")
+    write = writer._write
+
+    def fail_second(frame, event, meta):
+        if event.index["t"] == 1:
+            raise OSError("Disk full")
+        write(frame, event, meta)
+    monkeypatch.setattr(writer, "_write", fail_second)
+
+    writer.sequenceStarted(SEQUENCE)
+    done = []
+    for event in SEQUENCE:
+        writer.frameReady(np.zeros((8, 8), np.uint16), event, {}, done=lambda: done.append(1))
+    with pytest.raises(RuntimeError, match="1 frames"):
+        writer.barrier()
+    # The frame that failed is let go as well
+    assert len(done) == 4
+    # Counted once, the next barrier only reports new failures
+    writer.barrier()
+    writer.close()
+
+
+def test_streamed_planes_mapped_from_index(tmp_path):
+    tifffile = pytest.importorskip("tifffile")
+    writer = OMETiffWriter(tmp_path/"acq", write_behind=False, streaming=True)
+    sequence = useq.MDASequence(time_plan={"interval": 0, "loops": 3},
+                                channels=["488", "561"], axis_order="tc")
+    writer.sequenceStarted(sequence)
+    events = list(sequence)
+    # Out of order and the last plane is missing, like a cancelled acquisition
+    order = [1, 0, 3, 2, 4]
+    for n in order:
+        frame = np.full((8, 8), n, np.uint16)
+        writer.frameReady(frame, events[n], {})
+    writer.sequenceFinished(sequence)
+
+    with tifffile.TiffFile(tmp_path/"acq"/"acq.ome.tiff") as tif:
+        xml = tif.ome_metadata
+        pages = [page.asarray()[0, 0] for page in tif.pages]
+    assert pages == order
+    tiff_data = re.findall(r'<TiffData FirstC="(\d+)" FirstT="(\d+)" FirstZ="0" IFD="(\d+)"', xml)
+    for c, t, ifd in tiff_data:
+        # The page has the plane the TiffData says
+        assert pages[int(ifd)] == 2*int(t) + int(c)
+    assert len(tiff_data) == 5
+    assert 'SizeT="3"' in xml and 'SizeC="2"' in xml
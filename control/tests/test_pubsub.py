@@ -0,0 +1,62 @@
+import logging
+import multiprocessing
+
+from isim_control.pubsub import Broker, Publisher, Subscriber
+
+
+class Recorder:
+    def __init__(self):
+        self.received = []
+        self.sub = Subscriber(["frames"], {"new_frame": [self.received.append]})
+
+
+def test_queued_publisher_keeps_order():
+    pub_queue = multiprocessing.Queue()
+    publisher = Publisher(pub_queue)
+    # No broker yet, these go through the pub_queue
+    for n in range(50):
+        publisher.publish("frames", "new_frame", [n])
+    broker = Broker(pub_queue, auto_start=False)
+    recorder = Recorder()
+    broker.attach(recorder)
+    broker.start()
+    # The broker runs now, but the publisher must not overtake what it queued
+    for n in range(50, 100):
+        publisher.publish("frames", "new_frame", [n])
+    broker.stop()
+    broker.join(5)
+    recorder.sub.join(5)
+    assert recorder.received == list(range(100))
+
+
+def test_stop_routes_queued_messages(caplog):
+    pub_queue = multiprocessing.Queue()
+    publisher = Publisher(pub_queue)
+    for n in range(200):
+        publisher.publish("frames", "new_frame", [n])
+    broker = Broker(pub_queue, auto_start=False)
+    recorder = Recorder()
+    broker.attach(recorder)
+    broker.start()
+    # Right away, most messages are still in the pub_queue
+    broker.stop()
+    broker.join(5)
+    recorder.sub.join(5)
+    assert not broker.is_alive() and not recorder.sub.is_alive()
+    assert recorder.received == list(range(200))
+
+    with caplog.at_level(logging.WARNING, logger="isim_control.pubsub"):
+        broker.route("frames", "new_frame", [200])
+    assert "dropped" in caplog.text
+    assert recorder.received[-1] == 199
+
+
+def test_stop_without_running_broker():
+    broker = Broker(auto_start=False)
+    recorder = Recorder()
+    broker.attach(recorder)
+    broker.route("frames", "new_frame", [0])
+    broker.stop()
+    recorder.sub.join(5)
+    assert not recorder.sub.is_alive()
+    assert recorder.received == [0]
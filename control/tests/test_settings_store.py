@@ -0,0 +1,66 @@
+import logging
+from threading import Thread
+
+import pytest
+
+pytest.importorskip("pymmcore_plus")
+from isim_control.settings_store import SettingsStore
+
+
+@pytest.fixture
+def stores():
+    store = SettingsStore(create=True, size=2**16)
+    reader = SettingsStore(store.name)
+    yield store, reader
+    reader.close()
+    store.close()
+
+
+def test_snapshot_during_updates(stores):
+    store, reader = stores
+    n_updates = 500
+    errors = []
+
+    def update():
+        for n in range(1, n_updates + 1):
+            store.update(settings={"n": n, "values": [n]*200}, system_state={"n": n})
+
+    def read():
+        last = 0
+        while last < n_updates:
+            version, sections = reader.snapshot(timeout=5)
+            if not sections:
+                continue
+            n = sections["settings"]["n"]
+            # Torn or mixed reads would have sections of different updates
+            if (sections["settings"]["values"] != [n]*200 or sections["system_state"]["n"] != n
+                    or version != n or n < last):
+                errors.append((version, sections))
+                return
+            last = n
+
+    threads = [Thread(target=update)] + [Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not errors
+    assert reader.snapshot()[0] == store.version == n_updates
+
+
+def test_unchanged_version_is_not_unpickled_again(stores):
+    store, reader = stores
+    version = store.update(settings={"path": "a"})
+    _, first = reader.snapshot()
+    assert reader.snapshot() == (version, first)
+    assert reader.snapshot()[1] is first
+
+
+def test_newer_version_is_logged(stores, caplog):
+    store, reader = stores
+    version = store.update(settings={"path": "a"})
+    store.update(settings={"path": "b"})
+    with caplog.at_level(logging.ERROR):
+        loaded, sections = reader.snapshot(version=version)
+    assert loaded == version + 1 and sections["settings"]["path"] == "b"
+    assert "version" in caplog.text
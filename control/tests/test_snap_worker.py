@@ -0,0 +1,92 @@
+from threading import Event
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pymmcore_plus")
+from isim_control.ni.snap_worker import SnapWorker
+
+
+class TriggeredCore:
+    """snapImage blocks until the test triggers it, like the camera waiting for the DAQ."""
+    def __init__(self, fail: bool = False):
+        self.trigger = Event()
+        self.fail = fail
+        self.snaps = 0
+
+    def snapImage(self):
+        if not self.trigger.wait(5):
+            raise RuntimeError("Not triggered")
+        self.trigger.clear()
+        if self.fail:
+            raise RuntimeError("Camera error")
+        self.snaps += 1
+
+    def getTags(self):
+        return {"snap": self.snaps}
+
+    def getImage(self, fix=False):
+        return np.full((4, 4), self.snaps, np.uint16)
+
+
+@pytest.fixture
+def worker():
+    workers = []
+
+    def make(core, n_slots=2):
+        workers.append(SnapWorker(core, n_slots=n_slots, name="test_snap"))
+        return workers[-1]
+    yield make
+    for snapper in workers:
+        snapper.stop()
+        snapper.join(1)
+        assert not snapper.is_alive() and not snapper.dispatcher.is_alive()
+
+
+def test_states_in_order(worker):
+    core = TriggeredCore()
+    snapper = worker(core)
+    frames = []
+    slot = snapper.submit("event", lambda slot: frames.append((slot.data, slot.image[0, 0])),
+                          data="timing")
+    assert slot.wait("armed", 1)
+    assert not slot.triggered.is_set() and not slot.free.is_set()
+    core.trigger.set()
+    assert slot.wait("free", 1)
+    assert frames == [("timing", 1)]
+    assert slot.meta == {"snap": 1} and slot.error is None
+    # The image is let go after the callback
+    assert slot.image is None
+    states = ["submitted", "armed", "triggered", "read_out", "free"]
+    times = [slot.times[state] for state in states]
+    assert times == sorted(times)
+
+
+def test_failed_snap_sets_every_state(worker):
+    core = TriggeredCore(fail=True)
+    snapper = worker(core)
+    frames = []
+    slot = snapper.submit(callback=frames.append)
+    core.trigger.set()
+    assert slot.wait("free", 1)
+    assert slot.armed.is_set() and slot.triggered.is_set() and slot.read_out.is_set()
+    assert isinstance(slot.error, RuntimeError)
+    assert frames == []
+
+
+def test_full_ring_times_out(worker):
+    core = TriggeredCore()
+    snapper = worker(core, n_slots=2)
+    first = snapper.submit()
+    snapper.submit()
+    with pytest.raises(TimeoutError):
+        snapper.submit(timeout=0.05)
+    core.trigger.set()
+    assert first.wait("free", 1)
+    # The first slot is used again once it is free
+    assert snapper.submit(timeout=1) is first
+    core.trigger.set()
+    assert first.wait("armed", 1)
+    core.trigger.set()
+    assert first.wait("free", 1)
+    assert snapper.snaps == 3
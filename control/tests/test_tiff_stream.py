@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from isim_control.io.tiff_stream import PLACEHOLDER, PlaneIndex, StreamingTiff, index_path
+
+tifffile = pytest.importorskip("tifffile")
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "stream.ome.tiff"
+    stream = StreamingTiff(path)
+    frames = {}
+    for t in range(2):
+        for c in range(2):
+            frames[(t, c)] = np.random.randint(0, 4000, (16, 12), dtype=np.uint16)
+            assert stream.write(frames[(t, c)], {"t": t, "c": c}) == 2*t + c
+    stream.flush()
+
+    # Planes can be read while the file is still open
+    index = PlaneIndex(path)
+    assert len(index) == 4
+    np.testing.assert_array_equal(index.read(t=1, c=0), frames[(1, 0)])
+    with pytest.raises(KeyError):
+        index.read(t=2, c=0)
+
+    stream.close("<OME>done</OME>")
+    assert index_path(path).exists()
+    with tifffile.TiffFile(path) as tif:
+        assert len(tif.pages) == 4
+        assert tif.pages[0].description == "<OME>done</OME>"
+        np.testing.assert_array_equal(tif.pages[3].asarray(), frames[(1, 1)])
+    index.refresh()
+    np.testing.assert_array_equal(index.read(t=0, c=1), frames[(0, 1)])
+
+
+def test_placeholder_without_description(tmp_path):
+    path = tmp_path / "cut.ome.tiff"
+    stream = StreamingTiff(path)
+    stream.write(np.zeros((4, 4), np.uint16), {"t": 0})
+    stream.close()
+    with tifffile.TiffFile(path) as tif:
+        assert tif.pages[0].description == PLACEHOLDER
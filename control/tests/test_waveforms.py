@@ -0,0 +1,102 @@
+"""The segment table waveforms against the ones built with np.concatenate before."""
+import numpy as np
+import pytest
+import useq
+from scipy import ndimage
+
+from isim_control.ni.devices import NIDeviceGroup
+from isim_control.settings import iSIMSettings
+
+GALVO_AMP, GALVO_OFFSET = 0.2346, -0.075
+
+
+def make_pulse(start, end, offset, n_points):
+    duty_cycle = 10/n_points
+    up = np.ones(round(duty_cycle*n_points))*start
+    down = np.ones(n_points-round(duty_cycle*n_points))*end
+    return np.concatenate((up, down)) + offset
+
+
+def old_galvo(ni):
+    readout_length = ni['readout_points']
+    galvo_frame = np.linspace(-GALVO_AMP, GALVO_AMP, ni['exposure_points'])
+    overshoot_points = int(np.ceil(round(readout_length/20)/2))
+    scan_increment = galvo_frame[-1] - galvo_frame[-2]
+    overshoot_amp = scan_increment * (overshoot_points + 1)
+    overshoot_0 = np.linspace(-GALVO_AMP - overshoot_amp, -GALVO_AMP - scan_increment,
+                              overshoot_points)
+    overshoot_1 = np.linspace(GALVO_AMP + scan_increment, GALVO_AMP + overshoot_amp,
+                              overshoot_points)
+    frame = np.hstack((overshoot_0, galvo_frame, overshoot_1)) + GALVO_OFFSET
+    readout_length = readout_length - overshoot_points
+    delay0 = np.linspace(GALVO_OFFSET, -GALVO_AMP + GALVO_OFFSET - overshoot_amp,
+                         int(np.floor(readout_length*0.9)))
+    delay0 = np.hstack([delay0, np.ones(int(np.ceil(readout_length*0.1)))*delay0[-1]])
+    delay1 = np.linspace(GALVO_OFFSET + GALVO_AMP + overshoot_amp, GALVO_OFFSET,
+                         int(np.floor(readout_length*0.5)))
+    delay11 = np.ones(int(np.ceil(readout_length*0.5)))*GALVO_OFFSET
+    return np.hstack([delay0, frame, delay1, delay11])
+
+
+def old_camera(ni):
+    readout_delay = np.zeros(ni['readout_points'])
+    return np.hstack([make_pulse(5, 0, 0, ni['exposure_points']), readout_delay, readout_delay])
+
+
+def old_twitcher(ni, n_waves=240, amp=0.07, offset=5):
+    points_per_wave = int(np.ceil(ni['exposure_points']/n_waves))
+    up = np.linspace(-1, 1, points_per_wave//2 + 1)
+    down = np.linspace(1, -1, points_per_wave//2 + 1)
+    start = np.linspace(0, -1, points_per_wave//4 + 1)
+    end = np.linspace(-1, 0, points_per_wave//4 + 1)
+    frame = np.hstack((start[:-1], np.tile(np.hstack((up[:-1], down[:-1])),
+                                           round(n_waves + 20)), end))
+    missing_points = ni['total_points'] + ni['readout_points'] - frame.shape[0]
+    frame = np.hstack([np.ones(int(np.floor(missing_points/2)))*frame[0], frame,
+                       np.ones(int(np.ceil(missing_points/2)))*frame[-1]])
+    frame = ndimage.gaussian_filter1d(frame, points_per_wave/20)
+    return frame*(amp/frame.max()) + offset
+
+
+def old_aotf(ni, channel, powers):
+    n_points = ni['exposure_points']
+    blank = np.ones(n_points)*10
+    aotf_488, aotf_561 = np.zeros(n_points), np.zeros(n_points)
+    if channel == '488':
+        aotf_488 = np.ones(n_points)*powers['488']/10
+    elif channel == '561':
+        aotf_561 = np.ones(n_points)*powers['561']/10
+    else:
+        blank = np.zeros(n_points)
+    readout_delay = np.zeros((3, ni['readout_points']))
+    return np.hstack([readout_delay, np.vstack((blank, aotf_488, aotf_561)), readout_delay])
+
+
+@pytest.fixture
+def devices():
+    devices = NIDeviceGroup(iSIMSettings(), simulated=True)
+    yield devices
+    devices.task.close()
+
+
+@pytest.mark.parametrize("twitchers", [False, True])
+@pytest.mark.parametrize("sample_rate", [20_000, 60_066])
+@pytest.mark.parametrize("exposure", [1, 3, 10, 20, 100])
+def test_rows_match_the_concatenated_waveforms(devices, exposure, sample_rate, twitchers):
+    settings = iSIMSettings(ni_sample_rate=sample_rate, twitchers=twitchers)
+    settings.calculate_ni_settings(exposure)
+    devices.update_settings(settings)
+    ni = settings['ni']
+    n_points = devices.n_points()
+
+    static = devices.static_rows(twitchers)
+    np.testing.assert_allclose(static[0], old_galvo(ni)[:n_points], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(static[1], old_camera(ni)[:n_points], rtol=0, atol=1e-12)
+    twitcher = old_twitcher(ni)[:n_points] if twitchers else np.full(n_points, 5.)
+    np.testing.assert_allclose(static[2], twitcher, rtol=0, atol=1e-12)
+
+    powers = ni['laser_powers']
+    for channel in ("488", "561", "LED"):
+        rows = devices.channel_rows(useq.MDAEvent(channel=channel))
+        np.testing.assert_allclose(rows[:3], old_aotf(ni, channel, powers)[:, :n_points],
+                                   rtol=0, atol=1e-12)
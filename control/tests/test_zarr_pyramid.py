@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+zarr = pytest.importorskip("zarr")
+from isim_control.eda._util.zarr_pyramid import build_pyramid, downsample
+from isim_control.eda._util.zarr_saver import OMEZarrWriter
+
+
+def test_downsample():
+    plane = np.arange(30, dtype=np.uint16).reshape(5, 6)
+    np.testing.assert_array_equal(downsample(plane, 2, "stride"), plane[:4:2, ::2])
+    np.testing.assert_array_equal(downsample(plane, 2),
+                                  np.rint(plane[:4].reshape(2, 2, 3, 2).mean(axis=(1, 3))))
+    assert downsample(plane, 2).dtype == np.uint16
+
+
+def test_pyramid_levels(sequence, run):
+    writer = OMEZarrWriter(pyramid=(2, 4))
+    frames = run(writer)
+    writer.sequenceFinished(sequence)
+    level = writer.level("p0", 1)
+    assert level.shape == (2, 5, 16, 12)
+    expected = frames[(1, 3)].reshape(16, 2, 12, 2).mean(axis=(1, 3))
+    np.testing.assert_array_equal(level[1, 3], np.rint(expected).astype(np.uint16))
+    assert writer.level("p0", 2).shape == (2, 5, 8, 6)
+    paths = [d["path"] for d in writer.group.attrs["multiscales"][0]["datasets"]]
+    assert paths == ["p0", "p0_2x", "p0_4x"]
+    writer.close()
+
+
+def test_build_pyramid_afterwards(tmp_path, sequence, run):
+    writer = OMEZarrWriter(tmp_path / "data.zarr")
+    frames = run(writer)
+    writer.sequenceFinished(sequence)
+    assert build_pyramid(tmp_path / "data.zarr", factors=(2,)) == {"p0": ["p0_2x"]}
+    level = zarr.open_group(tmp_path / "data.zarr")["p0_2x"]
+    np.testing.assert_array_equal(level[0, 1], downsample(frames[(0, 1)], 2))
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+zarr = pytest.importorskip("zarr")
+from isim_control.eda._util.zarr_saver import ChunkedOMEZarrWriter
+
+
+def test_chunked_writer_assembles_blocks(sequence, run):
+    writer = ChunkedOMEZarrWriter(chunks={"z": 2, "y": 16, "x": 16}, n_threads=2)
+    # Cancelled in the middle of the second z block of t=1
+    frames = run(writer, n_frames=8)
+    ary = writer.position_arrays["p0"]
+    assert ary.chunks == (1, 2, 16, 16)
+    assert list(writer._blocks) == [("p0", (1, 1))]
+    # Read from the buffer of the block until it is written
+    np.testing.assert_array_equal(writer.read_frame(ary, (1, 2)), frames[(1, 2)])
+    writer.sequenceFinished(sequence)
+    assert not writer._blocks and not writer._writing
+    for (t, z), frame in frames.items():
+        np.testing.assert_array_equal(ary[t, z], frame)
+        np.testing.assert_array_equal(writer.read_frame(ary, (t, z)), frame)
+    # Never written
+    assert not ary[1, 3].any()
+    writer.close()